@@ -7,7 +7,7 @@ import ray
 import random
 from tqdm import tqdm, trange
 import pickle
-from .utils import combined_shape
+from .utils import combined_shape, EpisodeRecorder
 from algorithms.envs.flow.envs.base import Env
 
 class ReplayBuffer:
@@ -180,9 +180,8 @@ class RL(object):
         returns = []
         scaled = []
         lengths = []
-        episodes = []
+        recorder = EpisodeRecorder(f"checkpoints/{self.name}/test", self.n_test, self.max_ep_len)
         for i in trange(self.n_test):
-            episode = []
             test_env = self.test_env
             test_env.reset()
             d, ep_ret, ep_len = np.array([False]), 0, 0
@@ -204,8 +203,8 @@ class RL(object):
                     state_gotten = test_env.state
                 if not isinstance(state_gotten, np.ndarray):
                     state_gotten = test_env.other2array(state_gotten)
-                episode += [(state_gotten.tolist(), action.cpu().numpy().tolist(), r.tolist())]
                 d = np.array(d)
+                recorder.store(i, s=state_gotten, a=action, r=r, d=d)
                 ep_ret += r.mean()
                 ep_len += 1
             if hasattr(test_env, 'rescaleReward'):
@@ -213,7 +212,7 @@ class RL(object):
                 ep_ret = test_env.rescaleReward(ep_ret, ep_len)
             returns += [ep_ret]
             lengths += [ep_len]
-            episodes += [episode]
+        recorder.close()
         returns = np.stack(returns, axis=0)
         lengths = np.stack(lengths, axis=0)
         self.logger.log(test_episode_reward=returns, test_episode_len=lengths, test_round=None)
@@ -221,13 +220,6 @@ class RL(object):
         print(f"{self.n_test} episodes average accumulated reward: {returns.mean()}")
         if hasattr(test_env, 'rescaleReward'):
             print(f"scaled reward {np.mean(scaled)}")
-        with open(f"checkpoints/{self.name}/test.pickle", "wb") as f:
-            pickle.dump(episodes, f)
-        with open(f"checkpoints/{self.name}/test.txt", "w") as f:
-            for episode in episodes:
-                for step in episode:
-                    f.write(f"{step[0]}, {step[1]}, {step[2]}\n")
-                f.write("\n")
         return returns.mean()
         
     def updateAgent(self):
@@ -72,6 +72,7 @@ def getArgs(radius_p, radius_v, radius_pi, env):
     p_args.node_hidden_size = [16, 16]
     p_args.reward_coeff = 10.0
     agent_args.p_args = p_args
+    agent_args.reward_oracle = None # env.rewardOracle() replaces the learned reward and done of the model
 
     v_args = Config()
     v_args.network = MLP
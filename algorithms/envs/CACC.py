@@ -1,6 +1,7 @@
 import gym
 import numpy as np
-from .NCS.cacc_env import CACCEnv
+from .NCS.cacc_env import CACCEnv, BatchedCACCEnv, VDIFF
+import torch
 from gym.spaces import Box, Discrete
 import configparser
 import os
@@ -36,8 +37,8 @@ class CACCWrapper(gym.Wrapper):
             return True
         return False
     
-    def reset(self):
-        state = self.env.reset()
+    def reset(self, **kwargs):
+        state = self.env.reset(**kwargs)
         state = np.array(state, dtype=np.float32)
         self.state = state
         return state
@@ -66,9 +67,13 @@ class CACCWrapper(gym.Wrapper):
     
     def state2Reward(self, state):
         # accepts a (gpu) tensor
-        # Deprecated
-        reward, done =  self.env.state2Reward(state)
-        return (reward+self.bias)/self.std, done
+        reward, done = self.rewardOracle(device=state.device)(None, None, state)
+        return reward, done
+
+    def rewardOracle(self, device='cpu'):
+        # v0s is replaced by every reset of the environment, the oracle reads the current one
+        v0s = (lambda: self.env.v0s) if hasattr(self.env, 'v0s') else None
+        return CACCRewardOracle(self.env, bias=self.bias, std=self.std, v0s=v0s, device=device)
     
     def rescaleReward(self, acc_reward, episode_len):
         """
@@ -102,6 +107,109 @@ class CACCWrapper(gym.Wrapper):
         return self.state
 
 
+class CACCRewardOracle:
+    """
+    The analytic (normalized and clipped) reward and done of CACCWrapper, computed from s1 on device.
+    Input s1: [..., n_agent, 5] (e.g. [b, n_agent, 5] or [b, T, n_agent, 5]), a is not used.
+    t: optional long tensor of the leading shape of s1, the time index of each s1 into v0s
+        (clipped to its last entry, model rollouts may run past the end of the episode);
+    without t, the speed of the leading vehicle is recovered from the vdiff feature of s1 (exact unless clipped).
+    v0s: the speeds of the leading vehicle, or a function returning the current ones (they change with the episodes),
+        copied to device once per new array.
+    Output: reward [..., n_agent], done [..., n_agent], where done is a collision.
+    """
+    def __init__(self, env, bias=0, std=1, v0s=None, device='cpu'):
+        for name in ['dt', 'h_min', 'h_star', 'v_star', 'u_max', 'a', 'b', 'G']:
+            setattr(self, name, getattr(env, name))
+        self.bias = bias
+        self.std = std
+        self.v0s = v0s
+        self.device = device
+        self.v0s_cache = None # (source array, device, tensor on device)
+
+    def to(self, device):
+        self.device = device
+        return self
+
+    def _v0s(self):
+        v0s = self.v0s() if callable(self.v0s) else self.v0s
+        if self.v0s_cache is None or self.v0s_cache[0] is not v0s or self.v0s_cache[1] != self.device:
+            self.v0s_cache = (v0s, self.device, torch.as_tensor(v0s, dtype=torch.float, device=self.device))
+        return self.v0s_cache[2]
+
+    def __call__(self, s, a, s1, t=None):
+        v = s1[..., 0] * self.v_star + self.v_star
+        u = s1[..., 4] * self.u_max
+        h = s1[..., 3] * self.h_star + self.h_star
+        if t is None:
+            v0 = v[..., :1] + s1[..., :1, 1] * VDIFF
+        else:
+            v0s = self._v0s()
+            v0 = v0s[t.clamp(max=v0s.shape[0] - 1)].unsqueeze(-1)
+        v_lead = torch.cat([v0, v[..., :-1]], dim=-1)
+        h = h - self.dt * (v_lead - v)
+        rewards = -(h - self.h_star) ** 2 - self.a * (v - self.v_star) ** 2 - self.b * u ** 2
+        collision = (h.min(dim=-1, keepdim=True)[0] < self.h_min).expand(*rewards.shape)
+        rewards = torch.where(collision, torch.full_like(rewards, -self.G), rewards)
+        rewards = ((rewards + self.bias) / self.std).clamp(-5, 5)
+        return rewards, collision
+
+
+class BatchedCACCWrapper(CACCWrapper):
+    """
+    CACCWrapper of a BatchedCACCEnv, states are [n_env, n_agent, 5], rewards and dones [n_env, n_agent].
+    With the torch backend, they are tensors on device.
+    """
+    def __init__(self, config_path, n_env, bias=0, std=1, test=False, backend='numpy', device='cpu'):
+        config_path = os.path.join(os.path.dirname(__file__), config_path)
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        env = BatchedCACCEnv(config['ENV_CONFIG'], n_env, backend=backend, device=device)
+        gym.Wrapper.__init__(self, env)
+        self.observation_space = Box(-1e6, 1e6, [5])
+        self.action_space = Discrete(4)
+        self.bias=bias
+        self.std=std
+        self.test = test
+        self.n_env = n_env
+        self.backend = backend
+        env.neighbor_mask += np.eye(env.n_agent, dtype=env.neighbor_mask.dtype)
+
+    def _float(self, x):
+        if self.backend == 'torch':
+            return x.float()
+        return x.astype(np.float32)
+
+    def reset(self):
+        state = self._float(self.env.reset())
+        self.state = state
+        return state
+
+    def rewardOracle(self, device='cpu'):
+        # v0s differs among the episodes of the batch, the oracle recovers it from the state instead
+        return CACCRewardOracle(self.env, bias=self.bias, std=self.std, device=device)
+
+    def _comparable_reward(self):
+        reward = self.env._get_reward()
+        if self.backend == 'torch':
+            reward = reward.cpu().numpy()
+        return reward
+
+    def step(self, action):
+        if isinstance(action, torch.Tensor) and self.backend != 'torch':
+            action = action.cpu().numpy()
+        state, reward, done, info = self.env.step(action)
+        if self.test:
+            reward = self.env._get_reward()
+        state = self._float(state)
+        reward = (self._float(reward)+self.bias)/self.std
+        done = self._float(done)[:, None]
+        self.state=state
+        if self.backend == 'torch':
+            return state, reward.clamp(-5, 5), done.expand(-1, self.env.n_agent), None
+        return state, np.clip(reward, -5, 5), done.repeat(self.env.n_agent, axis=1), None
+
+
 def CACC_catchup():
     return CACCWrapper('NCS/config/config_ma2c_nc_catchup.ini', bias=200, std=2000)
 
@@ -112,4 +220,10 @@ def CACC_catchup_test():
     return CACCWrapper('NCS/config/config_ma2c_nc_catchup.ini', bias=200, std=2000, test=True)
 
 def CACC_slowdown_test():
-    return CACCWrapper('NCS/config/config_ma2c_nc_slowdown.ini', bias=300, std=2000, test=True)
\ No newline at end of file
+    return CACCWrapper('NCS/config/config_ma2c_nc_slowdown.ini', bias=300, std=2000, test=True)
+
+def CACC_catchup_batched(n_env, backend='numpy', device='cpu'):
+    return BatchedCACCWrapper('NCS/config/config_ma2c_nc_catchup.ini', n_env, bias=200, std=2000, backend=backend, device=device)
+
+def CACC_slowdown_batched(n_env, backend='numpy', device='cpu'):
+    return BatchedCACCWrapper('NCS/config/config_ma2c_nc_slowdown.ini', n_env, bias=300, std=2000, backend=backend, device=device)
@@ -9,11 +9,13 @@ from algorithms.envs.flow.core.params import VehicleParams
 from algorithms.envs.flow.controllers import IDMController, ContinuousRouter, RLController
 from algorithms.envs.flow.core.params import TrafficLightParams
 from algorithms.envs.flow.networks.figure_eight import ADDITIONAL_NET_PARAMS
+from algorithms.envs.flow.core.kernel.simulation.loop import BatchedLoopEnv
 import gym
 from gym.spaces import Box, Discrete
 from gym.envs.registration import register
 
 import numpy as np
+import torch
 
 class FigureEightWrapper(AccelEnv):
     def __init__(self, env_params, sim_params, network, simulator):
@@ -47,12 +49,11 @@ class FigureEightWrapper(AccelEnv):
 
     def get_state_(self):
         """See class definition."""
-        speed = [self.k.vehicle.get_speed(veh_id) / self.k.network.max_speed()
-                 for veh_id in self.sorted_ids]
-        pos = [self.k.vehicle.get_x_by_id(veh_id) / self.k.network.length()
-               for veh_id in self.sorted_ids]
-        speed = np.array(speed).reshape((-1, 1))
-        pos = np.array(pos).reshape((-1, 1))
+        sorted_ids = self.sorted_ids
+        speed = np.asarray(self.k.vehicle.get_speed(sorted_ids)) / self.k.network.max_speed()
+        pos = np.asarray(self.k.vehicle.get_x_by_id(sorted_ids)) / self.k.network.length()
+        speed = speed.reshape((-1, 1))
+        pos = pos.reshape((-1, 1))
         return np.concatenate([speed, pos], axis=-1)
     
     def step(self, rl_actions: np.array):
@@ -79,6 +80,9 @@ class FigureEightWrapper(AccelEnv):
         n = self.n_agent
         return np.array([comp_r / n] * n, dtype=np.float32)
 
+    def rewardOracle(self, device='cpu'):
+        return FigureEightRewardOracle(self.k.network.max_speed(), self.env_params.additional_params['target_velocity'], self.env_params.evaluate)
+
     def init_neighbor_mask(self):
         n = self.n_agent
         for i in range(n):
@@ -95,7 +99,74 @@ class FigureEightWrapper(AccelEnv):
     def rescaleReward(self, ep_return, ep_len):
         return ep_return
 
-def makeFigureEight2(evaluate=False, version=0, render=None):
+class BatchedFigureEightWrapper(BatchedLoopEnv):
+    """
+    FigureEightWrapper of n_env figure eights stepped together in one LoopWorlds (see BatchedLoopEnv),
+    states are [n_env, n_agent, 2], rewards and dones [n_env, n_agent].
+    """
+    def __init__(self, env, n_env):
+        super().__init__(env, n_env)
+        self.target_vel = env.env_params.additional_params['target_velocity']
+        self.evaluate = env.env_params.evaluate
+
+    def _action_ids(self):
+        # see AccelEnv._apply_rl_actions()
+        rl_ids = self.env.k.vehicle.get_rl_ids()
+        return [veh_id for veh_id in self.env.sorted_ids if veh_id in rl_ids]
+
+    def step(self, rl_actions):
+        s1, d = super().step(rl_actions)
+        vel = self.speed()
+        # see FigureEightWrapper.get_reward_()
+        if self.evaluate:
+            r = np.repeat(vel.mean(axis=1, keepdims=True), self.n_agent, axis=1)
+        else:
+            r = self.target_vel - np.abs(self.target_vel - vel)
+        d = np.repeat(d[:, None], self.n_agent, axis=1)
+        return s1, r, d, None
+
+    def _comparable_reward(self):
+        # see FigureEightWrapper._comparable_reward() and rewards.desired_velocity()
+        vel = self.speed()
+        n = self.n_agent
+        if self.evaluate:
+            comp_r = vel.mean(axis=1)
+        else:
+            max_cost = np.linalg.norm(np.array([self.target_vel] * n))
+            cost = np.linalg.norm(vel - self.target_vel, axis=1)
+            comp_r = np.maximum(max_cost - cost, 0) / (max_cost + np.finfo(np.float32).eps)
+        return np.repeat((comp_r / n)[:, None], n, axis=1).astype(np.float32)
+
+    def rewardOracle(self, device='cpu'):
+        return FigureEightRewardOracle(self.env.k.network.max_speed(), self.target_vel, self.evaluate)
+
+    def rescaleReward(self, ep_return, ep_len):
+        return ep_return
+
+class FigureEightRewardOracle:
+    """
+    The analytic reward of FigureEightWrapper (see get_reward_()) on device.
+    Input s1: [..., n_agent, 2]
+    Output: reward [..., n_agent], done [..., n_agent] (always False, the episodes only end at the horizon)
+    """
+    def __init__(self, max_speed, target_vel, evaluate=False):
+        self.max_speed = max_speed
+        self.target_vel = target_vel
+        self.evaluate = evaluate
+
+    def to(self, device):
+        return self
+
+    def __call__(self, s, a, s1, t=None):
+        vel = s1[..., 0] * self.max_speed
+        if self.evaluate:
+            reward = vel.mean(dim=-1, keepdim=True).expand(*vel.shape)
+        else:
+            reward = self.target_vel - torch.abs(self.target_vel - vel)
+        return reward, torch.zeros(vel.shape, dtype=torch.bool, device=vel.device)
+
+
+def makeFigureEight2(evaluate=False, version=0, render=None, use_libsumo=False, simulator='traci'):
     HORIZON = 1500
     vehicles = VehicleParams()
     vehicles.add(
@@ -117,13 +188,14 @@ def makeFigureEight2(evaluate=False, version=0, render=None):
         # name of the network class the experiment is running on
         network=FigureEightNetwork,
 
-        # simulator that is used by the experiment
-        simulator='traci',
+        # simulator that is used by the experiment, 'traci' (sumo) or 'numpy'
+        simulator=simulator,
 
         # sumo-related parameters (see flow.core.params.SumoParams)
         sim=SumoParams(
             sim_step=0.1,
             render=render,
+            use_libsumo=use_libsumo,
             no_step_log=True,
             print_warnings=False
         ),
@@ -201,3 +273,6 @@ def makeFigureEight2(evaluate=False, version=0, render=None):
 
 def makeFigureEightTest():
     return makeFigureEight2(evaluate=True)
+
+def makeFigureEight2Batched(n_env, evaluate=False, version=0):
+    return BatchedFigureEightWrapper(makeFigureEight2(evaluate, version, simulator='numpy'), n_env)
@@ -385,6 +385,126 @@ class CACCEnv:
         self.init_test_seeds(test_seeds)
 
 
+class BatchedCACCEnv:
+    """
+    n_env CACC episodes stepped together, with hs, vs, us of shape [n_env, n_agent] and v0s of shape [n_env, T+1].
+    All the episodes share the time step t and are reset together.
+    The initial conditions of the episodes are drawn by a CACCEnv, one reset each,
+    so the episodes are the same as n_env consecutive episodes of CACCEnv (and identical for n_env=1 with numpy).
+    backend: 'numpy', or 'torch' to keep the arrays on device (float64)
+    Only the per-vehicle state (ma2c agents) is supported, and no data is recorded.
+    """
+    def __init__(self, config, n_env, backend='numpy', device='cpu'):
+        self.env = CACCEnv(config)
+        self.n_env = n_env
+        self.backend = backend
+        self.device = device
+        if self.env.agent.startswith('ia2c'):
+            raise NotImplementedError("BatchedCACCEnv only supports the per-vehicle state")
+        for name in ['dt', 'T', 'batch_size', 'h_min', 'h_star', 'h_s', 'h_g', 'v_max', 'v_star', 'u_min', 'u_max',
+                     'a', 'b', 'G', 'n_agent', 'n_a', 'n_a_ls', 'n_s_ls', 'coop_gamma', 'neighbor_mask', 'distance_mask',
+                     'action_space', 'observation_space', 'reward_range', 'metadata']:
+            setattr(self, name, getattr(self.env, name))
+        self.train_mode = False
+        self.alphas = self._array([alpha for alpha, _ in self.env.a_map])
+        self.betas = self._array([beta for _, beta in self.env.a_map])
+
+    def _array(self, x, dtype=None):
+        if self.backend == 'torch':
+            if not isinstance(x, torch.Tensor):
+                x = np.asarray(x)
+            # tensors (e.g. actions on the training device) are converted without a round trip through numpy
+            return torch.as_tensor(x, dtype=dtype if dtype is not None else torch.float64, device=self.device)
+        if isinstance(x, torch.Tensor):
+            x = x.detach().cpu().numpy()
+        return np.asarray(x, dtype=dtype if dtype is not None else np.float64)
+
+    def _clip(self, x, low, high):
+        if self.backend == 'torch':
+            return x.clamp(low, high)
+        return np.clip(x, low, high)
+
+    def _cat(self, ls):
+        if self.backend == 'torch':
+            return torch.cat(ls, dim=1)
+        return np.concatenate(ls, axis=1)
+
+    def _get_vh(self, h):
+        # the same as OVMCarFollowing.get_vh(), which is 0 at h_st and v_max at h_go
+        cos = torch.cos if self.backend == 'torch' else np.cos
+        h = self._clip(h, self.h_s, self.h_g)
+        return self.v_max / 2 * (1 - cos(np.pi * (h - self.h_s) / (self.h_g - self.h_s)))
+
+    def _v_lead(self, t):
+        return self._cat([self.v0s[:, t:t + 1], self.vs_cur[:, :-1]])
+
+    def _get_reward(self):
+        collided = (self.hs_cur < self.h_min).any(1)
+        self.collision = self.collision | collided
+        rewards = -(self.hs_cur - self.h_star) ** 2 - self.a * (self.vs_cur - self.v_star) ** 2 - self.b * (self.us_cur) ** 2
+        rewards[collided] = -self.G
+        return rewards
+
+    def _get_state(self):
+        """
+        Output: [n_env, n_agent, 5]
+        """
+        v_lead = self._v_lead(self.t)
+        v_state = (self.vs_cur - self.v_star) / self.v_star
+        vdiff_state = self._clip((v_lead - self.vs_cur) / VDIFF, -2, 2)
+        vhdiff_state = self._clip((self._get_vh(self.hs_cur) - self.vs_cur) / VDIFF, -2, 2)
+        h_state = (self.hs_cur + (v_lead - self.vs_cur) * self.dt - self.h_star) / self.h_star
+        u_state = self.us_cur / self.u_max
+        states = [v_state, vdiff_state, vhdiff_state, h_state, u_state]
+        if self.backend == 'torch':
+            return torch.stack(states, dim=-1)
+        return np.stack(states, axis=-1)
+
+    def reset(self):
+        hs, vs, v0s = [], [], []
+        for _ in range(self.n_env):
+            self.env.reset()
+            hs.append(self.env.hs[0])
+            vs.append(self.env.vs[0])
+            v0s.append(self.env.v0s)
+        self.t = 0
+        self.hs_cur, self.vs_cur, self.v0s = [self._array(item) for item in [hs, vs, v0s]]
+        self.us_cur = self.hs_cur * 0
+        self.collision = self._array(np.zeros(self.n_env, dtype=bool), dtype=torch.bool if self.backend == 'torch' else bool)
+        return self._get_state()
+
+    def step(self, action):
+        """
+        action: [n_env, n_agent]
+        Returns state [n_env, n_agent, 5], reward [n_env, n_agent], done [n_env], global reward [n_env]
+        """
+        action = self._array(action, dtype=torch.long if self.backend == 'torch' else np.int64).reshape(self.n_env, self.n_agent)
+        collision = self.collision
+        alpha, beta = self.alphas[action], self.betas[action]
+        u = alpha * (self._get_vh(self.hs_cur) - self.vs_cur) + beta * (self._v_lead(self.t) - self.vs_cur)
+        # apply v, u constraints
+        vs_next = self._clip(self.vs_cur + self._clip(u, self.u_min, self.u_max) * self.dt, 0, self.v_max)
+        us_next = (vs_next - self.vs_cur) / self.dt
+        # update headway
+        v_lead = self._v_lead(self.t)
+        v_lead_next = self._cat([self.v0s[:, self.t + 1:self.t + 2], vs_next[:, :-1]])
+        hs_next = self.hs_cur + 0.5 * self.dt * (v_lead + v_lead_next - self.vs_cur - vs_next)
+        # if collision happens, the episode stays still and returns -G for all the remaining steps
+        for cur, nxt in [(self.hs_cur, hs_next), (self.vs_cur, vs_next), (self.us_cur, us_next)]:
+            nxt[collision] = cur[collision]
+        self.hs_cur, self.vs_cur, self.us_cur = hs_next, vs_next, us_next
+        reward = self._get_reward()
+        reward[collision] = -self.G
+        self.t += 1
+        global_reward = reward.sum(1)
+        done = self.collision.clone() if self.backend == 'torch' else self.collision.copy()
+        if self.t % self.batch_size:
+            done[:] = False
+        if self.t == self.T:
+            done[:] = True
+        return self._get_state(), reward, done, global_reward
+
+
 class OVMCarFollowing:
     '''
     The OVM controller for vehicle ACC
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from copy import deepcopy
 import gym
 from gym.spaces import Box, Discrete
@@ -9,6 +10,7 @@ from ..envs.flow.core.params import SumoParams, EnvParams, InitialConfig, NetPar
 from ..envs.flow.core.params import VehicleParams, SumoCarFollowingParams
 from ..envs.flow.controllers import RLController, IDMController, ContinuousRouter
 from ..envs.flow.networks import RingNetwork
+from ..envs.flow.core.kernel.simulation.loop import BatchedLoopEnv
 
 class RingAttenuationWrapper(WaveAttenuationEnv):
     def __init__(self, env_params, sim_params, network, simulator='traci'):
@@ -57,12 +59,11 @@ class RingAttenuationWrapper(WaveAttenuationEnv):
 
     def get_state_(self):
         """See class definition."""
-        speed = [self.k.vehicle.get_speed(veh_id) / self.k.network.max_speed()
-                 for veh_id in self.sorted_ids]
-        pos = [self.k.vehicle.get_x_by_id(veh_id) / self.k.network.length()
-               for veh_id in self.sorted_ids]
-        speed = np.array(speed).reshape((-1, 1))
-        pos = np.array(pos).reshape((-1, 1))
+        sorted_ids = self.sorted_ids
+        speed = np.asarray(self.k.vehicle.get_speed(sorted_ids)) / self.k.network.max_speed()
+        pos = np.asarray(self.k.vehicle.get_x_by_id(sorted_ids)) / self.k.network.length()
+        speed = speed.reshape((-1, 1))
+        pos = pos.reshape((-1, 1))
         return np.concatenate([speed, pos], axis=-1)
     
     def step(self, rl_actions):
@@ -99,6 +100,9 @@ class RingAttenuationWrapper(WaveAttenuationEnv):
 
         return reward
 
+    def rewardOracle(self, device='cpu'):
+        return RingRewardOracle(self.k.network.max_speed(), self.n_agent, self.target_vel)
+
     def init_neighbor_mask(self):
         n = self.n_agent
         for i in range(n):
@@ -115,7 +119,62 @@ class RingAttenuationWrapper(WaveAttenuationEnv):
     def rescaleReward(self, ep_return, ep_len):
         return ep_return
 
-def makeRingAttenuation(evaluate=False, version=0, render=None):
+class BatchedRingAttenuationWrapper(BatchedLoopEnv):
+    """
+    RingAttenuationWrapper of n_env rings stepped together in one LoopWorlds (see BatchedLoopEnv),
+    states are [n_env, n_agent, 2], rewards and dones [n_env, n_agent].
+    The rings of a batch share the ring length drawn by its first reset.
+    """
+    def __init__(self, env, n_env):
+        super().__init__(env, n_env)
+        self.target_vel = env.target_vel
+
+    def step(self, rl_actions):
+        rl_actions = np.asarray(rl_actions).reshape(self.n_env, self.n_agent)
+        s1, d = super().step(rl_actions)
+        vel = self.speed()
+        # see RingAttenuationWrapper.get_reward_()
+        eta_2 = 4.
+        r = eta_2 * (self.target_vel - np.abs(self.target_vel - vel)) / (20 * self.n_agent)
+        eta = 4  # 0.25
+        r += eta * (0 - np.abs(rl_actions) / self.n_agent)
+        d = np.repeat(d[:, None], self.n_agent, axis=1)
+        return s1, r, d, None
+
+    def rewardOracle(self, device='cpu'):
+        return RingRewardOracle(self.env.k.network.max_speed(), self.n_agent, self.target_vel)
+
+    def rescaleReward(self, ep_return, ep_len):
+        return ep_return
+
+class RingRewardOracle:
+    """
+    The analytic reward of RingAttenuationWrapper (see get_reward_()) on device.
+    Input s1: [..., n_agent, 2], a: [..., n_agent] or [..., n_agent, 1]
+    Output: reward [..., n_agent], done [..., n_agent] (always False, the episodes only end at the horizon)
+    """
+    def __init__(self, max_speed, n_agent, target_vel=20.):
+        self.max_speed = max_speed
+        self.n_agent = n_agent
+        self.target_vel = target_vel
+
+    def to(self, device):
+        return self
+
+    def __call__(self, s, a, s1, t=None):
+        vel = s1[..., 0] * self.max_speed
+        a = a.float().view(vel.shape)
+        # reward average velocity
+        eta_2 = 4.
+        reward = eta_2 * (self.target_vel - torch.abs(self.target_vel - vel)) / (20 * self.n_agent)
+        # punish accelerations (should lead to reduced stop-and-go waves)
+        eta = 4  # 0.25
+        reward = reward + eta * (0 - torch.abs(a) / self.n_agent)
+        reward = torch.where((vel < -100).any(dim=-1, keepdim=True).expand(*vel.shape), torch.zeros_like(reward), reward)
+        return reward, torch.zeros(vel.shape, dtype=torch.bool, device=vel.device)
+
+
+def makeRingAttenuation(evaluate=False, version=0, render=None, use_libsumo=False, simulator='traci'):
     # time horizon of a single rollout
     HORIZON = 3000
     NUM_VEHICLES = 22
@@ -142,13 +201,14 @@ def makeRingAttenuation(evaluate=False, version=0, render=None):
         # name of the network class the experiment is running on
         network=RingNetwork,
 
-        # simulator that is used by the experiment
-        simulator='traci',
+        # simulator that is used by the experiment, 'traci' (sumo) or 'numpy'
+        simulator=simulator,
 
         # sumo-related parameters (see flow.core.params.SumoParams)
         sim=SumoParams(
             sim_step=0.1,
             render=render,
+            use_libsumo=use_libsumo,
             restart_instance=False,
             no_step_log=True,
             print_warnings=False
@@ -227,3 +287,6 @@ def makeRingAttenuation(evaluate=False, version=0, render=None):
         })
 
     return gym.envs.make(env_name)
+
+def makeRingAttenuationBatched(n_env, evaluate=False, version=0):
+    return BatchedRingAttenuationWrapper(makeRingAttenuation(evaluate, version, simulator='numpy'), n_env)
@@ -1,9 +1,14 @@
 from typing import List
+import multiprocessing as mp
+import os
+import random
+import traceback
 from numpy.lib.arraysetops import isin
 import ray
 import numpy as np
 import torch
-from algorithms.utils import parallelEval
+from gym.spaces import Discrete
+from algorithms.utils import parallelEval, setSeed
 
 @ray.remote
 class EnvWrapper(object):
@@ -76,3 +81,253 @@ class VectorizedEnv:
         data = [{} for _ in range(self.n_env)]
         results = self.eval(self.envs, 'reset', data)
         return self.get_state_()
+
+
+def seededReset(env, seed=None, keep_rng=False):
+    """
+    Resets env, with random, np and torch seeded by seed if it is not None.
+    For the environments with test seeds (CACCEnv.init_test_seeds), the episode is the one of this test seed.
+        keep_rng: restores the global RNGs of the process after the reset, for an env that runs in the learner's process
+            (the reset is seeded, the steps that follow are not)
+    """
+    if seed is None:
+        return env.reset()
+    if keep_rng:
+        state = _rngState()
+        try:
+            return seededReset(env, seed)
+        finally:
+            _setRngState(state)
+    setSeed(seed)
+    if hasattr(env, 'init_test_seeds'):
+        env.init_test_seeds([seed])
+        return env.reset(test_ind=0)
+    return env.reset()
+
+
+def _rngState():
+    cuda = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    return random.getstate(), np.random.get_state(), torch.get_rng_state(), cuda, torch.backends.cudnn.deterministic
+
+
+def _setRngState(state):
+    python, numpy, cpu, cuda, deterministic = state
+    random.setstate(python)
+    np.random.set_state(numpy)
+    torch.set_rng_state(cpu)
+    if cuda is not None:
+        torch.cuda.set_rng_state_all(cuda)
+    torch.backends.cudnn.deterministic = deterministic
+
+
+def _subprocWorker(env_fn, index, pipe, buffers, seed=None):
+    """
+    Runs one environment in a subprocess.
+    The actions are read from and the results written into the shared buffers, the pipe only carries commands and infos.
+    Without buffers, reset returns the state through the pipe (to read the specs of the environment).
+    The RNGs are seeded by seed + index, or from the OS entropy if seed is None,
+    since the forked workers would otherwise all start with the RNG states of the parent.
+    """
+    setSeed((seed + index) % 2 ** 32 if seed is not None else int.from_bytes(os.urandom(4), 'little'))
+    env = env_fn()
+    arrays = None
+    if buffers is not None:
+        arrays = {name: np.frombuffer(raw, dtype=dtype).reshape(shape) for name, (raw, dtype, shape) in buffers.items()}
+    while True:
+        cmd, data = pipe.recv()
+        try:
+            if cmd == 'step':
+                s1, r, d, info = env.step(arrays['a'][index])
+                arrays['s'][index] = s1
+                arrays['r'][index] = r
+                arrays['d'][index] = d
+                result = info
+            elif cmd == 'reset':
+                seededReset(env, data)
+                result = None
+                if arrays is None:
+                    result = np.asarray(env.get_state_())
+                else:
+                    arrays['s'][index] = env.get_state_()
+            elif cmd == 'getAttr':
+                result = getattr(env, data)
+            elif cmd == 'hasAttr':
+                result = hasattr(env, data)
+            elif cmd == 'call':
+                name, args = data
+                result = getattr(env, name)(*args)
+            elif cmd == 'close':
+                pipe.send((True, None))
+                break
+            else:
+                raise ValueError(f"unknown command {cmd}")
+            pipe.send((True, result))
+        except Exception:
+            pipe.send((False, traceback.format_exc()))
+    pipe.close()
+
+
+class SubprocVectorizedEnv:
+    """
+    VectorizedEnv with subprocesses instead of ray actors.
+    States, rewards, dones and actions are exchanged through preallocated shared memory, the pipes only signal.
+    Environment 0 runs in this process (so n_env=1 runs sequentially without any subprocess),
+    it is stepped while the subprocesses step the others.
+    step() returns s1, so get_state_() is only a copy of the shared states.
+    Rescale reward is not defined by this implementation.
+        env_args.local_env: False runs environment 0 in a subprocess too, so that no environment is built in this
+            process (its attributes and state are read from a first worker, closed once the buffers are allocated),
+            and the seeded resets and the steps of the episodes only use the RNGs of the subprocesses
+        env_args.seed: the workers are seeded by seed + their index (from the OS entropy if it is None)
+    """
+    names = [
+        'n_s_ls', 'n_a_ls', 'coop_gamma', 'observation_space', 'action_space', 'neighbor_mask', 'distance_mask']
+
+    def __init__(self, env_fn, env_args):
+        self.n_env = env_args.n_env
+        self.local_env = True if (not hasattr(env_args, "local_env")) else env_args.local_env
+        self.n_local = 1 if self.local_env else 0
+        seed = None if (not hasattr(env_args, "seed")) else env_args.seed
+        self.pipes, self.processes = [], []
+        if self.local_env:
+            self.env = env_fn()
+            self.env.reset()
+            state = np.asarray(self.env.get_state_())
+            for name in self.names + ['rescaleReward']:
+                if hasattr(self.env, name):
+                    setattr(self, name, getattr(self.env, name))
+        else:
+            self.env = None
+            pipe, process = self._start(env_fn, 0, None, seed)
+            state = self._request(pipe, 'reset')
+            for name in self.names:
+                if self._request(pipe, 'hasAttr', name):
+                    setattr(self, name, self._request(pipe, 'getAttr', name))
+            if self._request(pipe, 'hasAttr', 'rescaleReward'):
+                self.rescaleReward = self._rescaleReward
+            self._request(pipe, 'close')
+            process.join()
+        n_agent = self.neighbor_mask.shape[0]
+        if isinstance(self.action_space, Discrete):
+            a_shape, a_dtype = [n_agent], np.int64
+        else:
+            a_shape, a_dtype = [n_agent] + list(self.action_space.shape), np.float32
+        specs = {
+            's': (state.dtype, [self.n_env] + list(state.shape)),
+            'r': (np.float32, [self.n_env, n_agent]),
+            'd': (np.bool_, [self.n_env, n_agent]),
+            'a': (a_dtype, [self.n_env] + a_shape),
+        }
+        self.buffers = {}
+        self.arrays = {}
+        for name, (dtype, shape) in specs.items():
+            dtype = np.dtype(dtype)
+            raw = mp.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+            self.buffers[name] = (raw, dtype, shape)
+            self.arrays[name] = np.frombuffer(raw, dtype=dtype).reshape(shape)
+        self.arrays['s'][0] = state
+
+        for i in range(self.n_local, self.n_env):
+            pipe, process = self._start(env_fn, i, self.buffers, seed)
+            self.pipes.append(pipe)
+            self.processes.append(process)
+        self._call('reset')
+
+    @staticmethod
+    def _start(env_fn, index, buffers, seed):
+        pipe, child_pipe = mp.Pipe()
+        process = mp.Process(target=_subprocWorker, args=(env_fn, index, child_pipe, buffers, seed), daemon=True)
+        process.start()
+        child_pipe.close()
+        return pipe, process
+
+    def _request(self, pipe, cmd, data=None):
+        pipe.send((cmd, data))
+        return self._receive([pipe])[0]
+
+    def _rescaleReward(self, *args):
+        """ rescaleReward() of the environment of the first worker, without a local environment """
+        return self._request(self.pipes[0], 'call', ('rescaleReward', args))
+
+    def _send(self, cmd, data=None):
+        for pipe in self.pipes:
+            pipe.send((cmd, data))
+
+    def _receive(self, pipes=None):
+        results = []
+        for pipe in self.pipes if pipes is None else pipes:
+            success, result = pipe.recv()
+            if not success:
+                raise RuntimeError(f"subprocess environment failed:\n{result}")
+            results.append(result)
+        return results
+
+    def _call(self, cmd, data=None):
+        self._send(cmd, data)
+        return self._receive()
+
+    def get_state_(self):
+        return self.arrays['s'].copy()
+
+    def step(self, actions):
+        """
+        actions: [n_env, n_agent, ...]
+        Returns s1, r, d of [n_env, n_agent, ...] and the list of infos.
+        """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions, indices=None):
+        """
+        Starts stepping the environments of indices (all of them by default), actions: [len(indices), n_agent, ...]
+        step_wait() should then be called with the same indices.
+        A local environment 0 is stepped here, after the others have been dispatched, so that it overlaps with them.
+        """
+        indices = list(range(self.n_env)) if indices is None else list(indices)
+        a = self.arrays['a']
+        a[indices] = np.asarray(actions).reshape([len(indices)] + list(a.shape[1:]))
+        for i in indices:
+            if i >= self.n_local:
+                self.pipes[i - self.n_local].send(('step', None))
+        if self.local_env and 0 in indices:
+            s1, r, d, self.local_info = self.env.step(a[0])
+            self.arrays['s'][0] = s1
+            self.arrays['r'][0] = r
+            self.arrays['d'][0] = d
+
+    def step_wait(self, indices=None):
+        """
+        Returns s1, r, d of [len(indices), n_agent, ...] and the list of infos.
+        """
+        indices = list(range(self.n_env)) if indices is None else list(indices)
+        infos = []
+        if self.local_env and 0 in indices:
+            infos.append(self.local_info)
+        infos += self._receive([self.pipes[i - self.n_local] for i in indices if i >= self.n_local])
+        return self.arrays['s'][indices], self.arrays['r'][indices], self.arrays['d'][indices], infos
+
+    def reset(self, seeds=None, indices=None):
+        """
+        Resets the environments of indices (all of them by default), 
+        seeds: None, or the seed of the episode of each of them (see seededReset),
+            the global RNGs of this process are left as they are
+        """
+        indices = list(range(self.n_env)) if indices is None else list(indices)
+        seeds = [None] * len(indices) if seeds is None else list(seeds)
+        pipes = []
+        for i, seed in zip(indices, seeds):
+            if i >= self.n_local:
+                self.pipes[i - self.n_local].send(('reset', seed))
+                pipes.append(self.pipes[i - self.n_local])
+        for i, seed in zip(indices, seeds):
+            if i < self.n_local:
+                seededReset(self.env, seed, keep_rng=True)
+                self.arrays['s'][0] = self.env.get_state_()
+        self._receive(pipes)
+        return self.get_state_()
+
+    def close(self):
+        self._call('close')
+        for process in self.processes:
+            process.join()
+        self.pipes, self.processes = [], []
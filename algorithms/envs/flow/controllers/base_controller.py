@@ -76,6 +76,7 @@ class BaseController(metaclass=ABCMeta):
             'obey_speed_limit': self.get_obey_speed_limit_action
         }
         self.failsafes = []
+        self.failsafe_names = tuple(failsafe_list) if failsafe_list else ()
         if failsafe_list:
             for check in failsafe_list:
                 if check in failsafe_map:
@@ -96,6 +97,34 @@ class BaseController(metaclass=ABCMeta):
         """Return the acceleration of the controller."""
         pass
 
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """Return the accelerations of a batch of vehicles using this class.
+
+        Controller classes that do not override this method are evaluated one
+        vehicle at a time with get_accel().
+
+        Parameters
+        ----------
+        env : flow.envs.Env
+            state of the environment at the current time step
+        batch : ControllerBatch
+            the controllers of the vehicles, with their parameters (see
+            ControllerBatch.param) and the current state of their vehicles
+
+        Returns
+        -------
+        np.ndarray
+            the acceleration of each vehicle, NaN to let sumo control it
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def is_batched(cls):
+        """Return whether the class implements get_accel_batch()."""
+        return cls.get_accel_batch.__func__ is not \
+            BaseController.get_accel_batch.__func__
+
     def get_action(self, env):
         """Convert the get_accel() acceleration into an action.
 
@@ -379,3 +408,249 @@ class BaseController(metaclass=ABCMeta):
                     "=====================================".format(self.veh_id))
 
         return action
+
+
+class ControllerBatch:
+    """The acceleration controllers of a group of vehicles, evaluated at once.
+
+    All the controllers are of the same class and use the same failsafes.
+    Their parameters are gathered into arrays the first time they are needed,
+    and the state of their vehicles is read from the columns of the
+    VehicleTable of the vehicle kernel at each step, so that the
+    accelerations, noise and failsafes are computed with a few NumPy calls
+    instead of one get_action() call per vehicle.
+
+    Attributes
+    ----------
+    veh_ids : list of str
+        the vehicles of the batch
+    controllers : list of BaseController
+        their acceleration controllers
+    rows : np.ndarray
+        row of each vehicle in the vehicle table
+    speed, headway, edge : np.ndarray
+        current speed, headway and edge code of each vehicle
+    has_lead : np.ndarray
+        whether each vehicle has a (known) leader
+    lead_speed : np.ndarray
+        speed of the leader of each vehicle, -1001 if there is none
+    skip : np.ndarray
+        vehicles left to sumo at this step, i.e. not subscribed yet or in a
+        junction
+    """
+
+    def __init__(self, controllers):
+        """Instantiate a batch of controllers of the same class."""
+        self.controllers = controllers
+        self.veh_ids = [controller.veh_id for controller in controllers]
+        self.controller_class = type(controllers[0])
+        self.failsafe_names = controllers[0].failsafe_names
+        self._params = {}
+
+    def __len__(self):
+        return len(self.controllers)
+
+    def param(self, name):
+        """Return an attribute of all the controllers, as a float array."""
+        value = self._params.get(name)
+        if value is None:
+            value = np.array([getattr(controller, name)
+                              for controller in self.controllers],
+                             dtype=np.float64)
+            self._params[name] = value
+        return value
+
+    def update(self, env):
+        """Read the current state of the vehicles from the vehicle table."""
+        table = env.k.vehicle.get_table()
+        data = table.data
+        self.rows = table.row_array(self.veh_ids)
+        self.speed = data['speed'][self.rows]
+        self.headway = data['headway'][self.rows]
+        self.edge = data['edge'][self.rows]
+        leader = data['leader'][self.rows]
+        self.has_lead = leader >= 0
+        self.lead_speed = np.where(self.has_lead, data['speed'][leader], -1001)
+        self.skip = (self.rows < 0) | table.internal_edges()[self.edge]
+
+    def get_actions(self, env):
+        """Return the accelerations of the vehicles.
+
+        This is the batched equivalent of BaseController.get_action(): the
+        accelerations with and without noise and failsafes are stored in the
+        vehicle kernel, and NaN is returned for the vehicles left to sumo.
+        """
+        self.update(env)
+        vehicle = env.k.vehicle
+        with np.errstate(divide='ignore', invalid='ignore'):
+            accel = np.array(self.controller_class.get_accel_batch(env, self),
+                             dtype=np.float64)
+            accel[self.skip] = np.nan
+            vehicle.update_accel(self.veh_ids, accel,
+                                 noise=False, failsafe=False)
+            vehicle.update_accel(self.veh_ids, self.apply_failsafes(env, accel),
+                                 noise=False, failsafe=True)
+
+            # add noise to the accelerations, if requested
+            noise = self.param('accel_noise')
+            noisy = (noise > 0) & ~np.isnan(accel)
+            if noisy.any():
+                accel[noisy] += np.sqrt(env.sim_step) * \
+                    np.random.normal(0, noise[noisy])
+            vehicle.update_accel(self.veh_ids, accel,
+                                 noise=True, failsafe=False)
+
+            accel = self.apply_failsafes(env, accel)
+            vehicle.update_accel(self.veh_ids, accel,
+                                 noise=True, failsafe=True)
+        return accel
+
+    def apply_failsafes(self, env, action):
+        """Apply the failsafes of the controllers, in order."""
+        for name in self.failsafe_names:
+            action = self.FAILSAFES[name](self, env, action)
+        return action
+
+    def _warn(self, mask, message):
+        """Print a failsafe warning for the masked vehicles."""
+        mask = mask & (self.param('display_warnings') > 0)
+        for i in np.flatnonzero(mask):
+            print("=====================================\n"
+                  + message.format(self.veh_ids[i]) +
+                  "\n=====================================")
+
+    def safe_action_instantaneous(self, env, action):
+        """See BaseController.get_safe_action_instantaneous."""
+        # if there is only one vehicle in the network, all actions are safe
+        if env.k.vehicle.num_vehicles == 1:
+            return action
+        this_vel = self.speed
+        sim_step = env.sim_step
+        next_vel = this_vel + action * sim_step
+        crash = self.has_lead & (next_vel > 0) & (
+            self.headway < sim_step * next_vel + this_vel * 1e-3 +
+            0.5 * this_vel * sim_step)
+        self._warn(crash, "Vehicle {} is about to crash. Instantaneous "
+                          "acceleration clipping applied.")
+        return np.where(crash, -this_vel / sim_step, action)
+
+    def safe_velocity_action(self, env, action):
+        """See BaseController.get_safe_velocity_action."""
+        # if there is only one vehicle in the network, all actions are safe
+        if env.k.vehicle.num_vehicles == 1:
+            return action
+        this_vel = self.speed
+        sim_step = env.sim_step
+        v_safe = 2 * self.headway / sim_step + (self.lead_speed - this_vel) \
+            - this_vel * (2 * self.param('delay'))
+        self._warn(~np.isnan(action) & (this_vel > v_safe),
+                   "Speed of vehicle {} is greater than safe speed. Safe "
+                   "velocity clipping applied.")
+        return np.where(this_vel + action * sim_step > v_safe,
+                        np.where(v_safe > 0, (v_safe - this_vel) / sim_step,
+                                 -this_vel / sim_step),
+                        action)
+
+    def obey_speed_limit_action(self, env, action):
+        """See BaseController.get_obey_speed_limit_action."""
+        # speed limit of the edge of each (controlled) vehicle
+        edge_speed_limit = np.full(len(self), np.inf)
+        valid = ~np.isnan(action)
+        if valid.any():
+            codes, inverse = np.unique(self.edge[valid], return_inverse=True)
+            names = env.k.vehicle.get_table().edge_names
+            limits = np.array([env.k.network.speed_limit(names[code])
+                               for code in codes], dtype=np.float64)
+            edge_speed_limit[valid] = limits[inverse]
+
+        this_vel = self.speed
+        sim_step = env.sim_step
+        over = this_vel + action * sim_step > edge_speed_limit
+        self._warn(over & (edge_speed_limit > 0),
+                   "Speed of vehicle {} is greater than speed limit. Obey "
+                   "speed limit clipping applied.")
+        return np.where(over,
+                        np.where(edge_speed_limit > 0,
+                                 (edge_speed_limit - this_vel) / sim_step,
+                                 -this_vel / sim_step),
+                        action)
+
+    def feasible_action(self, env, action):
+        """See BaseController.get_feasible_action."""
+        max_accel = self.param('max_accel')
+        max_deaccel = self.param('max_deaccel')
+        self._warn(action > max_accel,
+                   "Acceleration of vehicle {} is greater than the max "
+                   "acceleration. Feasible acceleration clipping applied.")
+        self._warn(np.minimum(action, max_accel) < -max_deaccel,
+                   "Deceleration of vehicle {} is greater than the max "
+                   "deceleration. Feasible acceleration clipping applied.")
+        return np.maximum(np.minimum(action, max_accel), -max_deaccel)
+
+    FAILSAFES = {
+        'instantaneous': safe_action_instantaneous,
+        'safe_velocity': safe_velocity_action,
+        'feasible_accel': feasible_action,
+        'obey_speed_limit': obey_speed_limit_action,
+    }
+
+
+class BatchedControllers:
+    """Evaluate the acceleration controllers of the controlled vehicles.
+
+    The vehicles whose controller class implements get_accel_batch() are
+    grouped by controller class and failsafes into ControllerBatch objects,
+    the others (and all the vehicles, if the vehicle kernel has no
+    VehicleTable) fall back to BaseController.get_action(). The groups are
+    rebuilt only when the controllers of the vehicles change.
+    """
+
+    def __init__(self):
+        """Instantiate without any groups."""
+        self._controllers = None
+        self._batches = []
+        self._single = []
+
+    def _group(self, controllers, batched):
+        """Split the controllers into batches and single controllers."""
+        groups = {}
+        self._single = []
+        for i, controller in enumerate(controllers):
+            if batched and controller is not None and \
+                    type(controller).is_batched():
+                key = (type(controller), controller.failsafe_names)
+                groups.setdefault(key, []).append((i, controller))
+            else:
+                self._single.append((i, controller))
+        self._batches = [
+            ([i for i, _ in group], ControllerBatch([c for _, c in group]))
+            for group in groups.values()]
+        self._controllers = controllers
+
+    def get_actions(self, env, veh_ids):
+        """Return the accelerations of the controllers of the vehicles.
+
+        Parameters
+        ----------
+        env : flow.envs.Env
+            state of the environment at the current time step
+        veh_ids : list of str
+            the controlled vehicles
+
+        Returns
+        -------
+        list of float or None
+            the acceleration of each vehicle, None for the vehicles left to
+            sumo at this step
+        """
+        controllers = env.k.vehicle.get_acc_controller(list(veh_ids))
+        if controllers != self._controllers:
+            self._group(controllers, env.k.vehicle.get_table() is not None)
+
+        accel = [None] * len(controllers)
+        for i, controller in self._single:
+            accel[i] = controller.get_action(env)
+        for index, batch in self._batches:
+            for i, action in zip(index, batch.get_actions(env).tolist()):
+                accel[i] = None if np.isnan(action) else action
+        return accel
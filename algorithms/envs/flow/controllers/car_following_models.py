@@ -6,7 +6,9 @@ in Flow to match various prominent car-following models that can be calibrated.
 
 Each controller includes the function ``get_accel(self, env) -> acc`` which,
 using the current state of the world and existing parameters, uses the control
-model to return a vehicle acceleration.
+model to return a vehicle acceleration. Most of them also implement
+``get_accel_batch(cls, env, batch) -> accs``, which computes the accelerations
+of all the vehicles using the model at once (see ControllerBatch).
 """
 import math
 import numpy as np
@@ -90,6 +92,15 @@ class CFMController(BaseController):
         return self.k_d*(d_l - self.d_des) + self.k_v*(lead_vel - this_vel) + \
             self.k_c*(self.v_des - this_vel)
 
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """See parent class."""
+        this_vel = batch.speed
+        accel = batch.param('k_d') * (batch.headway - batch.param('d_des')) \
+            + batch.param('k_v') * (batch.lead_speed - this_vel) \
+            + batch.param('k_c') * (batch.param('v_des') - this_vel)
+        return np.where(batch.has_lead, accel, batch.param('max_accel'))
+
 
 class BCMController(BaseController):
     """Bilateral car-following model controller.
@@ -181,6 +192,22 @@ class BCMController(BaseController):
             self.k_v * ((lead_vel - this_vel) - (this_vel - trail_vel)) + \
             self.k_c * (self.v_des - this_vel)
 
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """See parent class."""
+        table = env.k.vehicle.get_table()
+        trail = table.data['follower'][batch.rows]
+        has_trail = (batch.rows >= 0) & (trail >= 0)
+        trail_vel = np.where(has_trail, table.data['speed'][trail], -1001)
+        footway = np.where(has_trail, table.data['headway'][trail], -1001)
+
+        this_vel = batch.speed
+        accel = batch.param('k_d') * (batch.headway - footway) + \
+            batch.param('k_v') * ((batch.lead_speed - this_vel) -
+                                  (this_vel - trail_vel)) + \
+            batch.param('k_c') * (batch.param('v_des') - this_vel)
+        return np.where(batch.has_lead, accel, batch.param('max_accel'))
+
 
 class LACController(BaseController):
     """Linear Adaptive Cruise Control.
@@ -339,6 +366,26 @@ class OVMController(BaseController):
 
         return self.alpha * (v_h - this_vel) + self.beta * h_dot
 
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """See parent class."""
+        this_vel = batch.speed
+        h = batch.headway
+        h_st, h_go = batch.param('h_st'), batch.param('h_go')
+        v_max = batch.param('v_max')
+
+        # V function here - input: h, output : Vh
+        v_h = np.where(
+            h <= h_st, 0,
+            np.where(h < h_go,
+                     v_max / 2 * (1 - np.cos(np.pi * (h - h_st) /
+                                             (h_go - h_st))),
+                     v_max))
+
+        accel = batch.param('alpha') * (v_h - this_vel) + \
+            batch.param('beta') * (batch.lead_speed - this_vel)
+        return np.where(batch.has_lead, accel, batch.param('max_accel'))
+
 
 class LinearOVM(BaseController):
     """Linear OVM controller.
@@ -411,6 +458,20 @@ class LinearOVM(BaseController):
 
         return (v_h - this_vel) / self.adaptation
 
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """See parent class."""
+        h = batch.headway
+        h_st, v_max = batch.param('h_st'), batch.param('v_max')
+
+        # V function here - input: h, output : Vh
+        alpha = 1.689  # the average value from Nakayama paper
+        v_h = np.where(h < h_st, 0,
+                       np.where(h <= h_st + v_max / alpha,
+                                alpha * (h - h_st), v_max))
+
+        return (v_h - batch.speed) / batch.param('adaptation')
+
 
 class IDMController(BaseController):
     """Intelligent Driver Model (IDM) controller.
@@ -499,6 +560,24 @@ class IDMController(BaseController):
 
         return self.a * (1 - (v / self.v0)**self.delta - (s_star / h)**2)
 
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """See parent class."""
+        v = batch.speed
+        # in order to deal with ZeroDivisionError
+        h = np.where(np.abs(batch.headway) < 1e-3, 1e-3, batch.headway)
+        a, b = batch.param('a'), batch.param('b')
+
+        s_star = np.where(
+            batch.has_lead,
+            batch.param('s0') + np.maximum(
+                0, v * batch.param('T') + v * (v - batch.lead_speed) /
+                (2 * np.sqrt(a * b))),
+            0)
+
+        return a * (1 - (v / batch.param('v0'))**batch.param('delta') -
+                    (s_star / h)**2)
+
 
 class SimCarFollowingController(BaseController):
     """Controller whose actions are purely defined by the simulator.
@@ -514,6 +593,11 @@ class SimCarFollowingController(BaseController):
         """See parent class."""
         return None
 
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """See parent class."""
+        return np.full(len(batch), np.nan)
+
 
 class GippsController(BaseController):
     """Gipps' Model controller.
@@ -601,6 +685,27 @@ class GippsController(BaseController):
 
         return (v_next-v)/env.sim_step
 
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """See parent class."""
+        v = batch.speed
+        h = batch.headway
+        v_l = batch.lead_speed
+        v_desired, acc = batch.param('v_desired'), batch.param('acc')
+        b, b_l = batch.param('b'), batch.param('b_l')
+        s0, tau = batch.param('s0'), batch.param('tau')
+
+        # get velocity dynamics
+        v_acc = v + (2.5 * acc * tau * (1 - (v / v_desired)) *
+                     np.sqrt(0.025 + (v / v_desired)))
+        v_safe = (tau * b) + np.sqrt(((tau**2) * (b**2)) - (
+                b * ((2 * (h-s0)) - (tau * v) - ((v_l**2) / b_l))))
+
+        # fmin skips a NaN v_safe, like the builtin min of get_accel
+        v_next = np.fmin(np.fmin(v_acc, v_safe), v_desired)
+
+        return (v_next-v)/env.sim_step
+
 
 class BandoFTLController(BaseController):
     """Bando follow-the-leader controller.
@@ -685,3 +790,17 @@ class BandoFTLController(BaseController):
         s_dot = v_l - v
         u = self.alpha * (v_h - v) + self.beta * s_dot/(s**2)
         return u
+
+    @classmethod
+    def get_accel_batch(cls, env, batch):
+        """See parent class."""
+        v, s = batch.speed, batch.headway
+        h_st = batch.param('h_st')
+        v_h = batch.param('v_max') * (
+            (np.tanh(s/h_st-2)+np.tanh(2))/(1+np.tanh(2)))
+        s_dot = batch.lead_speed - v
+        u = batch.param('alpha') * (v_h - v) + \
+            batch.param('beta') * s_dot/(s**2)
+        want_max_accel = batch.param('want_max_accel') > 0
+        return np.where(~batch.has_lead & want_max_accel,
+                        batch.param('max_accel'), u)
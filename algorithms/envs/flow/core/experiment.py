@@ -170,7 +170,7 @@ class Experiment:
 
             # Save emission data at the end of every rollout. This is skipped
             # by the internal method if no emission path was specified.
-            if self.env.simulator == "traci":
+            if self.env.simulator in ("traci", "numpy"):
                 self.env.k.simulation.save_emission(run_id=i)
 
         # Print the averages/std for all variables in the info_dict.
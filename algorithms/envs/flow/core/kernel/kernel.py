@@ -1,8 +1,10 @@
 """Script containing the Flow kernel object for interacting with simulators."""
 
 import warnings
-from algorithms.envs.flow.core.kernel.simulation import TraCISimulation, AimsunKernelSimulation
-from algorithms.envs.flow.core.kernel.network import TraCIKernelNetwork, AimsunKernelNetwork
+from algorithms.envs.flow.core.kernel.simulation import TraCISimulation, AimsunKernelSimulation, \
+    LoopSimulation
+from algorithms.envs.flow.core.kernel.network import TraCIKernelNetwork, AimsunKernelNetwork, \
+    LoopKernelNetwork
 from algorithms.envs.flow.core.kernel.vehicle import TraCIVehicle, AimsunKernelVehicle
 from algorithms.envs.flow.core.kernel.traffic_light import TraCITrafficLight, \
     AimsunKernelTrafficLight
@@ -51,7 +53,7 @@ class Kernel(object):
         Parameters
         ----------
         simulator : str
-            simulator type, must be one of {"traci"}
+            simulator type, must be one of {"traci", "aimsun", "numpy"}
         sim_params : flow.core.params.SimParams
             simulation-specific parameters
 
@@ -67,6 +69,13 @@ class Kernel(object):
             self.network = TraCIKernelNetwork(self, sim_params)
             self.vehicle = TraCIVehicle(self, sim_params)
             self.traffic_light = TraCITrafficLight(self)
+        elif simulator == 'numpy':
+            # closed single-lane loops simulated with numpy, behind the
+            # TraCI api (see flow/core/kernel/simulation/loop.py)
+            self.simulation = LoopSimulation(self)
+            self.network = LoopKernelNetwork(self, sim_params)
+            self.vehicle = TraCIVehicle(self, sim_params)
+            self.traffic_light = TraCITrafficLight(self)
         elif simulator == 'aimsun':
             self.simulation = AimsunKernelSimulation(self)
             self.network = AimsunKernelNetwork(self, sim_params)
@@ -3,5 +3,7 @@
 from algorithms.envs.flow.core.kernel.network.base import BaseKernelNetwork
 from algorithms.envs.flow.core.kernel.network.traci import TraCIKernelNetwork
 from algorithms.envs.flow.core.kernel.network.aimsun import AimsunKernelNetwork
+from algorithms.envs.flow.core.kernel.network.loop import LoopKernelNetwork
 
-__all__ = ["BaseKernelNetwork", "TraCIKernelNetwork", "AimsunKernelNetwork"]
+__all__ = ["BaseKernelNetwork", "TraCIKernelNetwork", "AimsunKernelNetwork",
+           "LoopKernelNetwork"]
@@ -0,0 +1,214 @@
+"""Script containing the network kernel of the NumPy loop simulator."""
+import numpy as np
+
+from algorithms.envs.flow.core.kernel.network.traci import TraCIKernelNetwork
+from algorithms.envs.flow.utils.exceptions import FatalFlowError
+
+
+class LoopKernelNetwork(TraCIKernelNetwork):
+    """Network kernel for the NumPy simulator of closed single-lane loops.
+
+    The edges and connections are built directly from the network class (no
+    netconvert call and no xml file), with the edge starts of the network as
+    the geometry of the loop: the loop visits the edges and the internal
+    (junction) edges in the order of their starts, each of them spanning up
+    to the start of the next one. This is the case of the ring and figure
+    eight networks.
+
+    Internal edges of the same junction that are both on the loop are foes
+    (e.g. the crossing of the figure eight). The edge leading to each of them
+    with the highest "priority" has the right of way.
+
+    Attributes
+    ----------
+    loop_edges : list of str
+        edges of the loop, in order
+    loop_starts : np.ndarray
+        position of the start of each edge of the loop
+    loop_lengths : np.ndarray
+        length of each edge of the loop
+    loop_speeds : np.ndarray
+        speed limit of each edge of the loop
+    loop_length : float
+        total length of the loop
+    crossings : list of (int, int, bool)
+        index (in loop_edges) of each pair of foe internal edges, and whether
+        the first one yields to the vehicles approaching the second one
+    loop_shape : (np.ndarray, np.ndarray, np.ndarray)
+        position along the loop, x and y of the vertices of the loop
+    """
+
+    def generate_net(self,
+                     net_params,
+                     traffic_lights,
+                     nodes,
+                     edges,
+                     types=None,
+                     connections=None):
+        """See parent class.
+
+        Nothing is written, the edges and connections are those of the loop.
+        """
+        if net_params.additional_params.get("lanes", 1) != 1:
+            raise FatalFlowError(
+                "The numpy simulator only supports single-lane networks.")
+        if net_params.inflows is not None and \
+                len(net_params.inflows.get()) > 0:
+            raise FatalFlowError(
+                "The numpy simulator does not support inflows.")
+
+        type_data = {typ["id"]: typ for typ in types or []}
+        edge_data = {edge["id"]: edge for edge in edges}
+
+        # the starts of the edges and of the internal edges, in loop order.
+        # Other internal edge starts (that are not edges of the network) are
+        # only used by get_x
+        starts = [(edge, pos) for edge, pos in self.network.edge_starts
+                  if edge in edge_data]
+        starts += [(edge, pos) for edge, pos in
+                   self.network.internal_edge_starts if edge[0] == ':']
+        starts.sort(key=lambda tup: tup[1])
+        if set(edge_data) - set(edge for edge, _ in starts):
+            raise FatalFlowError(
+                "The numpy simulator requires the edge starts of all edges.")
+
+        names = [edge for edge, _ in starts]
+        positions = np.array([pos for _, pos in starts], dtype=np.float64)
+        lengths = np.diff(positions)
+        last = names[-1]
+        if last[0] != ':':
+            last_length = float(edge_data[last]["length"])
+        else:
+            # the closing junction spans as much as the other ones
+            internal = [length for edge, length in zip(names, lengths)
+                        if edge[0] == ':']
+            last_length = np.mean(internal) if internal else 0.1
+        lengths = np.append(lengths, last_length)
+
+        # speed limit of each edge, the one of the next edge for junctions
+        speeds = []
+        for edge in names:
+            if edge[0] == ':':
+                speeds.append(None)
+                continue
+            data = edge_data[edge]
+            typ = type_data.get(data.get("type"), {})
+            speeds.append(float(data.get("speed", typ.get("speed", 30))))
+        for i in range(len(names) - 1, -1, -1):
+            if speeds[i] is None:
+                speeds[i] = speeds[(i + 1) % len(names)] or 30.
+
+        self.loop_edges = names
+        self.loop_starts = positions
+        self.loop_lengths = lengths
+        self.loop_speeds = np.array(speeds, dtype=np.float64)
+        self.loop_length = float(positions[-1] + lengths[-1] - positions[0])
+        self.crossings = self._loop_crossings(edge_data)
+        self.loop_shape = self._loop_shape(nodes, edge_data)
+
+        edges_dict = {
+            edge: {"length": float(length), "speed": float(speed), "lanes": 1}
+            for edge, length, speed in zip(names, lengths, self.loop_speeds)}
+        next_conn, prev_conn = {}, {}
+        for i, edge in enumerate(names):
+            next_edge = names[(i + 1) % len(names)]
+            next_conn[edge] = {0: [(next_edge, 0)]}
+            prev_conn[next_edge] = {0: [(edge, 0)]}
+
+        return edges_dict, {"next": next_conn, "prev": prev_conn}
+
+    def _loop_crossings(self, edge_data):
+        """Return the pairs of foe internal edges of the loop.
+
+        See the crossings attribute.
+        """
+        names = self.loop_edges
+        junctions = {}
+        for i, edge in enumerate(names):
+            if edge[0] == ':':
+                junctions.setdefault(edge[1:].rsplit('_', 1)[0], []).append(i)
+
+        def priority(i):
+            approach = names[i - 1]
+            if approach[0] == ':':
+                return 0
+            return int(edge_data[approach].get("priority", 0))
+
+        crossings = []
+        for indices in junctions.values():
+            for i in indices:
+                for j in indices:
+                    if i != j:
+                        crossings.append((i, j, priority(i) < priority(j)))
+        return crossings
+
+    def _loop_shape(self, nodes, edge_data):
+        """Return the vertices of the loop, see the loop_shape attribute.
+
+        The edges follow their shape (or the line between their nodes), and
+        are stretched to their length along the loop. Junctions link the end
+        of an edge to the start of the next one.
+        """
+        node_xy = {node["id"]: (float(node["x"]), float(node["y"]))
+                   for node in nodes}
+        points = []
+        for edge in self.loop_edges:
+            if edge[0] == ':':
+                points.append(None)
+                continue
+            data = edge_data[edge]
+            shape = data.get("shape")
+            if shape is None:
+                shape = [node_xy[data["from"]], node_xy[data["to"]]]
+            points.append(np.array(shape, dtype=np.float64).reshape(-1, 2))
+
+        s, xy = [], []
+        for i, start in enumerate(self.loop_starts):
+            length = self.loop_lengths[i]
+            shape = points[i]
+            if shape is None:
+                # a junction goes from the end of the previous edge to the
+                # start of the next one
+                before = points[i - 1] if points[i - 1] is not None \
+                    else np.zeros((1, 2))
+                after = points[(i + 1) % len(points)]
+                after = after if after is not None else before
+                shape = np.stack([before[-1], after[0]])
+            step = np.linalg.norm(np.diff(shape, axis=0), axis=1)
+            along = np.concatenate([[0.], np.cumsum(step)])
+            if along[-1] > 0:
+                along = along / along[-1]
+            else:
+                along = np.linspace(0, 1, len(along))
+            s.append(start + along * length)
+            xy.append(shape)
+        s = np.concatenate(s)
+        xy = np.concatenate(xy)
+        return s, xy[:, 0], xy[:, 1]
+
+    def generate_cfg(self, net_params, traffic_lights, routes):
+        """See parent class.
+
+        Nothing is written, the routes are only checked to follow the loop
+        and brought to the (route, fraction) format of the parent class.
+        """
+        loop = [edge for edge in self.loop_edges if edge[0] != ':']
+        for route_id in routes.keys():
+            if isinstance(routes[route_id][0], str):
+                routes[route_id] = [(routes[route_id], 1)]
+            for route, _ in routes[route_id]:
+                start = loop.index(route[0]) if route[0] in loop else -1
+                if start < 0 or list(route) != \
+                        (loop[start:] + loop[:start])[:len(route)]:
+                    raise FatalFlowError(
+                        'Route "{}" does not follow the loop, which the numpy '
+                        'simulator requires.'.format(route_id))
+
+        return self.sumfn
+
+    def close(self):
+        """See parent class.
+
+        There are no files to delete.
+        """
+        pass
@@ -9,6 +9,7 @@ import subprocess
 import xml.etree.ElementTree as ElementTree
 from lxml import etree
 from copy import deepcopy
+import numpy as np
 
 E = etree.Element
 
@@ -190,6 +191,22 @@ class TraCIKernelNetwork(BaseKernelNetwork):
 
         self.total_edgestarts_dict = dict(self.total_edgestarts)
 
+        # sorted edge starts, used by get_edge to bisect positions
+        self._edgestart_names = [edge for edge, _ in self.total_edgestarts]
+        self._edgestart_pos = np.array(
+            [start for _, start in self.total_edgestarts], dtype=np.float64)
+
+        # edges are interned as integer codes, with the start of each code
+        # and whether the relative position is added to it in get_x. The
+        # edges with a start and the internal edges (resolved once here) are
+        # interned up front.
+        self._edge_codes = {}
+        self._code_start = np.zeros(0, dtype=np.float64)
+        self._code_add_position = np.zeros(0, dtype=bool)
+        for edge in [""] + list(self.total_edgestarts_dict) + \
+                self._junction_list:
+            self.edge_code(edge)
+
         self.__length = sum(
             self._edges[edge_id]['length'] for edge_id in self._edges
         )
@@ -244,28 +261,86 @@ class TraCIKernelNetwork(BaseKernelNetwork):
                 continue
 
     def get_edge(self, x):
-        """See parent class."""
-        for (edge, start_pos) in reversed(self.total_edgestarts):
-            if x >= start_pos:
-                return edge, x - start_pos
+        """See parent class.
+
+        x may also be an array of positions, in which case the list of edges
+        and the array of relative positions are returned.
+        """
+        index = np.searchsorted(self._edgestart_pos, x, side='right') - 1
+        if isinstance(x, (list, np.ndarray)):
+            edges = [self._edgestart_names[i] if i >= 0 else None
+                     for i in index.tolist()]
+            return edges, np.asarray(x) - self._edgestart_pos[index]
+        if index < 0:
+            return None
+        return self._edgestart_names[index], x - self._edgestart_pos[index]
 
     def get_x(self, edge, position):
-        """See parent class."""
+        """See parent class.
+
+        edge and position may also be a list of edges and an array of
+        relative positions, in which case an array is returned.
+        """
+        if isinstance(edge, (list, np.ndarray)):
+            codes = np.fromiter((self.edge_code(e) for e in edge),
+                                dtype=np.int64, count=len(edge))
+            return self.get_x_by_code(codes, position)
+        code = self.edge_code(edge)
+        if self._code_add_position[code]:
+            return self._code_start[code].item() + position
+        return self._code_start[code].item()
+
+    def get_x_by_code(self, codes, positions):
+        """Return the absolute positions of edge codes and relative positions.
+
+        Parameters
+        ----------
+        codes : np.ndarray
+            edge codes, see edge_code
+        positions : array_like
+            relative positions on the edges
+
+        Returns
+        -------
+        np.ndarray
+            positions with respect to some global reference
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        return self._code_start[codes] + \
+            np.where(self._code_add_position[codes], positions, 0)
+
+    def edge_code(self, edge):
+        """Return the integer code of an edge, interning it if needed.
+
+        Raises a KeyError for (non-internal) edges without a start.
+        """
+        code = self._edge_codes.get(edge)
+        if code is not None:
+            return code
+
         # if there was a collision which caused the vehicle to disappear,
         # return an x value of -1001
         if len(edge) == 0:
-            return -1001
-
-        if edge[0] == ':':
-            try:
-                return self.internal_edgestarts_dict[edge] + position
-            except KeyError:
+            start, add_position = -1001, False
+        elif edge[0] == ':':
+            if edge in self.internal_edgestarts_dict:
+                start = self.internal_edgestarts_dict[edge]
+                add_position = True
+            else:
                 # in case several internal links are being generalized for
                 # by a single element (for backwards compatibility)
                 edge_name = edge.rsplit('_', 1)[0]
-                return self.total_edgestarts_dict.get(edge_name, -1001)
+                start = self.total_edgestarts_dict.get(edge_name, -1001)
+                add_position = False
         else:
-            return self.total_edgestarts_dict[edge] + position
+            start, add_position = self.total_edgestarts_dict[edge], True
+
+        code = len(self._edge_codes)
+        self._edge_codes[edge] = code
+        self._code_start = np.append(self._code_start, start)
+        self._code_add_position = np.append(self._code_add_position,
+                                            add_position)
+        return code
 
     def edge_length(self, edge_id):
         """See parent class."""
@@ -3,6 +3,8 @@
 from algorithms.envs.flow.core.kernel.simulation.base import KernelSimulation
 from algorithms.envs.flow.core.kernel.simulation.traci import TraCISimulation
 from algorithms.envs.flow.core.kernel.simulation.aimsun import AimsunKernelSimulation
+from algorithms.envs.flow.core.kernel.simulation.loop import LoopSimulation
 
 
-__all__ = ['KernelSimulation', 'TraCISimulation', 'AimsunKernelSimulation']
+__all__ = ['KernelSimulation', 'TraCISimulation', 'AimsunKernelSimulation',
+           'LoopSimulation']
@@ -0,0 +1,875 @@
+"""Script containing the NumPy simulator of closed single-lane loops.
+
+The simulator is meant as a SUMO-free backend of the ring and figure eight
+networks (see flow.core.kernel.network.loop). It is made of:
+
+* LoopWorlds: the state of the vehicles of many worlds (copies of the same
+  loop) as [n_worlds, n_vehicles] arrays, stepped at once.
+* LoopConnection: the subset of the TraCI API used by the TraCI vehicle,
+  simulation and traffic light kernels, over one of the worlds. It is passed
+  to the kernel in place of a TraCI connection.
+* LoopSimulation: the simulation kernel starting the above.
+* BatchedLoopEnv: the episodes of a loop env stepped together as the worlds
+  of a LoopWorlds, with the states, rewards and dones computed from its
+  arrays instead of through the flow kernels.
+
+The flow kernels drive a single world through the connection, so that an
+env built with the numpy simulator steps one world. BatchedLoopEnv steps
+n_env of them at once.
+
+The vehicles follow the SUMO IDM model, and the speeds commanded through
+slowDown/setSpeed are checked according to the speed mode of the vehicle
+(safe speed, maximum acceleration and deceleration and right of way at
+junctions), as in SUMO. Junction crossings are approximated: vehicles stop
+before a crossing if a foe vehicle is on it, or (for the road without
+priority) if a foe vehicle is about to reach it. The ring matches SUMO, the
+figure eight does not: SUMO's right of way at the crossing is not
+reproduced, so that the vehicles cross it at slightly different times.
+"""
+
+import numpy as np
+import traci.constants as tc
+
+from algorithms.envs.flow.core.kernel.simulation.traci import TraCISimulation
+from algorithms.envs.flow.core.util import ensure_dir
+
+# speed mode bits, see SUMO's speed mode documentation. There are no traffic
+# lights, so that the red light bit (16) is ignored
+REGARD_SAFE_SPEED = 1
+REGARD_MAX_ACCEL = 2
+REGARD_MAX_DECEL = 4
+REGARD_RIGHT_OF_WAY = 8
+DISREGARD_JUNCTION_FOES = 32
+# speed mode of the vehicles that are not commanded
+ALL_CHECKS = 31
+
+# distance (in m) ahead of a crossing within which vehicles check for foes
+JUNCTION_LOOKAHEAD = 50.
+# time (in s) before which a foe vehicle about to reach a crossing with the
+# right of way blocks it
+JUNCTION_TIME_GAP = 4.
+
+
+class LoopWorlds:
+    """Vehicles of many copies of a loop network, stepped at once.
+
+    Vehicles are given slots, shared by all the worlds (a vehicle is active
+    in some of them). The state of the vehicles is stored as [n_worlds,
+    capacity] arrays, and the position of a vehicle is the position of its
+    front along the loop (as given by get_x).
+
+    Attributes
+    ----------
+    time : float
+        simulation time, in seconds
+    slots : dict < str, int >
+        slot of each vehicle
+    active : np.ndarray
+        whether each slot is used in each world
+    pos : np.ndarray
+        position of the front of the vehicles along the loop
+    speed : np.ndarray
+        speed of the vehicles
+    command : np.ndarray
+        speed commanded to the vehicles for the next step, NaN if none
+    """
+
+    # parameters of each vehicle, from its type
+    PARAMS = {
+        'length': 5.,
+        'min_gap': 2.5,
+        'accel': 2.6,
+        'decel': 4.5,
+        'tau': 1.,
+        'max_speed': 30.,
+        'speed_factor': 1.,
+    }
+
+    # dynamic state of each vehicle
+    STATE = {
+        'pos': 0.,
+        'speed': 0.,
+        'distance': 0.,
+        'model_speed': 0.,
+        'command': np.nan,
+    }
+
+    def __init__(self, network, n_worlds=1, sim_step=0.1, ballistic=False,
+                 seed=None, capacity=32):
+        """Instantiate empty worlds.
+
+        Parameters
+        ----------
+        network : flow.core.kernel.network.LoopKernelNetwork
+            network kernel of the loop
+        n_worlds : int
+            number of copies of the loop
+        sim_step : float
+            seconds per simulation step
+        ballistic : bool
+            whether to use the ballistic position update instead of the Euler
+            one
+        seed : int or None
+            seed of the speed factors of the vehicles
+        capacity : int
+            initial number of vehicle slots
+        """
+        self.n_worlds = n_worlds
+        self.sim_step = sim_step
+        self.ballistic = ballistic
+        self.rng = np.random.RandomState(seed)
+        self.time = 0.
+
+        self.starts = network.loop_starts
+        self.lengths = network.loop_lengths
+        self.speed_limits = network.loop_speeds
+        self.loop_length = network.loop_length
+        self.crossings = network.crossings
+        self.geometry = network.loop_shape
+        # SUMO angle of each segment of the geometry, zero-length segments
+        # (at the junctions) keep the angle of the previous one
+        s, x, y = self.geometry
+        dx, dy = np.diff(x), np.diff(y)
+        angle = np.degrees(np.arctan2(dx, dy)) % 360
+        moving = np.hypot(dx, dy) > 0
+        last = np.maximum.accumulate(
+            np.where(moving, np.arange(len(dx)), -1))
+        self._angles = angle[np.where(last >= 0, last, np.argmax(moving))]
+
+        self.capacity = capacity
+        self.slots = {}
+        self.ids = []
+        shape = (n_worlds, capacity)
+        self.active = np.zeros(shape, dtype=bool)
+        self.speed_mode = np.full(shape, ALL_CHECKS, dtype=np.int64)
+        self.hold = np.zeros(shape, dtype=bool)
+        for name, value in list(self.PARAMS.items()) + \
+                list(self.STATE.items()):
+            setattr(self, name, np.full(shape, value, dtype=np.float64))
+
+    def _columns(self):
+        return ['active', 'speed_mode', 'hold'] + list(self.PARAMS) + \
+            list(self.STATE)
+
+    def slot(self, veh_id):
+        """Return the slot of a vehicle, giving it one if needed."""
+        slot = self.slots.get(veh_id)
+        if slot is None:
+            slot = len(self.ids)
+            if slot == self.capacity:
+                self._grow()
+            self.slots[veh_id] = slot
+            self.ids.append(veh_id)
+        return slot
+
+    def _grow(self):
+        """Double the number of slots."""
+        for name in self._columns():
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate([column, column], axis=1))
+        self.active[:, self.capacity:] = False
+        self.capacity *= 2
+
+    def add(self, world, veh_id, type_params, pos, speed):
+        """Add a vehicle to a world.
+
+        Parameters
+        ----------
+        world : int
+            index of the world
+        veh_id : str
+            name of the vehicle
+        type_params : dict
+            SUMO parameters of the type of the vehicle, see VehicleParams
+        pos : float
+            position of the front of the vehicle along the loop
+        speed : float
+            initial speed
+        """
+        slot = self.slot(veh_id)
+        speed_dev = float(type_params.get('speedDev', 0))
+        speed_factor = float(type_params.get('speedFactor', 1.))
+        if speed_dev > 0:
+            speed_factor = np.clip(
+                self.rng.normal(speed_factor, speed_dev), 0.2, 2.)
+        params = {
+            'length': type_params.get('length', self.PARAMS['length']),
+            'min_gap': type_params.get('minGap', self.PARAMS['min_gap']),
+            'accel': type_params.get('accel', self.PARAMS['accel']),
+            'decel': type_params.get('decel', self.PARAMS['decel']),
+            'tau': type_params.get('tau', self.PARAMS['tau']),
+            'max_speed': type_params.get('maxSpeed',
+                                         self.PARAMS['max_speed']),
+            'speed_factor': speed_factor,
+        }
+        for name, value in params.items():
+            getattr(self, name)[world, slot] = float(value)
+        for name, value in self.STATE.items():
+            getattr(self, name)[world, slot] = value
+        self.pos[world, slot] = self._wrap(pos)
+        self.speed[world, slot] = speed
+        self.model_speed[world, slot] = speed
+        self.speed_mode[world, slot] = ALL_CHECKS
+        self.hold[world, slot] = False
+        self.active[world, slot] = True
+
+    def remove(self, world, veh_id):
+        """Remove a vehicle from a world."""
+        slot = self.slots.get(veh_id)
+        if slot is not None:
+            self.active[world, slot] = False
+
+    def _wrap(self, pos):
+        """Bring positions back to the loop."""
+        return (pos - self.starts[0]) % self.loop_length + self.starts[0]
+
+    def edge_index(self, pos):
+        """Return the index of the edge (in the loop) of positions."""
+        return np.searchsorted(self.starts, pos, side='right') - 1
+
+    def desired_speed(self):
+        """Return the maximum speed of the vehicles on their edge."""
+        limit = self.speed_limits[self.edge_index(self.pos)]
+        return np.minimum(self.max_speed, limit * self.speed_factor)
+
+    def leaders(self):
+        """Return the leader of each vehicle, its gap and speed.
+
+        The gap is the bumper-to-bumper distance. Inactive vehicles and
+        vehicles alone in their world have no leader (-1) and an infinite
+        gap.
+        """
+        n_worlds, capacity = self.active.shape
+        key = np.where(self.active, self.pos - self.starts[0], np.inf)
+        order = np.argsort(key, axis=1, kind='stable')
+        count = self.active.sum(axis=1)[:, None]
+        rank = np.arange(capacity)[None, :]
+        next_rank = np.where(rank + 1 < count, rank + 1, 0)
+        worlds = np.arange(n_worlds)[:, None]
+
+        leader = np.full((n_worlds, capacity), -1, dtype=np.int64)
+        leader[worlds, order] = np.where(
+            (rank < count) & (count >= 2), order[worlds, next_rank], -1)
+
+        has_leader = leader >= 0
+        lead = np.where(has_leader, leader, 0)
+        gap = (self.pos[worlds, lead] - self.pos) % self.loop_length - \
+            self.length[worlds, lead]
+        gap = np.where(has_leader, gap, np.inf)
+        lead_speed = np.where(has_leader, self.speed[worlds, lead], 0.)
+        return leader, gap, lead_speed
+
+    def _occupied(self, index):
+        """Return whether a vehicle is (partly) on an edge of the loop."""
+        front = (self.pos - self.starts[index]) % self.loop_length
+        on_edge = front < self.lengths[index] + self.length
+        return on_edge & self.active
+
+    def _distance_to(self, index):
+        """Return the distance from the vehicles to the start of an edge."""
+        return (self.starts[index] - self.pos) % self.loop_length
+
+    def stop_gaps(self):
+        """Return the distance to the crossing each vehicle must stop at.
+
+        A vehicle approaching a crossing stops before it if a foe vehicle is
+        on the foe edge (first returned array) or, if the vehicle has no
+        priority, about to reach it (second returned array). Vehicles that
+        can no longer stop before the crossing go on. The distances are
+        infinite if the vehicle does not need to stop.
+        """
+        occupied_gap = np.full(self.pos.shape, np.inf)
+        approach_gap = np.full(self.pos.shape, np.inf)
+        brake_distance = self.speed ** 2 / (2 * self.decel)
+        for index, foe, yields in self.crossings:
+            distance = self._distance_to(index)
+            stops = self.active & (distance < JUNCTION_LOOKAHEAD) \
+                & (distance >= brake_distance)
+            occupied = self._occupied(foe).any(axis=1)[:, None]
+            occupied_gap = np.where(stops & occupied,
+                                    np.minimum(occupied_gap, distance),
+                                    occupied_gap)
+            if yields:
+                foe_distance = self._distance_to(foe)
+                foe_time = foe_distance / np.maximum(self.speed, 1e-3)
+                approaching = (
+                    self.active & (foe_distance < JUNCTION_LOOKAHEAD)
+                    & (foe_time < JUNCTION_TIME_GAP)).any(axis=1)[:, None]
+                approach_gap = np.where(stops & approaching,
+                                        np.minimum(approach_gap, distance),
+                                        approach_gap)
+        return occupied_gap, approach_gap
+
+    def _idm_speed(self, gap, lead_speed, desired_speed):
+        """Return the speed after a step of the IDM model.
+
+        The gap may be infinite (free road).
+        """
+        v = self.speed
+        s_star = self.min_gap + np.maximum(
+            0, v * self.tau + v * (v - lead_speed) /
+            (2 * np.sqrt(self.accel * self.decel)))
+        interaction = np.where(
+            np.isinf(gap), 0, (s_star / np.maximum(gap, 1e-3)) ** 2)
+        accel = self.accel * (
+            1 - (v / np.maximum(desired_speed, 1e-3)) ** 4 - interaction)
+        return v + accel * self.sim_step
+
+    def _safe_speed(self, gap, lead_speed, desired_speed):
+        """Return the IDM speed behind a leader, infinite without one."""
+        return np.where(np.isinf(gap), np.inf,
+                        self._idm_speed(gap, lead_speed, desired_speed))
+
+    def apply_acceleration(self, acc):
+        """Command the speeds reached with the accelerations acc.
+
+        acc is a [n_worlds, capacity] array, NaN for the vehicles that are
+        not commanded.
+        """
+        self.command = np.where(
+            np.isnan(acc), self.command,
+            np.maximum(self.speed + acc * self.sim_step, 0))
+
+    def step(self):
+        """Advance all the worlds by a simulation step.
+
+        Returns
+        -------
+        np.ndarray
+            whether each vehicle collided during the step
+        """
+        dt = self.sim_step
+        speed = self.speed
+        desired_speed = self.desired_speed()
+        _, gap, lead_speed = self.leaders()
+        occupied_gap, approach_gap = self.stop_gaps()
+
+        # safe speeds behind the leader and before a blocked crossing
+        follow_speed = self._safe_speed(gap, lead_speed, desired_speed)
+        occupied_speed = self._safe_speed(occupied_gap, 0., desired_speed)
+        approach_speed = self._safe_speed(approach_gap, 0., desired_speed)
+        free_speed = self._idm_speed(np.inf, 0., desired_speed)
+        model_speed = np.maximum(np.minimum.reduce(
+            [follow_speed, occupied_speed, approach_speed, free_speed]), 0)
+
+        # the commanded speeds are checked according to the speed mode. The
+        # maximum speed of the vehicle is always regarded, the speed limit
+        # only by the model
+        commanded = ~np.isnan(self.command)
+        mode = np.where(commanded, self.speed_mode, ALL_CHECKS)
+        target = np.where(commanded,
+                          np.minimum(self.command, self.max_speed),
+                          model_speed)
+        target = np.where(mode & REGARD_MAX_ACCEL,
+                          np.minimum(target, speed + self.accel * dt), target)
+        target = np.where(mode & REGARD_MAX_DECEL,
+                          np.maximum(target, speed - self.decel * dt), target)
+        target = np.where(mode & REGARD_SAFE_SPEED,
+                          np.minimum(target, follow_speed), target)
+        target = np.where(mode & REGARD_RIGHT_OF_WAY,
+                          np.minimum(target, approach_speed), target)
+        target = np.where(mode & DISREGARD_JUNCTION_FOES, target,
+                          np.minimum(target, occupied_speed))
+        next_speed = np.where(self.active, np.maximum(target, 0), 0.)
+
+        if self.ballistic:
+            travelled = (speed + next_speed) / 2 * dt
+        else:
+            travelled = next_speed * dt
+        travelled = np.where(self.active, travelled, 0.)
+        self.pos = self._wrap(self.pos + travelled)
+        self.distance += travelled
+        self.speed = next_speed
+        self.model_speed = model_speed
+        # slowDown commands only last a step, setSpeed ones are held
+        self.command = np.where(self.hold, self.command, np.nan)
+        self.time += dt
+
+        # collisions along the loop, and at the crossings
+        _, gap, _ = self.leaders()
+        collided = self.active & (gap < 0)
+        for index, foe, _ in self.crossings:
+            on_edge = self._occupied(index)
+            on_foe = self._occupied(foe)
+            collided |= on_edge & on_foe.any(axis=1)[:, None]
+        return collided
+
+    def xy(self):
+        """Return the 2D position and the SUMO angle of the vehicles.
+
+        The angle is in degrees, clockwise from the north.
+        """
+        s, x, y = self.geometry
+        pos = self.pos
+        i = np.clip(np.searchsorted(s, pos, side='right') - 1, 0, len(s) - 2)
+        return np.interp(pos, s, x), np.interp(pos, s, y), self._angles[i]
+
+
+class _LoopVehicleAPI:
+    """The TraCI vehicle domain over a world of LoopWorlds."""
+
+    def __init__(self, connection):
+        self._conn = connection
+        self._worlds = connection.worlds
+        self._world = connection.world
+        # vehicles waiting to be inserted at the next step
+        self._pending = {}
+        self._types = {}
+        self._routes = {}
+        self._colors = {}
+        self._lc_modes = {}
+        self._subscribed = set()
+        self._lead_subscribed = set()
+
+    def _slot(self, veh_id):
+        return self._worlds.slots[veh_id]
+
+    def getIDList(self):
+        worlds, world = self._worlds, self._world
+        return [veh_id for veh_id, slot in worlds.slots.items()
+                if worlds.active[world, slot]]
+
+    def addFull(self, vehID, routeID, typeID="DEFAULT_VEHTYPE", depart=None,
+                departLane="first", departPos="base", departSpeed="0",
+                **kwargs):
+        self._pending[vehID] = (routeID, typeID, departPos, departSpeed)
+        self._conn.loaded += 1
+
+    def _insert(self):
+        """Insert the pending vehicles, return their names."""
+        departed = []
+        for veh_id, (route_id, type_id, pos, speed) in self._pending.items():
+            edges = self._conn.route_edges[route_id]
+            index = self._conn.edge_index[edges[0]]
+            self._worlds.add(self._world, veh_id,
+                             self._conn.type_params[type_id],
+                             self._worlds.starts[index] + _to_float(pos),
+                             _to_float(speed))
+            self._types[veh_id] = type_id
+            self._routes[veh_id] = tuple(edges)
+            departed.append(veh_id)
+        self._pending = {}
+        return departed
+
+    def remove(self, vehID, reason=None):
+        if self._pending.pop(vehID, None) is None:
+            self._worlds.remove(self._world, vehID)
+        self.unsubscribe(vehID)
+
+    def subscribe(self, vehID, varIDs=None, *args, **kwargs):
+        self._subscribed.add(vehID)
+        self._conn.invalidate()
+
+    def subscribeLeader(self, vehID, dist=0, *args, **kwargs):
+        self._lead_subscribed.add(vehID)
+        self._conn.invalidate()
+
+    def unsubscribe(self, vehID):
+        self._subscribed.discard(vehID)
+        self._lead_subscribed.discard(vehID)
+        self._conn.invalidate()
+
+    def getSubscriptionResults(self, vehID):
+        return self._conn.vehicle_results().get(vehID)
+
+    def getAllSubscriptionResults(self):
+        return self._conn.vehicle_results()
+
+    def getTypeID(self, vehID):
+        return self._types[vehID]
+
+    def getLength(self, vehID):
+        return self._worlds.length[self._world, self._slot(vehID)].item()
+
+    def getMaxSpeed(self, vehID):
+        return self._worlds.max_speed[self._world, self._slot(vehID)].item()
+
+    def setMaxSpeed(self, vehID, speed):
+        self._worlds.max_speed[self._world, self._slot(vehID)] = speed
+
+    def getSpeed(self, vehID):
+        return self._worlds.speed[self._world, self._slot(vehID)].item()
+
+    def getRoadID(self, vehID):
+        return self._conn.road(self._slot(vehID))[0]
+
+    def getLanePosition(self, vehID):
+        return self._conn.road(self._slot(vehID))[1]
+
+    def getLaneIndex(self, vehID):
+        return 0
+
+    def getFuelConsumption(self, vehID):
+        return 0.
+
+    def setSpeedMode(self, vehID, speedMode):
+        self._worlds.speed_mode[self._world, self._slot(vehID)] = speedMode
+
+    def setLaneChangeMode(self, vehID, lcm):
+        self._lc_modes[vehID] = lcm
+
+    def getLaneChangeMode(self, vehID):
+        return self._lc_modes.get(vehID, 0)
+
+    def slowDown(self, vehID, speed, duration):
+        slot = self._slot(vehID)
+        self._worlds.command[self._world, slot] = speed
+        self._worlds.hold[self._world, slot] = False
+
+    def setSpeed(self, vehID, speed):
+        slot = self._slot(vehID)
+        # a negative speed gives the control back to the model
+        self._worlds.command[self._world, slot] = \
+            speed if speed >= 0 else np.nan
+        self._worlds.hold[self._world, slot] = speed >= 0
+
+    def changeLane(self, vehID, laneIndex, duration):
+        # there is a single lane
+        pass
+
+    def setRoute(self, vehID, edgeList):
+        self._routes[vehID] = tuple(edgeList)
+
+    def getColor(self, vehID):
+        return self._colors.get(vehID, (255, 255, 0, 255))
+
+    def setColor(self, vehID, color):
+        self._colors[vehID] = tuple(color)
+
+
+class _LoopSimulationAPI:
+    """The TraCI simulation domain over a world of LoopWorlds."""
+
+    def __init__(self, connection):
+        self._conn = connection
+
+    def subscribe(self, varIDs=None, *args, **kwargs):
+        pass
+
+    def getSubscriptionResults(self):
+        conn = self._conn
+        return {
+            tc.VAR_DEPARTED_VEHICLES_IDS: conn.departed,
+            tc.VAR_ARRIVED_VEHICLES_IDS: [],
+            tc.VAR_TELEPORT_STARTING_VEHICLES_IDS: conn.teleported,
+            tc.VAR_TIME_STEP: int(round(conn.worlds.time * 1000)),
+            tc.VAR_DELTA_T: int(round(conn.worlds.sim_step * 1000)),
+            tc.VAR_LOADED_VEHICLES_NUMBER: conn.step_loaded,
+            tc.VAR_DEPARTED_VEHICLES_NUMBER: len(conn.departed),
+            tc.VAR_ARRIVED_VEHICLES_NUMBER: 0,
+        }
+
+    def getStartingTeleportNumber(self):
+        return len(self._conn.teleported)
+
+
+class _LoopTrafficLightAPI:
+    """The TraCI traffic light domain, there are no traffic lights."""
+
+    def getIDList(self):
+        return []
+
+
+class _LoopLaneAPI:
+    """The TraCI lane domain over the loop (for the pyglet renderer)."""
+
+    def __init__(self, connection):
+        self._conn = connection
+
+    def getIDList(self):
+        return ['{}_0'.format(edge) for edge in self._conn.edges]
+
+    def getShape(self, laneID):
+        worlds = self._conn.worlds
+        index = self._conn.edge_index[laneID.rsplit('_', 1)[0]]
+        s, x, y = worlds.geometry
+        start = worlds.starts[index]
+        keep = (s >= start) & (s <= start + worlds.lengths[index])
+        return list(zip(x[keep].tolist(), y[keep].tolist()))
+
+
+class LoopConnection:
+    """TraCI-like connection to a world of LoopWorlds.
+
+    Stepping the connection steps all the worlds.
+    """
+
+    def __init__(self, worlds, network, world=0):
+        """Instantiate the connection.
+
+        Parameters
+        ----------
+        worlds : LoopWorlds
+            the simulated worlds
+        network : flow.core.kernel.network.LoopKernelNetwork
+            network kernel of the loop
+        world : int
+            index of the world the connection is about
+        """
+        self.worlds = worlds
+        self.world = world
+        self.edges = network.loop_edges
+        self.edge_index = {edge: i for i, edge in enumerate(self.edges)}
+        self.route_edges = {
+            'route{}_{}'.format(edge, i): route
+            for edge, routes in network.rts.items()
+            for i, (route, _) in enumerate(routes)}
+        self.type_params = {
+            typ['veh_id']: typ['type_params']
+            for typ in network.network.vehicles.types}
+
+        self.loaded = 0
+        self.step_loaded = 0
+        self.departed = []
+        self.teleported = []
+        self._results = None
+
+        self.vehicle = _LoopVehicleAPI(self)
+        self.simulation = _LoopSimulationAPI(self)
+        self.trafficlight = _LoopTrafficLightAPI()
+        self.lane = _LoopLaneAPI(self)
+
+    def simulationStep(self, step=0.):
+        """Advance the simulation by a step, see traci.simulationStep."""
+        collided = self.worlds.step()
+        ids = self.worlds.ids
+        self.teleported = [ids[slot] for slot in
+                           np.flatnonzero(collided[self.world]).tolist()]
+        self.departed = self.vehicle._insert()
+        self.step_loaded, self.loaded = self.loaded, 0
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop the subscription results computed at this step."""
+        self._results = None
+
+    def road(self, slot):
+        """Return the edge and the relative position of the vehicle in slot."""
+        pos = self.worlds.pos[self.world, slot]
+        index = self.worlds.edge_index(pos)
+        return self.edges[index], (pos - self.worlds.starts[index]).item()
+
+    def vehicle_results(self):
+        """Return the subscription results of the subscribed vehicles.
+
+        The results are computed once per step.
+        """
+        if self._results is not None:
+            return self._results
+        worlds, world, vehicle = self.worlds, self.world, self.vehicle
+        leader, gap, _ = worlds.leaders()
+        px, py, angle = worlds.xy()
+        pos = worlds.pos[world]
+        index = worlds.edge_index(pos)
+        relative = pos - worlds.starts[index]
+        ids = worlds.ids
+        results = {}
+        for veh_id in vehicle._subscribed:
+            slot = worlds.slots.get(veh_id)
+            if slot is None or not worlds.active[world, slot]:
+                continue
+            obs = {
+                tc.VAR_LANE_INDEX: 0,
+                tc.VAR_LANEPOSITION: relative[slot].item(),
+                tc.VAR_ROAD_ID: self.edges[index[slot]],
+                tc.VAR_SPEED: worlds.speed[world, slot].item(),
+                tc.VAR_EDGES: vehicle._routes.get(veh_id, ()),
+                tc.VAR_POSITION: (px[world, slot].item(),
+                                  py[world, slot].item()),
+                tc.VAR_ANGLE: angle[world, slot].item(),
+                tc.VAR_SPEED_WITHOUT_TRACI:
+                    worlds.model_speed[world, slot].item(),
+                tc.VAR_FUELCONSUMPTION: 0.,
+                tc.VAR_DISTANCE: worlds.distance[world, slot].item(),
+            }
+            if veh_id in vehicle._lead_subscribed:
+                lead = leader[world, slot]
+                # as SUMO, the gap to the leader excludes the minimum gap
+                obs[tc.VAR_LEADER] = None if lead < 0 else (
+                    ids[lead], (gap[world, slot]
+                                - worlds.min_gap[world, slot]).item())
+            results[veh_id] = obs
+        self._results = results
+        return results
+
+    def close(self):
+        """Close the connection, there is nothing to release."""
+        pass
+
+
+def _to_float(value):
+    """Return a SUMO depart value as a float, 0 if it is not a number."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.
+
+
+class LoopSimulation(TraCISimulation):
+    """NumPy simulation kernel of closed single-lane loops.
+
+    Extends flow.core.kernel.simulation.TraCISimulation, whose kernel api is
+    replaced by a LoopConnection. There is no sumo process.
+    """
+
+    def start_simulation(self, network, sim_params):
+        """Start a NumPy simulation of the loop of the network kernel.
+
+        Returns the connection to it, see LoopConnection. The LoopWorlds has a
+        single world, the one the flow kernels (and so the env) drive, see
+        BatchedLoopEnv for many of them.
+        """
+        self.sim_step = sim_params.sim_step
+
+        self.emission_path = sim_params.emission_path
+        if self.emission_path is not None:
+            ensure_dir(self.emission_path)
+
+        if sim_params.render is True:
+            raise ValueError("sumo-gui is not available with the numpy "
+                             "simulator.")
+
+        self.sumo_proc = None
+        worlds = LoopWorlds(network,
+                            sim_step=sim_params.sim_step,
+                            ballistic=sim_params.use_ballistic,
+                            seed=sim_params.seed)
+        connection = LoopConnection(worlds, network)
+        # as with sumo, the simulation starts with a step
+        connection.simulationStep()
+        return connection
+
+
+class BatchedLoopEnv:
+    """Episodes of a loop env stepped together as the worlds of a LoopWorlds.
+
+    The env (a flow env with the numpy simulator, whose vehicles are all
+    controlled by the RL agent, e.g. the ring and figure eight wrappers) only
+    draws the initial state of the episodes, one reset each, so that world i
+    starts as an episode of the env. The steps then skip the flow kernels:
+    the accelerations are applied to, and the states read from, the [n_env,
+    capacity] arrays of the worlds. For n_env=1, the episodes are the same as
+    the ones of the env.
+
+    All the episodes share the time step and are reset together. The worlds
+    are copies of one network: if the env draws a new network at each reset
+    (the ring length of WaveAttenuationEnv), the first reset of a batch draws
+    it and the others reuse it. The sub-steps (sims_per_step) of an episode
+    go on after a collision, and rendering and emission files are not
+    supported.
+
+    States are [n_env, n_agent, 2] (the speed and position of the vehicles,
+    normalized as in the wrappers), dones [n_env].
+    """
+
+    names = ['n_agent', 'n_s_ls', 'n_a_ls', 'coop_gamma', 'neighbor_mask',
+             'distance_mask', 'action_space', 'observation_space']
+
+    def __init__(self, env, n_env):
+        """Instantiate the batch.
+
+        Parameters
+        ----------
+        env : flow.envs.Env
+            env built with the numpy simulator
+        n_env : int
+            number of episodes stepped together
+        """
+        if not isinstance(env.k.simulation, LoopSimulation):
+            raise ValueError("BatchedLoopEnv requires an env with the numpy "
+                             "simulator.")
+        self.env = env
+        self.n_env = n_env
+        for name in self.names:
+            setattr(self, name, getattr(env, name))
+        self.worlds = None
+
+    def _action_ids(self):
+        """Return the vehicles the actions are applied to, in order."""
+        return self.env.k.vehicle.get_rl_ids()
+
+    def reset(self):
+        """Draw the initial state of each episode with a reset of the env.
+
+        Returns the states [n_env, n_agent, 2].
+        """
+        env = self.env
+        params = env.env_params.additional_params
+        ring_length = params.get('ring_length')
+        snapshots = []
+        try:
+            for _ in range(self.n_env):
+                env.reset()
+                if ring_length is not None:
+                    length = env.network.net_params.additional_params['length']
+                    params['ring_length'] = [length, length]
+                worlds = env.k.kernel_api.worlds
+                snapshots.append({name: getattr(worlds, name)[0].copy()
+                                  for name in worlds._columns()})
+        finally:
+            if ring_length is not None:
+                params['ring_length'] = ring_length
+
+        batched = LoopWorlds(env.k.network, n_worlds=self.n_env,
+                             sim_step=worlds.sim_step,
+                             ballistic=worlds.ballistic)
+        batched.capacity = worlds.capacity
+        batched.slots = dict(worlds.slots)
+        batched.ids = list(worlds.ids)
+        batched.time = worlds.time
+        for name in worlds._columns():
+            setattr(batched, name, np.stack(
+                [snapshot[name] for snapshot in snapshots]))
+        self.worlds = batched
+        self.slots = np.array([batched.slots[veh_id]
+                               for veh_id in env.sorted_ids])
+        self.action_slots = np.array([batched.slots[veh_id]
+                                      for veh_id in self._action_ids()])
+        self.max_speed = env.k.network.max_speed()
+        self.length = env.k.network.length()
+        self.time_counter = env.time_counter
+        return self.get_state_()
+
+    def speed(self):
+        """Return the speeds of the vehicles [n_env, n_agent]."""
+        return self.worlds.speed[:, self.slots]
+
+    def get_state_(self):
+        """Return the states [n_env, n_agent, 2]."""
+        speed = self.speed() / self.max_speed
+        pos = self.worlds.pos[:, self.slots] / self.length
+        return np.stack([speed, pos], axis=-1)
+
+    def step(self, rl_actions):
+        """Advance all the episodes by a step.
+
+        Parameters
+        ----------
+        rl_actions : array_like
+            accelerations [n_env, n_agent] (or [n_env, n_agent, 1]), clipped
+            to the action space
+
+        Returns
+        -------
+        np.ndarray
+            states [n_env, n_agent, 2]
+        np.ndarray
+            whether each episode has ended (collision or horizon) [n_env]
+        """
+        worlds = self.worlds
+        env_params = self.env.env_params
+        acc = np.clip(
+            np.asarray(rl_actions, dtype=np.float64).reshape(
+                self.n_env, len(self.action_slots)),
+            self.action_space.low, self.action_space.high)
+        crash = np.zeros(self.n_env, dtype=bool)
+        for _ in range(env_params.sims_per_step):
+            self.time_counter += 1
+            command = np.full(worlds.pos.shape, np.nan)
+            command[:, self.action_slots] = acc
+            worlds.apply_acceleration(command)
+            worlds.hold[:, self.action_slots] = False
+            crash |= worlds.step().any(axis=1)
+        done = crash | (self.time_counter >= env_params.sims_per_step * (
+            env_params.warmup_steps + env_params.horizon))
+        return self.get_state_(), done
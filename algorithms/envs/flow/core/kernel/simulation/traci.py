@@ -175,6 +175,9 @@ class TraCISimulation(KernelSimulation):
         if self.emission_path is not None:
             ensure_dir(self.emission_path)
 
+        if getattr(sim_params, "use_libsumo", False):
+            return self._start_libsumo(network, sim_params)
+
         error = None
         for _ in range(RETRIES_ON_ERROR):
             try:
@@ -190,41 +193,7 @@ class TraCISimulation(KernelSimulation):
                     "--remote-port", str(sim_params.port),
                     "--num-clients", str(sim_params.num_clients),
                     "--step-length", str(sim_params.sim_step)
-                ]
-
-                # use a ballistic integration step (if request)
-                if sim_params.use_ballistic:
-                    sumo_call.append("--step-method.ballistic")
-
-                # ignore step logs (if requested)
-                if sim_params.no_step_log:
-                    sumo_call.append("--no-step-log")
-
-                # add the lateral resolution of the sublanes (if requested)
-                if sim_params.lateral_resolution is not None:
-                    sumo_call.append("--lateral-resolution")
-                    sumo_call.append(str(sim_params.lateral_resolution))
-
-                if sim_params.overtake_right:
-                    sumo_call.append("--lanechange.overtake-right")
-                    sumo_call.append("true")
-
-                # specify a simulation seed (if requested)
-                if sim_params.seed is not None:
-                    sumo_call.append("--seed")
-                    sumo_call.append(str(sim_params.seed))
-
-                if not sim_params.print_warnings:
-                    sumo_call.append("--no-warnings")
-                    sumo_call.append("true")
-
-                # set the time it takes for a gridlock teleport to occur
-                sumo_call.append("--time-to-teleport")
-                sumo_call.append(str(int(sim_params.teleport_time)))
-
-                # check collisions at intersections
-                sumo_call.append("--collision.check-junctions")
-                sumo_call.append("true")
+                ] + self._sumo_options(sim_params)
 
                 logging.info(" Starting SUMO on port " + str(port))
                 logging.debug(" Cfg file: " + str(network.cfg))
@@ -258,8 +227,75 @@ class TraCISimulation(KernelSimulation):
                 self.teardown_sumo()
         raise error
 
+    def _sumo_options(self, sim_params):
+        """Return the sumo command line options given by sim_params."""
+        sumo_call = []
+
+        # use a ballistic integration step (if request)
+        if sim_params.use_ballistic:
+            sumo_call.append("--step-method.ballistic")
+
+        # ignore step logs (if requested)
+        if sim_params.no_step_log:
+            sumo_call.append("--no-step-log")
+
+        # add the lateral resolution of the sublanes (if requested)
+        if sim_params.lateral_resolution is not None:
+            sumo_call.append("--lateral-resolution")
+            sumo_call.append(str(sim_params.lateral_resolution))
+
+        if sim_params.overtake_right:
+            sumo_call.append("--lanechange.overtake-right")
+            sumo_call.append("true")
+
+        # specify a simulation seed (if requested)
+        if sim_params.seed is not None:
+            sumo_call.append("--seed")
+            sumo_call.append(str(sim_params.seed))
+
+        if not sim_params.print_warnings:
+            sumo_call.append("--no-warnings")
+            sumo_call.append("true")
+
+        # set the time it takes for a gridlock teleport to occur
+        sumo_call.append("--time-to-teleport")
+        sumo_call.append(str(int(sim_params.teleport_time)))
+
+        # check collisions at intersections
+        sumo_call.append("--collision.check-junctions")
+        sumo_call.append("true")
+
+        return sumo_call
+
+    def _start_libsumo(self, network, sim_params):
+        """Start sumo in-process with libsumo.
+
+        The libsumo module has the same interface as a TraCI connection, and
+        is returned as the kernel api. There is no sumo subprocess.
+        """
+        if sim_params.render is True:
+            raise ValueError("sumo-gui is not available with libsumo, set "
+                             "use_libsumo=False to render with sumo-gui.")
+        import libsumo
+
+        sumo_call = [
+            "sumo", "-c", network.cfg,
+            "--step-length", str(sim_params.sim_step)
+        ] + self._sumo_options(sim_params)
+
+        logging.info(" Starting SUMO with libsumo")
+        logging.debug(" Cfg file: " + str(network.cfg))
+
+        self.sumo_proc = None
+        libsumo.start(sumo_call)
+        libsumo.simulationStep()
+        return libsumo
+
     def teardown_sumo(self):
         """Kill the sumo subprocess instance."""
+        if self.sumo_proc is None:
+            # sumo runs in-process with libsumo
+            return
         try:
             os.killpg(self.sumo_proc.pid, signal.SIGTERM)
         except Exception as e:
@@ -760,6 +760,14 @@ class KernelVehicle(object, metaclass=ABCMeta):
         """Update stored acceleration of vehicle with veh_id."""
         pass
 
+    def get_table(self):
+        """Return the columnar VehicleTable of the kernel.
+
+        None if the kernel does not keep one, in which case the controllers
+        are evaluated one vehicle at a time.
+        """
+        return None
+
     @abstractmethod
     def get_2d_position(self, veh_id, error=-1001):
         """Return (x, y) position of vehicle with veh_id."""
@@ -0,0 +1,307 @@
+"""Script containing the columnar vehicle state table."""
+import numpy as np
+
+
+class VehicleTable:
+    """Struct-of-arrays storage of the per-vehicle state.
+
+    Each column is a contiguous NumPy array with one row per vehicle. Rows
+    are given by a stable veh_id -> row index, and the rows of removed
+    vehicles are put on a free list and reused by the next added vehicles.
+
+    Edges are stored as interned integer codes, see `edge_code` and
+    `edge_names`; code 0 is the empty edge of vehicles that are not
+    subscribed yet.
+
+    Attributes
+    ----------
+    data : dict < str, np.ndarray >
+        the columns, indexed by row
+    rows : dict < str, int >
+        the row of each vehicle in the table
+    ids : list < str >
+        the vehicle of each row, None for free rows
+    """
+
+    # name of each column and its dtype
+    COLUMNS = {
+        'speed': np.float64,
+        'previous_speed': np.float64,
+        'position': np.float64,
+        'lane': np.int64,
+        'edge': np.int64,
+        'headway': np.float64,
+        'leader': np.int64,
+        'accel': np.float64,
+        'length': np.float64,
+        'min_gap': np.float64,
+        # closest vehicle led by each vehicle, and its headway
+        'follower': np.int64,
+        'follower_headway': np.float64,
+        # 2D position and angle
+        'x': np.float64,
+        'y': np.float64,
+        'angle': np.float64,
+        # accelerations requested by the controllers, NaN if none
+        'accel_no_noise_no_failsafe': np.float64,
+        'accel_no_noise_with_failsafe': np.float64,
+        'accel_with_noise_no_failsafe': np.float64,
+        'accel_with_noise_with_failsafe': np.float64,
+    }
+
+    # value of the columns of an empty row, zero for the others
+    DEFAULTS = {
+        'leader': -1,
+        'follower': -1,
+        'follower_headway': 1e3,
+        'accel_no_noise_no_failsafe': np.nan,
+        'accel_no_noise_with_failsafe': np.nan,
+        'accel_with_noise_no_failsafe': np.nan,
+        'accel_with_noise_with_failsafe': np.nan,
+    }
+
+    def __init__(self, capacity=64):
+        """Instantiate an empty table with room for capacity vehicles."""
+        self.capacity = capacity
+        self.data = {name: np.zeros(capacity, dtype=dtype)
+                     for name, dtype in self.COLUMNS.items()}
+        for name, value in self.DEFAULTS.items():
+            self.data[name][:] = value
+        self.rows = {}
+        self.ids = [None] * capacity
+        self._free = list(range(capacity - 1, -1, -1))
+        self.edge_codes = {}
+        self.edge_names = []
+        self._internal = np.zeros(0, dtype=bool)
+        # code 0 (the edge of an empty row) is the empty edge
+        self.edge_code("")
+
+    def __contains__(self, veh_id):
+        return veh_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, veh_id):
+        """Add a vehicle (if it is not in the table yet) and return its row.
+
+        The row is reset to the DEFAULTS, zero for the other columns.
+        """
+        if veh_id in self.rows:
+            return self.rows[veh_id]
+        if not self._free:
+            self._grow()
+        row = self._free.pop()
+        self.rows[veh_id] = row
+        self.ids[row] = veh_id
+        for name, column in self.data.items():
+            column[row] = self.DEFAULTS.get(name, 0)
+        return row
+
+    def remove(self, veh_id):
+        """Remove a vehicle from the table, its row is freed for reuse."""
+        row = self.rows.pop(veh_id, None)
+        if row is None:
+            return
+        self.ids[row] = None
+        self._free.append(row)
+        # vehicles led by (or leading) the removed one no longer have a
+        # (known) leader (or follower)
+        self.data['leader'][self.data['leader'] == row] = -1
+        self.data['follower'][self.data['follower'] == row] = -1
+
+    def clear(self):
+        """Remove all the vehicles."""
+        for veh_id in list(self.rows):
+            self.remove(veh_id)
+
+    def _grow(self):
+        """Double the capacity of the table."""
+        capacity = self.capacity * 2
+        for name, column in self.data.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.capacity] = column
+            self.data[name] = grown
+        for name, value in self.DEFAULTS.items():
+            self.data[name][self.capacity:] = value
+        self.ids += [None] * (capacity - self.capacity)
+        self._free = list(range(capacity - 1, self.capacity - 1, -1)) + \
+            self._free
+        self.capacity = capacity
+
+    def row(self, veh_id, missing=-1):
+        """Return the row of a vehicle, or missing if it is not in the table."""
+        return self.rows.get(veh_id, missing)
+
+    def row_array(self, veh_ids):
+        """Return the rows of a list of vehicles, -1 for unknown vehicles."""
+        rows = self.rows
+        return np.fromiter((rows.get(veh_id, -1) for veh_id in veh_ids),
+                           dtype=np.int64, count=len(veh_ids))
+
+    def active_rows(self):
+        """Return the rows in use."""
+        return np.fromiter(self.rows.values(), dtype=np.int64,
+                           count=len(self.rows))
+
+    def get(self, name, veh_id, error):
+        """Return the value of a column for a vehicle or a list of vehicles.
+
+        For a list of vehicles, an array is returned, with error for the
+        vehicles that are not in the table.
+        """
+        if isinstance(veh_id, (list, np.ndarray)):
+            rows = self.row_array(veh_id)
+            values = self.data[name][rows]
+            missing = rows < 0
+            if missing.any():
+                values = values.astype(np.result_type(values, error))
+                values[missing] = error
+            return values
+        row = self.rows.get(veh_id)
+        if row is None:
+            return error
+        return self.data[name][row].item()
+
+    def set(self, name, veh_id, value):
+        """Set the value of a column for a vehicle in the table."""
+        self.data[name][self.rows[veh_id]] = value
+
+    def edge_code(self, edge):
+        """Return the integer code of an edge name, interning it if needed."""
+        code = self.edge_codes.get(edge)
+        if code is None:
+            code = len(self.edge_names)
+            self.edge_codes[edge] = code
+            self.edge_names.append(edge)
+        return code
+
+    def internal_edges(self):
+        """Return whether each edge code is an internal (junction) edge.
+
+        The empty edge of a vehicle that is not subscribed yet counts as
+        internal as well.
+        """
+        n_old, n_new = len(self._internal), len(self.edge_names)
+        if n_old < n_new:
+            self._internal = np.concatenate([
+                self._internal,
+                [len(edge) == 0 or edge[0] == ":"
+                 for edge in self.edge_names[n_old:]]]).astype(bool)
+        return self._internal
+
+    def get_edge(self, veh_id, error):
+        """Return the edge name of a vehicle or a list of vehicles."""
+        if isinstance(veh_id, (list, np.ndarray)):
+            rows = self.row_array(veh_id)
+            codes = self.data['edge'][rows]
+            names = self.edge_names
+            return [names[code] if row >= 0 else error
+                    for row, code in zip(rows, codes)]
+        row = self.rows.get(veh_id)
+        if row is None:
+            return error
+        return self.edge_names[self.data['edge'][row]]
+
+
+class LaneIndex:
+    """Positions of the vehicles of a VehicleTable on each lane, sorted.
+
+    For each (edge code, lane) pair, the rows of the vehicles on the lane are
+    kept sorted by position across the steps. At each update, only the
+    vehicles that departed, arrived or changed lane are moved between the
+    lanes, and a lane is only re-sorted if vehicles were added to it or if
+    its order changed (e.g. after a teleport). Vehicles without an edge are
+    not indexed.
+
+    Attributes
+    ----------
+    rows : dict < (int, int), np.ndarray >
+        rows of the vehicles on each (non-empty) lane, sorted by position
+    positions : dict < (int, int), np.ndarray >
+        positions of these vehicles at the last update
+    """
+
+    def __init__(self):
+        """Instantiate an empty index."""
+        self.rows = {}
+        self.positions = {}
+        # edge code and lane of each indexed row, -1 for the others
+        self._edge = np.full(0, -1, dtype=np.int64)
+        self._lane = np.full(0, -1, dtype=np.int64)
+
+    def clear(self):
+        """Remove all the vehicles."""
+        self.rows = {}
+        self.positions = {}
+        self._edge[:] = -1
+        self._lane[:] = -1
+
+    def update(self, table):
+        """Update the index with the current edges, lanes and positions."""
+        if len(self._edge) < table.capacity:
+            pad = table.capacity - len(self._edge)
+            self._edge = np.concatenate(
+                [self._edge, np.full(pad, -1, dtype=np.int64)])
+            self._lane = np.concatenate(
+                [self._lane, np.full(pad, -1, dtype=np.int64)])
+
+        data = table.data
+        active = table.active_rows()
+        in_table = np.zeros(len(self._edge), dtype=bool)
+        in_table[active] = True
+        edge = np.where(in_table, data['edge'][:len(self._edge)], -1)
+        # vehicles without an edge (code 0) are not indexed
+        edge[edge == 0] = -1
+        lane = np.where(edge >= 0, data['lane'][:len(self._edge)], -1)
+
+        # arrived vehicles and vehicles that changed lane
+        moved = np.flatnonzero((edge != self._edge) | (lane != self._lane))
+        members = {}
+        touched = set()
+        for row in moved.tolist():
+            old = (self._edge[row].item(), self._lane[row].item())
+            new = (edge[row].item(), lane[row].item())
+            if old[0] >= 0:
+                if old not in members:
+                    members[old] = self.rows[old].tolist()
+                members[old].remove(row)
+                touched.add(old)
+            if new[0] >= 0:
+                if new not in members:
+                    members[new] = self.rows[new].tolist() \
+                        if new in self.rows else []
+                members[new].append(row)
+                touched.add(new)
+        self._edge, self._lane = edge, lane
+
+        for key in touched:
+            if len(members[key]) == 0:
+                del self.rows[key]
+                self.positions.pop(key, None)
+            else:
+                self.rows[key] = np.array(members[key], dtype=np.int64)
+
+        position = data['position']
+        for key, rows in self.rows.items():
+            positions = position[rows]
+            if key in touched or np.any(positions[1:] < positions[:-1]):
+                order = np.argsort(positions, kind='stable')
+                rows = rows[order]
+                positions = positions[order]
+                self.rows[key] = rows
+            self.positions[key] = positions
+
+    def lane(self, edge, lane):
+        """Return the rows and positions of the vehicles on a lane.
+
+        Both are empty if the lane is empty or the edge is unknown.
+        """
+        key = (edge, lane)
+        if key not in self.rows:
+            return _EMPTY_ROWS, _EMPTY_POSITIONS
+        return self.rows[key], self.positions[key]
+
+
+_EMPTY_ROWS = np.zeros(0, dtype=np.int64)
+_EMPTY_POSITIONS = np.zeros(0, dtype=np.float64)
@@ -1,7 +1,8 @@
 """Script containing the TraCI vehicle kernel class."""
-import traceback
 
 from algorithms.envs.flow.core.kernel.vehicle import KernelVehicle
+from algorithms.envs.flow.core.kernel.vehicle.table import VehicleTable, \
+    LaneIndex
 import traci.constants as tc
 from traci.exceptions import FatalTraCIError, TraCIException
 import numpy as np
@@ -10,8 +11,6 @@ import warnings
 from algorithms.envs.flow.controllers.car_following_models import SimCarFollowingController
 from algorithms.envs.flow.controllers.rlcontroller import RLController
 from algorithms.envs.flow.controllers.lane_change_controllers import SimLaneChangeController
-from bisect import bisect_left
-import itertools
 from copy import deepcopy
 
 # colors for vehicles
@@ -53,6 +52,17 @@ class TraCIVehicle(KernelVehicle):
         # on the state of the vehicles for a given time step
         self.__sumo_obs = {}
 
+        # columnar storage of the numeric state of the departed vehicles
+        # (speed, position, lane, edge, headway, leader, accel, length)
+        self._table = VehicleTable()
+        self._lane_index = LaneIndex()
+
+        # simulation time and step size of the last update
+        self._timestep = 0
+        self._timedelta = 0
+        # network edge code of each edge code of the table, see get_x_by_id
+        self._network_codes = np.zeros(0, dtype=np.int64)
+
         # total number of vehicles in the network
         self.num_vehicles = 0
         # number of rl vehicles in the network
@@ -85,8 +95,6 @@ class TraCIVehicle(KernelVehicle):
         except AttributeError:
             self._force_color_update = False
 
-        # old speeds used to compute accelerations
-        self.previous_speeds = {}
 
     def initialize(self, vehicles):
         """Initialize vehicle state information.
@@ -107,6 +115,8 @@ class TraCIVehicle(KernelVehicle):
         self.num_not_departed = 0
 
         self.__vehicles.clear()
+        self._table.clear()
+        self._lane_index.clear()
         for typ in vehicles.initial:
             for i in range(typ['num_vehicles']):
                 veh_id = '{}_{}'.format(typ['veh_id'], i)
@@ -135,12 +145,11 @@ class TraCIVehicle(KernelVehicle):
             step
         """
         # copy over the previous speeds
+        self._table.data['previous_speed'][:] = self._table.data['speed']
 
-        vehicle_obs = {}
-        for veh_id in self.__ids:
-            self.previous_speeds[veh_id] = self.get_speed(veh_id)
-            vehicle_obs[veh_id] = \
-                self.kernel_api.vehicle.getSubscriptionResults(veh_id)
+        # the subscription results of all the vehicles, fetched at once
+        all_obs = self.kernel_api.vehicle.getAllSubscriptionResults()
+        vehicle_obs = {veh_id: all_obs.get(veh_id) for veh_id in self.__ids}
         sim_obs = self.kernel_api.simulation.getSubscriptionResults()
 
         arrived_rl_ids = []
@@ -220,42 +229,15 @@ class TraCIVehicle(KernelVehicle):
             self.num_not_departed += sim_obs[tc.VAR_LOADED_VEHICLES_NUMBER] - \
                 sim_obs[tc.VAR_DEPARTED_VEHICLES_NUMBER]
 
-        # update the "headway", "leader", and "follower" variables
-        for veh_id in self.__ids:
-            try:
-                _position = vehicle_obs.get(veh_id, {}).get(
-                    tc.VAR_POSITION, -1001)
-                _angle = vehicle_obs.get(veh_id, {}).get(tc.VAR_ANGLE, -1001)
-                _time_step = sim_obs[tc.VAR_TIME_STEP]
-                _time_delta = sim_obs[tc.VAR_DELTA_T]
-                self.__vehicles[veh_id]["orientation"] = \
-                    list(_position) + [_angle]
-                self.__vehicles[veh_id]["timestep"] = _time_step
-                self.__vehicles[veh_id]["timedelta"] = _time_delta
-            except TypeError:
-                print(traceback.format_exc())
-            headway = vehicle_obs.get(veh_id, {}).get(tc.VAR_LEADER, None)
-            # check for a collided vehicle or a vehicle with no leader
-            if headway is None:
-                self.__vehicles[veh_id]["leader"] = None
-                self.__vehicles[veh_id]["follower"] = None
-                self.__vehicles[veh_id]["headway"] = 1e+3
-                self.__vehicles[veh_id]["follower_headway"] = 1e+3
-            else:
-                min_gap = self.minGap[self.get_type(veh_id)]
-                self.__vehicles[veh_id]["headway"] = headway[1] + min_gap
-                self.__vehicles[veh_id]["leader"] = headway[0]
-                if headway[0] in self.__vehicles:
-                    leader = self.__vehicles[headway[0]]
-                    # if veh_id is closer from leader than another follower
-                    # (in case followers are in different converging edges)
-                    if ("follower_headway" not in leader or
-                            headway[1] + min_gap < leader["follower_headway"]):
-                        leader["follower"] = veh_id
-                        leader["follower_headway"] = headway[1] + min_gap
+        self._timestep = sim_obs[tc.VAR_TIME_STEP]
+        self._timedelta = sim_obs[tc.VAR_DELTA_T]
 
         # update the sumo observations variable
         self.__sumo_obs = vehicle_obs.copy()
+        self._store_obs(vehicle_obs)
+
+        # update the "headway", "leader", and "follower" variables
+        self._store_leaders(vehicle_obs)
 
         # update the lane leaders data for each vehicle
         self._multi_lane_headways()
@@ -263,6 +245,86 @@ class TraCIVehicle(KernelVehicle):
         # make sure the rl vehicle list is still sorted
         self.__rl_ids.sort()
 
+    def _store_obs(self, vehicle_obs, veh_ids=None):
+        """Write the subscription results into the vehicle table.
+
+        Vehicles of the table without (or with empty) subscription results,
+        e.g. collided or teleported ones, get the error values of the getters
+        (-1001 and the empty edge), which the rewards check for (e.g.
+        speed < -100).
+
+        Parameters
+        ----------
+        vehicle_obs : dict < str, dict >
+            subscription results of each vehicle
+        veh_ids : list < str >, optional
+            vehicles to update, all the vehicles of the table if None
+        """
+        table = self._table
+        ids = list(table.rows) if veh_ids is None else \
+            [veh_id for veh_id in veh_ids if veh_id in table]
+        if len(ids) == 0:
+            return
+        rows = table.row_array(ids)
+        obs = [vehicle_obs.get(veh_id) or {} for veh_id in ids]
+        table.data['speed'][rows] = [o.get(tc.VAR_SPEED, -1001) for o in obs]
+        table.data['position'][rows] = \
+            [o.get(tc.VAR_LANEPOSITION, -1001) for o in obs]
+        table.data['lane'][rows] = \
+            [o.get(tc.VAR_LANE_INDEX, -1001) for o in obs]
+        table.data['edge'][rows] = \
+            [table.edge_code(o.get(tc.VAR_ROAD_ID, "")) for o in obs]
+        position = np.array([o.get(tc.VAR_POSITION, (-1001, -1001))
+                             for o in obs], dtype=np.float64).reshape(-1, 2)
+        table.data['x'][rows] = position[:, 0]
+        table.data['y'][rows] = position[:, 1]
+        table.data['angle'][rows] = [o.get(tc.VAR_ANGLE, -1001) for o in obs]
+
+    def _store_leaders(self, vehicle_obs):
+        """Write the leaders, headways and followers into the vehicle table.
+
+        The follower of a vehicle is the closest of the vehicles it leads (in
+        case they are in different converging edges).
+
+        Parameters
+        ----------
+        vehicle_obs : dict < str, dict >
+            subscription results of each vehicle
+        """
+        table = self._table
+        ids = [veh_id for veh_id in self.__ids if veh_id in table]
+        if len(ids) == 0:
+            return
+        rows = table.row_array(ids)
+        leaders = [(vehicle_obs.get(veh_id) or {}).get(tc.VAR_LEADER, None)
+                   for veh_id in ids]
+
+        # check for a collided vehicle or a vehicle with no leader
+        has_leader = np.array([headway is not None for headway in leaders],
+                              dtype=bool)
+        lead_rows = table.row_array(
+            [headway[0] if headway is not None else None
+             for headway in leaders])
+        gap = np.array([headway[1] if headway is not None else 0
+                        for headway in leaders], dtype=np.float64)
+        headway = np.where(has_leader, gap + table.data['min_gap'][rows], 1e+3)
+        table.data['headway'][rows] = headway
+        table.data['leader'][rows] = np.where(has_leader, lead_rows, -1)
+
+        table.data['follower'][rows] = -1
+        table.data['follower_headway'][rows] = 1e+3
+        led = np.flatnonzero(has_leader & (lead_rows >= 0))
+        if len(led) > 0:
+            # sort by leader, then by headway: the first vehicle of each
+            # leader is its follower
+            order = led[np.lexsort((headway[led], lead_rows[led]))]
+            lead = lead_rows[order]
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = lead[1:] != lead[:-1]
+            table.data['follower'][lead[first]] = rows[order[first]]
+            table.data['follower_headway'][lead[first]] = \
+                headway[order[first]]
+
     def _add_departed(self, veh_id, veh_type):
         """Add a vehicle that entered the network from an inflow or reset.
 
@@ -286,6 +348,7 @@ class TraCIVehicle(KernelVehicle):
         if veh_id not in self.__vehicles:
             self.num_vehicles += 1
             self.__vehicles[veh_id] = dict()
+        self._table.add(veh_id)
 
         # specify the type
         self.__vehicles[veh_id]["type"] = veh_type
@@ -342,8 +405,9 @@ class TraCIVehicle(KernelVehicle):
         self.kernel_api.vehicle.subscribeLeader(veh_id, 2000)
 
         # some constant vehicle parameters to the vehicles class
-        self.__vehicles[veh_id]["length"] = self.kernel_api.vehicle.getLength(
-            veh_id)
+        self._table.set("length", veh_id,
+                        self.kernel_api.vehicle.getLength(veh_id))
+        self._table.set("min_gap", veh_id, self.minGap[veh_type])
 
         # set the "last_lc" parameter of the vehicle
         self.__vehicles[veh_id]["last_lc"] = -float("inf")
@@ -374,6 +438,7 @@ class TraCIVehicle(KernelVehicle):
             self.kernel_api.vehicle.getSpeed(veh_id)
         self.__sumo_obs[veh_id][tc.VAR_FUELCONSUMPTION] = \
             self.kernel_api.vehicle.getFuelConsumption(veh_id)
+        self._store_obs({veh_id: self.__sumo_obs[veh_id]}, [veh_id])
 
         # make sure that the order of rl_ids is kept sorted
         self.__rl_ids.sort()
@@ -386,7 +451,7 @@ class TraCIVehicle(KernelVehicle):
 
     def reset(self):
         """See parent class."""
-        self.previous_speeds = {}
+        self._table.data['previous_speed'][:] = 0
 
     def remove(self, veh_id):
         """See parent class."""
@@ -404,6 +469,7 @@ class TraCIVehicle(KernelVehicle):
 
         if veh_id in self.__sumo_obs:
             del self.__sumo_obs[veh_id]
+        self._table.remove(veh_id)
 
         # remove it from all other id lists (if it is there)
         if veh_id in self.__human_ids:
@@ -424,30 +490,34 @@ class TraCIVehicle(KernelVehicle):
     def test_set_speed(self, veh_id, speed):
         """Set the speed of the specified vehicle."""
         self.__sumo_obs[veh_id][tc.VAR_SPEED] = speed
+        self._table.set("speed", veh_id, speed)
 
     def test_set_edge(self, veh_id, edge):
         """Set the speed of the specified vehicle."""
         self.__sumo_obs[veh_id][tc.VAR_ROAD_ID] = edge
+        self._table.set("edge", veh_id, self._table.edge_code(edge))
 
     def set_follower(self, veh_id, follower):
         """Set the follower of the specified vehicle."""
-        self.__vehicles[veh_id]["follower"] = follower
+        self._table.set("follower", veh_id, self._table.row(follower))
 
     def set_headway(self, veh_id, headway):
         """Set the headway of the specified vehicle."""
-        self.__vehicles[veh_id]["headway"] = headway
+        self._table.set("headway", veh_id, headway)
 
     def get_orientation(self, veh_id):
         """See parent class."""
-        return self.__vehicles[veh_id]["orientation"]
+        row = self._table.rows[veh_id]
+        return [self._table.data[name][row].item()
+                for name in ('x', 'y', 'angle')]
 
     def get_timestep(self, veh_id):
         """See parent class."""
-        return self.__vehicles[veh_id]["timestep"]
+        return self._timestep
 
     def get_timedelta(self, veh_id):
         """See parent class."""
-        return self.__vehicles[veh_id]["timedelta"]
+        return self._timedelta
 
     def get_type(self, veh_id):
         """Return the type of the vehicle of veh_id."""
@@ -549,15 +619,11 @@ class TraCIVehicle(KernelVehicle):
 
     def get_previous_speed(self, veh_id, error=-1001):
         """See parent class."""
-        if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_previous_speed(vehID, error) for vehID in veh_id]
-        return self.previous_speeds.get(veh_id, 0)
+        return self._table.get("previous_speed", veh_id, 0)
 
     def get_speed(self, veh_id, error=-1001):
         """See parent class."""
-        if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_speed(vehID, error) for vehID in veh_id]
-        return self.__sumo_obs.get(veh_id, {}).get(tc.VAR_SPEED, error)
+        return self._table.get("speed", veh_id, error)
 
     def get_default_speed(self, veh_id, error=-1001):
         """See parent class."""
@@ -568,21 +634,15 @@ class TraCIVehicle(KernelVehicle):
 
     def get_position(self, veh_id, error=-1001):
         """See parent class."""
-        if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_position(vehID, error) for vehID in veh_id]
-        return self.__sumo_obs.get(veh_id, {}).get(tc.VAR_LANEPOSITION, error)
+        return self._table.get("position", veh_id, error)
 
     def get_edge(self, veh_id, error=""):
         """See parent class."""
-        if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_edge(vehID, error) for vehID in veh_id]
-        return self.__sumo_obs.get(veh_id, {}).get(tc.VAR_ROAD_ID, error)
+        return self._table.get_edge(veh_id, error)
 
     def get_lane(self, veh_id, error=-1001):
         """See parent class."""
-        if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_lane(vehID, error) for vehID in veh_id]
-        return self.__sumo_obs.get(veh_id, {}).get(tc.VAR_LANE_INDEX, error)
+        return self._table.get("lane", veh_id, error)
 
     def get_route(self, veh_id, error=None):
         """See parent class."""
@@ -594,27 +654,36 @@ class TraCIVehicle(KernelVehicle):
 
     def get_length(self, veh_id, error=-1001):
         """See parent class."""
-        if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_length(vehID, error) for vehID in veh_id]
-        return self.__vehicles.get(veh_id, {}).get("length", error)
+        return self._table.get("length", veh_id, error)
 
     def get_leader(self, veh_id, error=""):
         """See parent class."""
-        if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_leader(vehID, error) for vehID in veh_id]
-        return self.__vehicles.get(veh_id, {}).get("leader", error)
+        return self._get_vehicle("leader", veh_id, error)
 
     def get_follower(self, veh_id, error=""):
         """See parent class."""
+        return self._get_vehicle("follower", veh_id, error)
+
+    def _get_vehicle(self, name, veh_id, error):
+        """Return the vehicle referred to by a row column of the table.
+
+        None if there is no such vehicle, error for unknown vehicles.
+        """
+        table = self._table
         if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_follower(vehID, error) for vehID in veh_id]
-        return self.__vehicles.get(veh_id, {}).get("follower", error)
+            rows = table.row_array(veh_id)
+            refs = table.data[name][rows]
+            return [error if row < 0 else (table.ids[ref] if ref >= 0 else None)
+                    for row, ref in zip(rows.tolist(), refs.tolist())]
+        row = table.rows.get(veh_id)
+        if row is None:
+            return error
+        ref = table.data[name][row]
+        return table.ids[ref] if ref >= 0 else None
 
     def get_headway(self, veh_id, error=-1001):
         """See parent class."""
-        if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_headway(vehID, error) for vehID in veh_id]
-        return self.__vehicles.get(veh_id, {}).get("headway", error)
+        return self._table.get("headway", veh_id, error)
 
     def get_last_lc(self, veh_id, error=-1001):
         """See parent class."""
@@ -626,7 +695,7 @@ class TraCIVehicle(KernelVehicle):
                           ' {}.'.format(veh_id, error))
             return error
         else:
-            return self.__vehicles.get(veh_id, {}).get("headway", error)
+            return self._table.get("headway", veh_id, error)
 
     def get_acc_controller(self, veh_id, error=None):
         """See parent class."""
@@ -717,153 +786,149 @@ class TraCIVehicle(KernelVehicle):
         This includes the lane leaders/followers/headways/tailways/
         leader velocity/follower velocity for all
         vehicles in the network.
+
+        The vehicles on each lane are looked up in the sorted lane index,
+        which is updated incrementally, and the lane leaders and followers
+        of the rl vehicles on the same edge are found with one bisection per
+        lane.
         """
         edge_list = self.master_kernel.network.get_edge_list()
-        junction_list = self.master_kernel.network.get_junction_list()
-        tot_list = edge_list + junction_list
         num_edges = (len(self.master_kernel.network.get_edge_list()) + len(
             self.master_kernel.network.get_junction_list()))
 
-        # maximum number of lanes in the network
-        max_lanes = max([self.master_kernel.network.num_lanes(edge_id)
-                         for edge_id in tot_list])
-
-        # Key = edge id
-        # Element = list, with the ith element containing tuples with the name
-        #           and position of all vehicles in lane i
-        edge_dict = dict.fromkeys(tot_list)
-
-        # add the vehicles to the edge_dict element
-        for veh_id in self.get_ids():
-            edge = self.get_edge(veh_id)
-            lane = self.get_lane(veh_id)
-            pos = self.get_position(veh_id)
-            if edge:
-                if edge_dict[edge] is None:
-                    edge_dict[edge] = [[] for _ in range(max_lanes)]
-                edge_dict[edge][lane].append((veh_id, pos))
-
-        # sort all lanes in each edge by position
-        for edge in tot_list:
-            if edge_dict[edge] is None:
-                del edge_dict[edge]
-            else:
-                for lane in range(max_lanes):
-                    edge_dict[edge][lane].sort(key=lambda x: x[1])
-
-        for veh_id in self.get_rl_ids():
-            # collect the lane leaders, followers, headways, and tailways for
-            # each vehicle
-            edge = self.get_edge(veh_id)
-            if edge:
-                headways, tailways, leaders, followers = \
-                    self._multi_lane_headways_util(veh_id, edge_dict,
-                                                   num_edges)
-
-                # add the above values to the vehicles class
-                self.set_lane_headways(veh_id, headways)
-                self.set_lane_tailways(veh_id, tailways)
-                self.set_lane_leaders(veh_id, leaders)
-                self.set_lane_followers(veh_id, followers)
+        table = self._table
+        self._lane_index.update(table)
+
+        # group the rl vehicles by edge
+        rl_ids = [veh_id for veh_id in self.get_rl_ids() if veh_id in table]
+        rl_rows = table.row_array(rl_ids)
+        rl_edges = table.data['edge'][rl_rows]
+        by_edge = collections.defaultdict(list)
+        for i, code in enumerate(rl_edges.tolist()):
+            # rl vehicles that are not subscribed yet have no edge
+            if code != 0:
+                by_edge[code].append(i)
+
+        for code, index in by_edge.items():
+            veh_ids = [rl_ids[i] for i in index]
+            headways, tailways, leaders, followers = \
+                self._multi_lane_headways_util(
+                    veh_ids, rl_rows[index], code, num_edges)
+
+            # add the above values to the vehicles class
+            for i, veh_id in enumerate(veh_ids):
+                self.set_lane_headways(veh_id, headways[i])
+                self.set_lane_tailways(veh_id, tailways[i])
+                self.set_lane_leaders(veh_id, leaders[i])
+                self.set_lane_followers(veh_id, followers[i])
 
         self._ids_by_edge = dict().fromkeys(edge_list)
-
-        for edge_id in edge_dict:
-            edges = list(itertools.chain.from_iterable(edge_dict[edge_id]))
-            # check for edges with no vehicles
-            if len(edges) > 0:
-                edges, _ = zip(*edges)
-                self._ids_by_edge[edge_id] = list(edges)
-            else:
+        ids = table.ids
+        for code, lane in sorted(self._lane_index.rows):
+            edge_id = table.edge_names[code]
+            if self._ids_by_edge.get(edge_id) is None:
                 self._ids_by_edge[edge_id] = []
+            self._ids_by_edge[edge_id].extend(
+                ids[row] for row in self._lane_index.rows[(code, lane)])
 
-    def _multi_lane_headways_util(self, veh_id, edge_dict, num_edges):
-        """Compute multi-lane data for the specified vehicle.
+    def _multi_lane_headways_util(self, veh_ids, rows, edge, num_edges):
+        """Compute multi-lane data for vehicles on the same edge.
 
         Parameters
         ----------
-        veh_id : str
-            name of the vehicle
-        edge_dict : dict < list<tuple> >
-            Key = Edge name
-                Index = lane index
-                Element = list sorted by position of (vehicle id, position)
+        veh_ids : list<str>
+            name of the vehicles
+        rows : np.ndarray
+            their rows in the vehicle table
+        edge : int
+            code of their edge
+        num_edges : int
+            number of edges and junctions in the network
 
         Returns
         -------
-        headway : list<float>
-            Index = lane index
+        headway : list<list<float>>
+            Index = vehicle, lane index
             Element = headway at this lane
-        tailway : list<float>
-            Index = lane index
+        tailway : list<list<float>>
+            Index = vehicle, lane index
             Element = tailway at this lane
-        lead_speed : list<str>
-            Index = lane index
-            Element = speed of leader at this lane
-        follow_speed : list<str>
-            Index = lane index
-            Element = speed of follower at this lane
-        leader : list<str>
-            Index = lane index
+        leader : list<list<str>>
+            Index = vehicle, lane index
             Element = leader at this lane
-        follower : list<str>
-            Index = lane index
+        follower : list<list<str>>
+            Index = vehicle, lane index
             Element = follower at this lane
         """
-        this_pos = self.get_position(veh_id)
-        this_edge = self.get_edge(veh_id)
-        this_lane = self.get_lane(veh_id)
-        num_lanes = self.master_kernel.network.num_lanes(this_edge)
+        table = self._table
+        length = table.data['length']
+        this_pos = table.data['position'][rows]
+        this_lane = table.data['lane'][rows]
+        this_length = length[rows]
+        num_lanes = self.master_kernel.network.num_lanes(
+            table.edge_names[edge])
 
         # set default values for all output values
-        headway = [1000] * num_lanes
-        tailway = [1000] * num_lanes
-        leader = [""] * num_lanes
-        follower = [""] * num_lanes
+        n = len(veh_ids)
+        headway = np.full((n, num_lanes), 1000.)
+        tailway = np.full((n, num_lanes), 1000.)
+        leader = np.full((n, num_lanes), -1, dtype=np.int64)
+        follower = np.full((n, num_lanes), -1, dtype=np.int64)
 
         for lane in range(num_lanes):
-            # check the vehicle's current  edge for lane leaders and followers
-            if len(edge_dict[this_edge][lane]) > 0:
-                ids, positions = zip(*edge_dict[this_edge][lane])
-                ids = list(ids)
-                positions = list(positions)
-                index = bisect_left(positions, this_pos)
+            # check the vehicles' current edge for lane leaders and followers
+            lane_rows, positions = self._lane_index.lane(edge, lane)
+            if len(lane_rows) > 0:
+                index = np.searchsorted(positions, this_pos, side='left')
 
                 # if you are at the end or the front of the edge, the lane
                 # leader is in the edges in front of you
-                if (lane == this_lane and index < len(positions) - 1) \
-                        or (lane != this_lane and index < len(positions)):
-                    # check if the index does not correspond to the current
-                    # vehicle
-                    if ids[index] == veh_id:
-                        leader[lane] = ids[index + 1]
-                        headway[lane] = (positions[index + 1] - this_pos -
-                                         self.get_length(leader[lane]))
-                    else:
-                        leader[lane] = ids[index]
-                        headway[lane] = (positions[index] - this_pos
-                                         - self.get_length(leader[lane]))
-
-                # you are in the back of the queue, the lane follower is in the
-                # edges behind you
-                if index > 0:
-                    follower[lane] = ids[index - 1]
-                    tailway[lane] = (this_pos - positions[index - 1]
-                                     - self.get_length(veh_id))
-
-            # if lane leader not found, check next edges
-            if leader[lane] == "":
-                headway[lane], leader[lane] = self._next_edge_leaders(
-                    veh_id, edge_dict, lane, num_edges)
-
-            # if lane follower not found, check previous edges
-            if follower[lane] == "":
-                tailway[lane], follower[lane] = self._prev_edge_followers(
-                    veh_id, edge_dict, lane, num_edges)
+                found = np.where(this_lane == lane,
+                                 index < len(positions) - 1,
+                                 index < len(positions))
+                # skip the current vehicle
+                current = np.minimum(index, len(positions) - 1)
+                lead = np.where(lane_rows[current] == rows, current + 1,
+                                current)
+                lead = np.where(found, lead, 0)
+                leader[found, lane] = lane_rows[lead][found]
+                headway[found, lane] = (positions[lead] - this_pos -
+                                        length[lane_rows[lead]])[found]
+
+                # you are in the back of the queue, the lane follower is in
+                # the edges behind you
+                found = index > 0
+                follow = np.maximum(index - 1, 0)
+                follower[found, lane] = lane_rows[follow][found]
+                tailway[found, lane] = (this_pos - positions[follow] -
+                                        this_length)[found]
+
+        headway, tailway = headway.tolist(), tailway.tolist()
+        ids = table.ids
+        leader = [[ids[row] if row >= 0 else "" for row in lanes]
+                  for lanes in leader.tolist()]
+        follower = [[ids[row] if row >= 0 else "" for row in lanes]
+                    for lanes in follower.tolist()]
+
+        edge_id = table.edge_names[edge]
+        for i in range(n):
+            for lane in range(num_lanes):
+                # if lane leader not found, check next edges
+                if leader[i][lane] == "":
+                    headway[i][lane], leader[i][lane] = \
+                        self._next_edge_leaders(
+                            this_pos[i], edge_id, lane, num_edges)
+
+                # if lane follower not found, check previous edges
+                if follower[i][lane] == "":
+                    tailway[i][lane], follower[i][lane] = \
+                        self._prev_edge_followers(
+                            this_pos[i], this_length[i], edge_id, lane,
+                            num_edges)
 
         return headway, tailway, leader, follower
 
-    def _next_edge_leaders(self, veh_id, edge_dict, lane, num_edges):
+    def _next_edge_leaders(self, pos, edge, lane, num_edges):
         """Search for leaders in the next edge.
 
         Looks to the edges/junctions in front of the vehicle's current edge
@@ -877,9 +942,6 @@ class TraCIVehicle(KernelVehicle):
         leader : str
             lane leader for the specified lane
         """
-        pos = self.get_position(veh_id)
-        edge = self.get_edge(veh_id)
-
         headway = 1000  # env.network.length
         leader = ""
         add_length = 0  # length increment in headway
@@ -892,15 +954,13 @@ class TraCIVehicle(KernelVehicle):
             add_length += self.master_kernel.network.edge_length(edge)
             edge, lane = self.master_kernel.network.next_edge(edge, lane)[0]
 
-            try:
-                if len(edge_dict[edge][lane]) > 0:
-                    leader = edge_dict[edge][lane][0][0]
-                    headway = edge_dict[edge][lane][0][1] - pos + add_length \
-                        - self.get_length(leader)
-            except KeyError:
-                # current edge has no vehicles, so move on
-                # print(traceback.format_exc())
-                continue
+            # edges that never had a vehicle have no code
+            rows, positions = self._lane_index.lane(
+                self._table.edge_codes.get(edge, -1), lane)
+            if len(rows) > 0:
+                leader = self._table.ids[rows[0]]
+                headway = positions[0] - pos + add_length \
+                    - self._table.data['length'][rows[0]]
 
             # stop if a lane follower is found
             if leader != "":
@@ -908,7 +968,7 @@ class TraCIVehicle(KernelVehicle):
 
         return headway, leader
 
-    def _prev_edge_followers(self, veh_id, edge_dict, lane, num_edges):
+    def _prev_edge_followers(self, pos, length, edge, lane, num_edges):
         """Search for followers in the previous edge.
 
         Looks to the edges/junctions behind the vehicle's current edge for
@@ -922,9 +982,6 @@ class TraCIVehicle(KernelVehicle):
         follower : str
             lane follower for the specified lane
         """
-        pos = self.get_position(veh_id)
-        edge = self.get_edge(veh_id)
-
         tailway = 1000  # env.network.length
         follower = ""
         add_length = 0  # length increment in headway
@@ -937,15 +994,12 @@ class TraCIVehicle(KernelVehicle):
             edge, lane = self.master_kernel.network.prev_edge(edge, lane)[0]
             add_length += self.master_kernel.network.edge_length(edge)
 
-            try:
-                if len(edge_dict[edge][lane]) > 0:
-                    tailway = pos - edge_dict[edge][lane][-1][1] + add_length \
-                              - self.get_length(veh_id)
-                    follower = edge_dict[edge][lane][-1][0]
-            except KeyError:
-                # current edge has no vehicles, so move on
-                # print(traceback.format_exc())
-                continue
+            # edges that never had a vehicle have no code
+            rows, positions = self._lane_index.lane(
+                self._table.edge_codes.get(edge, -1), lane)
+            if len(rows) > 0:
+                tailway = pos - positions[-1] + add_length - length
+                follower = self._table.ids[rows[-1]]
 
             # stop if a lane follower is found
             if follower != "":
@@ -961,8 +1015,8 @@ class TraCIVehicle(KernelVehicle):
             acc = [acc]
 
         for i, vid in enumerate(veh_ids):
-            if acc[i] is not None and vid in self.get_ids():
-                self.__vehicles[vid]["accel"] = acc[i]
+            if acc[i] is not None and vid in self._table:
+                self._table.set("accel", vid, acc[i])
                 this_vel = self.get_speed(vid)
                 next_vel = max([this_vel + acc[i] * self.sim_step, 0])
                 if smooth:
@@ -1019,13 +1073,30 @@ class TraCIVehicle(KernelVehicle):
     def get_x_by_id(self, veh_id):
         """See parent class."""
         if isinstance(veh_id, (list, np.ndarray)):
-            return [self.get_x_by_id(vehID) for vehID in veh_id]
+            rows = self._table.row_array(veh_id)
+            # vehicles that are unknown or not on an edge are at 0
+            codes = np.where(rows >= 0, self._table.data['edge'][rows], 0)
+            x = self.master_kernel.network.get_x_by_code(
+                self._network_edge_codes()[codes],
+                self._table.data['position'][rows])
+            return np.where(codes == 0, 0., x).tolist()
         if self.get_edge(veh_id) == '':
             # occurs when a vehicle crashes is teleported for some other reason
             return 0.
         return self.master_kernel.network.get_x(
             self.get_edge(veh_id), self.get_position(veh_id))
 
+    def _network_edge_codes(self):
+        """Return the network edge code of each edge code of the table."""
+        names = self._table.edge_names
+        codes = self._network_codes
+        if len(codes) < len(names):
+            network = self.master_kernel.network
+            codes = np.concatenate([codes, [
+                network.edge_code(edge) for edge in names[len(codes):]]])
+            self._network_codes = codes.astype(np.int64)
+        return self._network_codes
+
     def update_vehicle_colors(self):
         """See parent class.
 
@@ -1131,33 +1202,45 @@ class TraCIVehicle(KernelVehicle):
 
     def get_accel(self, veh_id, noise=True, failsafe=True):
         """See parent class."""
-        metric_name = 'accel'
-        if noise:
-            metric_name += '_with_noise'
-        else:
-            metric_name += '_no_noise'
-        if failsafe:
-            metric_name += '_with_falsafe'
-        else:
-            metric_name += '_no_failsafe'
-
-        if metric_name not in self.__vehicles[veh_id]:
-            self.__vehicles[veh_id][metric_name] = None
-        return self.__vehicles[veh_id][metric_name]
+        metric_name = self._accel_metric(noise, failsafe)
+        accel = self._table.get(metric_name, veh_id, np.nan)
+        if np.isnan(accel):
+            return None
+        return accel
 
     def update_accel(self, veh_id, accel, noise=True, failsafe=True):
-        """See parent class."""
+        """See parent class.
+
+        veh_id may also be a list of vehicles, with accel the list (or array)
+        of their accelerations, None (or NaN) if they are not controlled.
+        """
+        metric_name = self._accel_metric(noise, failsafe)
+        if isinstance(veh_id, (list, np.ndarray)):
+            rows = self._table.row_array(veh_id)
+            known = rows >= 0
+            self._table.data[metric_name][rows[known]] = \
+                np.asarray(accel, dtype=np.float64)[known]
+        elif veh_id in self._table:
+            self._table.set(metric_name, veh_id,
+                            np.nan if accel is None else accel)
+
+    @staticmethod
+    def _accel_metric(noise, failsafe):
+        """Return the table column of a kind of stored acceleration."""
         metric_name = 'accel'
         if noise:
             metric_name += '_with_noise'
         else:
             metric_name += '_no_noise'
         if failsafe:
-            metric_name += '_with_falsafe'
+            metric_name += '_with_failsafe'
         else:
             metric_name += '_no_failsafe'
+        return metric_name
 
-        self.__vehicles[veh_id][metric_name] = accel
+    def get_table(self):
+        """See parent class."""
+        return self._table
 
     def get_realized_accel(self, veh_id):
         """See parent class."""
@@ -588,6 +588,10 @@ class SumoParams(SimParams):
         current time step
     use_ballistic: bool, optional
         If true, use a ballistic integration step instead of an euler step
+    use_libsumo: bool, optional
+        If true, run sumo in-process through libsumo instead of connecting to
+        a sumo process with TraCI. This avoids the socket round-trips, but
+        only one simulation can run per process and the gui is not available
     """
 
     def __init__(self,
@@ -609,7 +613,8 @@ class SumoParams(SimParams):
                  teleport_time=-1,
                  num_clients=1,
                  color_by_speed=False,
-                 use_ballistic=False):
+                 use_ballistic=False,
+                 use_libsumo=False):
         """Instantiate SumoParams."""
         super(SumoParams, self).__init__(
             sim_step, render, restart_instance, emission_path, save_render,
@@ -624,6 +629,7 @@ class SumoParams(SimParams):
         self.num_clients = num_clients
         self.color_by_speed = color_by_speed
         self.use_ballistic = use_ballistic
+        self.use_libsumo = use_libsumo
 
 
 class EnvParams:
@@ -24,6 +24,8 @@ import sumolib
 
 from algorithms.envs.flow.core.util import ensure_dir
 from algorithms.envs.flow.core.kernel import Kernel
+from algorithms.envs.flow.controllers.base_controller import \
+    BatchedControllers
 from algorithms.envs.flow.utils.exceptions import FatalFlowError
 
 
@@ -61,7 +63,7 @@ class Env(gym.Env, metaclass=ABCMeta):
     network : flow.networks.Network
         see flow/networks/base.py
     simulator : str
-        the simulator used, one of {'traci', 'aimsun'}
+        the simulator used, one of {'traci', 'aimsun', 'numpy'}
     k : flow.core.kernel.Kernel
         Flow kernel object, using for state acquisition and issuing commands to
         the certain components of the simulator. For more information, see:
@@ -117,7 +119,8 @@ class Env(gym.Env, metaclass=ABCMeta):
         network : flow.networks.Network
             see flow/networks/base.py
         simulator : str
-            the simulator used, one of {'traci', 'aimsun'}. Defaults to 'traci'
+            the simulator used, one of {'traci', 'aimsun', 'numpy'}. Defaults to
+            'traci'
 
         Raises
         ------
@@ -180,6 +183,10 @@ class Env(gym.Env, metaclass=ABCMeta):
         # dynamically
         self.available_routes = self.k.network.rts
 
+        # evaluates the acceleration controllers of the controlled vehicles,
+        # batched by controller class
+        self.batched_controllers = BatchedControllers()
+
         # store the initial vehicle ids
         self.initial_ids = deepcopy(self.network.vehicles.ids)
 
@@ -247,8 +254,10 @@ class Env(gym.Env, metaclass=ABCMeta):
         """
         self.k.close()
 
-        # killed the sumo process if using sumo/TraCI
-        if self.simulator == 'traci':
+        # killed the sumo process if using sumo/TraCI (there is none with
+        # libsumo)
+        if self.simulator == 'traci' and \
+                self.k.simulation.sumo_proc is not None:
             self.k.simulation.sumo_proc.kill()
 
         if render is not None:
@@ -328,11 +337,8 @@ class Env(gym.Env, metaclass=ABCMeta):
 
             # perform acceleration actions for controlled human-driven vehicles
             if len(self.k.vehicle.get_controlled_ids()) > 0:
-                accel = []
-                for veh_id in self.k.vehicle.get_controlled_ids():
-                    action = self.k.vehicle.get_acc_controller(
-                        veh_id).get_action(self)
-                    accel.append(action)
+                accel = self.batched_controllers.get_actions(
+                    self, self.k.vehicle.get_controlled_ids())
                 self.k.vehicle.apply_acceleration(
                     self.k.vehicle.get_controlled_ids(), accel)
 
@@ -469,7 +475,7 @@ class Env(gym.Env, metaclass=ABCMeta):
             self.setup_initial_state()
 
         # clear all vehicles from the network and the vehicles class
-        if self.simulator == 'traci':
+        if self.simulator in ('traci', 'numpy'):
             for veh_id in self.k.kernel_api.vehicle.getIDList():  # FIXME: hack
                 try:
                     self.k.vehicle.remove(veh_id)
@@ -508,7 +514,7 @@ class Env(gym.Env, metaclass=ABCMeta):
                 # if a vehicle was not removed in the first attempt, remove it
                 # now and then reintroduce it
                 self.k.vehicle.remove(veh_id)
-                if self.simulator == 'traci':
+                if self.simulator in ('traci', 'numpy'):
                     self.k.kernel_api.vehicle.remove(veh_id)  # FIXME: hack
                 self.k.vehicle.add(
                     veh_id=veh_id,
@@ -528,7 +534,7 @@ class Env(gym.Env, metaclass=ABCMeta):
         if self.sim_params.render:
             self.k.vehicle.update_vehicle_colors()
 
-        if self.simulator == 'traci':
+        if self.simulator in ('traci', 'numpy'):
             initial_ids = self.k.kernel_api.vehicle.getIDList()
         else:
             initial_ids = self.initial_ids
@@ -77,10 +77,13 @@ class AdversarialAccelEnv(AccelEnv, MultiEnv):
 
         The adversary state and the agent state are identical.
         """
-        state = np.array([[
-            self.k.vehicle.get_speed(veh_id) / self.k.network.max_speed(),
-            self.k.vehicle.get_x_by_id(veh_id) / self.k.network.length()
-        ] for veh_id in self.sorted_ids])
+        sorted_ids = self.sorted_ids
+        state = np.stack([
+            np.asarray(self.k.vehicle.get_speed(sorted_ids)) /
+            self.k.network.max_speed(),
+            np.asarray(self.k.vehicle.get_x_by_id(sorted_ids)) /
+            self.k.network.length()
+        ], axis=1)
         state = np.ndarray.flatten(state)
         return {'av': state, 'adversary': state}
 
@@ -2,8 +2,14 @@ import time
 
 from numpy.core.numeric import indices
 from torch.distributions.normal import Normal
-from algorithms.utils import collect, mem_report
+from algorithms.utils import collect, mem_report, loadCheckpoint, loadOptimizerStateDicts, EpisodeRecorder
 from algorithms.models import GaussianActor, GraphConvolutionalModel, MLP, CategoricalActor
+from algorithms.models import StackedCategoricalActor, StackedGaussianActor, StackedLinear, StackedMLP, unstackStateDict
+from algorithms.mbdppo.advantage import AdvantageEstimator, TrajectoryProcessor
+from algorithms.mbdppo.minibatch import MinibatchEngine, maskedMean
+from algorithms.mbdppo.rollout import ModelRollout
+from algorithms.mbdppo.evaluation import Evaluator
+from algorithms.mbdppo.policy import exportPolicy, updatePolicy
 from tqdm.std import trange
 from algorithms.algorithm import ReplayBuffer
 from ray.state import actors
@@ -19,23 +25,44 @@ import pickle
 from algorithms.models import CategoricalActor, EnsembledModel, SquashedGaussianActor, ParameterizedModel_MBPPO
 
 class MultiCollect:
-    def __init__(self, adjacency, device="cpu"):
+    def __init__(self, adjacency, device="cpu", sparse_threshold=0.25):
         """
         Method: 'gather', 'reduce_mean', 'reduce_sum'.
         Adjacency: torch Tensor.
         Everything outward would be in the same device specifed in the initialization parameter.
+
+        All methods are evaluated in one batched op:
+            gather uses a padded neighbor-index tensor [n_agent, max_degree] (padded with the agent itself) plus a mask,
+            the reductions use an adjacency matmul, which is sparse if the density is below sparse_threshold.
         """
         self.device = device
         n = adjacency.size()[0]
         adjacency = adjacency > 0 # Adjacency Matrix, with size n_agent*n_agent. 
         adjacency = adjacency | torch.eye(n, device=device).bool() # Should contain self-loop, because an agent should utilize its own info.
         adjacency = adjacency.to(device)
+        self.n_agent = n
         self.degree = adjacency.sum(dim=1) # Number of information available to the agent.
+        self.max_degree = self.degree.max().item()
+        self.uniform = bool((self.degree == self.max_degree).all())
         self.indices = []
         index_full = torch.arange(n, device=device)
         for i in range(n):
             self.indices.append(torch.masked_select(index_full, adjacency[i])) # Which agents are needed.
 
+        # padded gather: row i holds the neighbors of agent i in ascending order, followed by i itself as padding
+        self.pad_indices = index_full.unsqueeze(1).repeat(1, self.max_degree)
+        self.pad_mask = torch.zeros(n, self.max_degree, dtype=torch.bool, device=device)
+        for i in range(n):
+            self.pad_indices[i, :self.indices[i].numel()] = self.indices[i]
+            self.pad_mask[i, :self.indices[i].numel()] = True
+        self.flat_indices = self.pad_indices.view(-1)
+
+        # reductions: sum_j adj[i, j] * x[j]
+        self.adjacency = adjacency.float()
+        self.sparse = adjacency.float().mean().item() < sparse_threshold
+        if self.sparse:
+            self.adjacency = self.adjacency.to_sparse()
+
     def gather(self, tensor):
         """
         Input shape: [batch_size, n_agent, dim]
@@ -43,6 +70,19 @@ class MultiCollect:
         """
         return self._collect('gather', tensor)
 
+    def gather_padded(self, tensor):
+        """
+        Input shape: [batch_size, n_agent, dim]
+        Return shape: [batch_size, n_agent, max_degree*dim]
+        The first degree[i]*dim entries of agent i equal gather(tensor)[i], the rest are zeros.
+        """
+        tensor = self._reshape(tensor)
+        b, n, depth = tensor.shape
+        result = torch.index_select(tensor, dim=1, index=self.flat_indices).view(b, n, self.max_degree, depth)
+        if not self.uniform:
+            result = result * self.pad_mask.view(1, n, self.max_degree, 1).to(result.dtype)
+        return result.view(b, n, self.max_degree * depth)
+
     def reduce_mean(self, tensor):
         """
         Input shape: [batch_size, n_agent, dim]
@@ -57,6 +97,14 @@ class MultiCollect:
         """
         return self._collect('reduce_sum', tensor)
 
+    def _reshape(self, tensor):
+        tensor = tensor.to(self.device)
+        if len(tensor.shape) == 1:
+            tensor = tensor.unsqueeze(0)
+        if len(tensor.shape) == 2:
+            tensor = tensor.unsqueeze(-1)
+        return tensor
+
     def _collect(self, method, tensor):
         """
         Input shape: [batch_size, n_agent, dim]
@@ -64,32 +112,41 @@ class MultiCollect:
             gather: [[batch_size, dim_i] for i in range(n_agent)]
             reduce: [batch_size, n_agent, dim]  # same as input
         """
-        tensor = tensor.to(self.device)
-        if len(tensor.shape) == 1:
-            tensor = tensor.unsqueeze(0)
-        if len(tensor.shape) == 2:
-            tensor = tensor.unsqueeze(-1)
+        tensor = self._reshape(tensor)
         b, n, depth = tensor.shape
-        result = []
-        for i in range(n):
-            if method == 'gather':
-                result.append(torch.index_select(tensor, dim=1, index=self.indices[i]).view(b, -1))
-            elif method == 'reduce_mean':
-                result.append(torch.index_select(tensor, dim=1, index=self.indices[i]).mean(dim=1))
+        if method == 'gather':
+            result = torch.index_select(tensor, dim=1, index=self.flat_indices).view(b, n, self.max_degree * depth)
+            if self.uniform:
+                return list(result.unbind(dim=1))
+            return [result[:, i, :self.indices[i].numel() * depth] for i in range(n)]
+        if not tensor.is_floating_point():
+            # matmul is only defined for floating point, fall back to the masked padded gather
+            result = torch.index_select(tensor, dim=1, index=self.flat_indices).view(b, n, self.max_degree, depth)
+            result = (result * self.pad_mask.view(1, n, self.max_degree, 1).to(result.dtype)).sum(dim=2)
+        else:
+            adjacency = self.adjacency if self.adjacency.dtype == tensor.dtype else self.adjacency.to(tensor.dtype)
+            if self.sparse:
+                result = torch.sparse.mm(adjacency, tensor.permute(1, 0, 2).reshape(n, b * depth))
+                result = result.view(n, b, depth).permute(1, 0, 2)
             else:
-                result.append(torch.index_select(tensor, dim=1, index=self.indices[i]).sum(dim=1))
-        if method != 'gather':
-            result = torch.stack(result, dim=1)
+                result = torch.matmul(adjacency, tensor)
+        if method == 'reduce_mean':
+            result = result / self.degree.view(1, n, 1).to(result.dtype)
         return result
 
 class Trajectory:
-    def __init__(self, **kwargs):
+    def __init__(self, source=None, start=None, **kwargs):
         """
         Data are of size [T, n_agent, dim].
+        They are usually zero-copy views into a TrajectoryBuffer,
+        source = (batch, row) then records that the trajectory is row `row` of the padded batch `batch`.
+        start: the time index of the first step in its episode, None if unknown
         """
         self.names = ["s", "a", "r", "s1", "d", "logp"]
         self.dict = {name: kwargs[name] for name in self.names}
         self.length = self.dict["s"].size()[0]
+        self.source = source
+        self.start = start
     
     def getFraction(self, length, start=None):
         if self.length < length:
@@ -102,7 +159,7 @@ class Trajectory:
         if start < 0:
             start = 0
         new_dict = {name: self.dict[name][start:start+length] for name in self.names}
-        return Trajectory(**new_dict)
+        return Trajectory(start=None if self.start is None else self.start + start, **new_dict)
     
     def __getitem__(self, key):
         assert key in self.names
@@ -112,10 +169,61 @@ class Trajectory:
     def names(cls):
         return ["s", "a", "r", "s1", "d", "logp"]
 
+def collateTrajectories(trajs):
+    """
+    Returns the padded batch {name: [batch_size, T_max, n_agent, dim]} of a list of trajectories,
+    d is padded with True and the others with zeros.
+    If the trajectories have different lengths, valid [batch_size, T_max, n_agent, 1] marks the steps that are not padding,
+    and the padding of a trajectory starts with the s1 of its last step, from which AdvantageEstimator bootstraps.
+    If the trajectories are exactly the rows of one TrajectoryBuffer, its storage is returned without copying.
+    A batch that is already collated (a dict) is returned as it is.
+    """
+    if isinstance(trajs, dict):
+        return trajs
+    names = Trajectory.names()
+    source = trajs[0].source
+    if source is not None and len(trajs) == source[0]['s'].size()[0] and \
+        all(traj.source is not None and traj.source[0] is source[0] and traj.source[1] == i for i, traj in enumerate(trajs)):
+        return source[0]
+    max_traj_length = max([traj.length for traj in trajs])
+    batch = {}
+    for name in names:
+        item = trajs[0][name]
+        shape = [len(trajs), max_traj_length] + list(item.shape[1:])
+        if name == 'd':
+            batch[name] = torch.ones(shape, dtype=item.dtype, device=item.device)
+        else:
+            batch[name] = torch.zeros(shape, dtype=item.dtype, device=item.device)
+        for i, traj in enumerate(trajs):
+            batch[name][i, :traj.length] = traj[name]
+    if any(traj.length != max_traj_length for traj in trajs):
+        batch['valid'] = torch.zeros(batch['d'].shape, dtype=torch.bool, device=batch['d'].device)
+        for i, traj in enumerate(trajs):
+            batch['valid'][i, :traj.length] = True
+            if traj.length < max_traj_length:
+                batch['s'][i, traj.length] = traj['s1'][-1]
+    return batch
+
+def _validMask(batch):
+    """ The valid mask of a collated batch as floats [batch_size, T, n_agent, 1], all ones if it has no padding """
+    if 'valid' in batch:
+        return batch['valid'].float()
+    return torch.ones(batch['d'].shape, device=batch['d'].device)
+
 class TrajectoryBuffer:
-    def __init__(self, device="cpu"):
+    """
+    Columnar storage of a batch of trajectories that are stored step by step.
+    Each of s, a, r, s1, d, logp is one preallocated [batch_size, T_max, n_agent, dim] tensor,
+    allocated by the first store() and doubled if more than T_max steps are stored.
+    The trajectories retrieved are views into the storage, so a buffer should not be reused after retrieve().
+    start: the time index of the first step stored in its episode, None if unknown
+    """
+    def __init__(self, device="cpu", max_length=None, start=None):
         self.device = device
-        self.s, self.a, self.r, self.s1, self.d, self.logp = [], [], [], [], [], []
+        self.start = start
+        self.max_length = max_length if max_length is not None and max_length > 0 else 64
+        self.data = None
+        self.length = 0
     
     def store(self, s, a, r, s1, d, logp):
         """
@@ -134,49 +242,73 @@ class TrajectoryBuffer:
         if r.dim() <= 1:
             r = r.unsqueeze(0)
         r = r[:, :n]
-        [s, a, r, s1, d, logp] = [item.view(b, n, -1) for item in [s, a, r, s1, d, logp]]
-        self.s.append(s)
-        self.a.append(a)
-        self.r.append(r)
-        self.s1.append(s1)
-        self.d.append(d)
-        self.logp.append(logp)
+        items = dict(zip(Trajectory.names(), [item.view(b, n, -1) for item in [s, a, r, s1, d, logp]]))
+        if self.data is None:
+            self.data = {name: torch.empty([b, self.max_length] + list(item.shape[1:]), dtype=item.dtype, device=device)
+                         for name, item in items.items()}
+        elif self.length == self.max_length:
+            self.max_length *= 2
+            for name, value in self.data.items():
+                grown = torch.empty([b, self.max_length] + list(value.shape[2:]), dtype=value.dtype, device=device)
+                grown[:, :self.length] = value[:, :self.length]
+                self.data[name] = grown
+        for name, item in items.items():
+            self.data[name][:, self.length] = item
+        self.length += 1
+    
+    def retrieveBatch(self):
+        """
+        Returns the padded batch {name: [batch_size, T, n_agent, dim]} as views into the storage.
+        """
+        if self.data is None:
+            return None
+        if self.length < self.max_length:
+            # shrinks the storage once, so that the batch is contiguous
+            self.data = {name: value[:, :self.length].contiguous() for name, value in self.data.items()}
+            self.max_length = self.length
+        return dict(self.data)
     
     def retrieve(self, length=None):
         """
         Returns trajectories with s, a, r, s1, d, logp.
         Data are of size [T, n_agent, dim]
         """
-        names = ["s", "a", "r", "s1", "d", "logp"]
-        trajs = []
-        traj_all = {}
-        if self.s == []:
+        batch = self.retrieveBatch()
+        if batch is None:
             return []
-        for name in names:
-            traj_all[name] = torch.stack(self.__getattribute__(name), dim=1)
-        n = traj_all['s'].size()[0]
-        for i in range(n):
-            traj_dict = {}
-            for name in names:
-                traj_dict[name] = traj_all[name][i]  #ndecth batch into single traj
-            trajs.append(Trajectory(**traj_dict))
-        return trajs
+        n = batch['s'].size()[0]
+        return [Trajectory(source=(batch, i), start=self.start, **{name: value[i] for name, value in batch.items()}) for i in range(n)]
 
 class ModelBuffer:
-    def __init__(self, max_traj_num):
+    """
+    Fixed-capacity ring of up to max_traj_num trajectories, stored as one [max_traj_num, T_max, n_agent, dim] tensor
+    per field plus a lengths vector. T_max is set by the first trajectory stored and grown if a longer one arrives.
+    """
+    def __init__(self, max_traj_num, device="cpu"):
         self.max_traj_num = max_traj_num
-        self.trajectories = []
-        self.ptr = -1
+        self.device = device
+        self.data = None
+        self.lengths = torch.zeros(max_traj_num, dtype=torch.long, device=device)
+        self.min_length = 0
+        self.ptr = 0
         self.count = 0
     
     def storeTraj(self, traj):
-        if self.count < self.max_traj_num:
-            self.trajectories.append(traj)
-            self.ptr = (self.ptr + 1) % self.max_traj_num
-            self.count = min(self.count + 1, self.max_traj_num)
-        else:
-            self.trajectories[self.ptr] = traj
-            self.ptr = (self.ptr + 1) % self.max_traj_num
+        if self.data is None:
+            self.data = {name: torch.zeros([self.max_traj_num] + list(traj[name].shape), dtype=traj[name].dtype, device=self.device)
+                         for name in Trajectory.names()}
+        T_max = self.data['s'].size()[1]
+        if traj.length > T_max:
+            for name, value in self.data.items():
+                grown = torch.zeros([self.max_traj_num, traj.length] + list(value.shape[2:]), dtype=value.dtype, device=self.device)
+                grown[:, :T_max] = value
+                self.data[name] = grown
+        for name, value in self.data.items():
+            value[self.ptr, :traj.length] = traj[name]
+        self.lengths[self.ptr] = traj.length
+        self.ptr = (self.ptr + 1) % self.max_traj_num
+        self.count = min(self.count + 1, self.max_traj_num)
+        self.min_length = int(self.lengths[:self.count].min())
     
     def storeTrajs(self, trajs):
         for traj in trajs:
@@ -184,16 +316,44 @@ class ModelBuffer:
     
     def sampleTrajs(self, n_traj):
         traj_idxs = np.random.choice(range(self.count), size=(n_traj,), replace=True)
-        return [self.trajectories[i] for i in traj_idxs]
+        return [Trajectory(**{name: value[i, :int(self.lengths[i])] for name, value in self.data.items()}) for i in traj_idxs]
+
+    def sampleBatch(self, batch_size, length):
+        """
+        Samples batch_size random windows [start, start+length) of the stored trajectories with one gather per field.
+        length is clipped to the shortest trajectory stored.
+        Returns {name: [batch_size, length, n_agent, dim]}.
+        """
+        length = min(length, self.min_length)
+        idxs = torch.randint(low=0, high=self.count, size=(batch_size,), device=self.device)
+        start_max = self.lengths[idxs] - length
+        starts = (torch.rand(batch_size, device=self.device) * (start_max + 1).float()).long()
+        steps = starts.unsqueeze(1) + torch.arange(length, device=self.device).unsqueeze(0) # [batch_size, length]
+        idxs = idxs.unsqueeze(1)
+        return {name: value[idxs, steps] for name, value in self.data.items()}
+
+    def state_dict(self):
+        return {'data': self.data, 'lengths': self.lengths, 'min_length': self.min_length, 'ptr': self.ptr, 'count': self.count}
+
+    def load_state_dict(self, state_dict):
+        if state_dict['data'] is not None:
+            self.data = {name: value.to(self.device) for name, value in state_dict['data'].items()}
+        self.lengths = state_dict['lengths'].to(self.device)
+        self.min_length = state_dict['min_length']
+        self.ptr = state_dict['ptr']
+        self.count = state_dict['count']
 
 class OnPolicyRunner:
     def __init__(self, logger, run_args, alg_args, agent, env_learn, env_test, **kwargs):
         self.logger = logger
         self.name = run_args.name
+        checkpoint = None
         if not run_args.init_checkpoint is None:
-            agent.load(run_args.init_checkpoint)
+            checkpoint = loadCheckpoint(run_args.init_checkpoint)
+            agent.load(checkpoint)
             logger.log(interaction=run_args.start_step)  
         self.start_step = run_args.start_step 
+        self.start_iter = 0
 
         # algorithm arguments
         self.n_iter = alg_args.n_iter
@@ -207,6 +367,7 @@ class OnPolicyRunner:
         self.test_length = alg_args.test_length
         self.max_episode_len = alg_args.max_episode_len
         self.clip_scheme = None if (not hasattr(alg_args, "clip_scheme")) else alg_args.clip_scheme
+        self.async_rollout = False if (not hasattr(alg_args, "async_rollout")) else alg_args.async_rollout
         
         # agent initialization
         self.agent = agent
@@ -225,28 +386,76 @@ class OnPolicyRunner:
             self.n_traj = alg_args.n_traj
             self.model_traj_length = alg_args.model_traj_length
             self.model_error_thres = alg_args.model_error_thres
-            self.model_buffer = ModelBuffer(alg_args.model_buffer_size)
+            self.model_buffer = ModelBuffer(alg_args.model_buffer_size, device=self.device)
             self.model_update_length = alg_args.model_update_length
             self.model_validate_interval = alg_args.model_validate_interval
             self.model_length_schedule = alg_args.model_length_schedule
             self.model_prob = alg_args.model_prob
+            model_mask_done = False if (not hasattr(alg_args, "model_mask_done")) else alg_args.model_mask_done
+            model_uncertainty_thres = None if (not hasattr(alg_args, "model_uncertainty_thres")) else alg_args.model_uncertainty_thres
+            self.model_rollout = ModelRollout(self.agent, device=self.device, mask_done=model_mask_done, uncertainty_thres=model_uncertainty_thres)
         self.s, self.episode_len, self.episode_reward = self.env_learn.reset(), 0, 0
 
+        # acts with the compiled policy of the agent (see exportPolicy) instead of agent.act()
+        compiled_policy = False if (not hasattr(alg_args, "compiled_policy")) else alg_args.compiled_policy
+        self.policy = exportPolicy(self.agent) if compiled_policy else None
+
+        # parallel test episodes, on n_test_env environments built by env_fn_test
+        self.evaluator = None
+        n_test_env = 0 if (not hasattr(alg_args, "n_test_env")) else alg_args.n_test_env
+        if n_test_env > 0 and kwargs.get('env_fn_test') is not None:
+            test_seeds = list(range(self.n_test)) if (not hasattr(alg_args, "test_seeds")) else alg_args.test_seeds
+            async_test = False if (not hasattr(alg_args, "async_test")) else alg_args.async_test
+            self.evaluator = Evaluator(kwargs['env_fn_test'], self.agent, self.n_test, self.test_length, test_seeds, n_test_env,
+                                       device=self.device, recorder_path=f"checkpoints/{self.name}/test", background=async_test,
+                                       compiled=compiled_policy)
+
+        # resumes the iterations, the counters and the buffers
+        if checkpoint is not None and self.stateKey() in checkpoint:
+            self.load_state_dict(checkpoint[self.stateKey()])
+
         # load pretrained model
         self.load_pretrained_model = alg_args.load_pretrained_model
         if self.model_based and self.load_pretrained_model:
-            self.agent.load_model(alg_args.pretrained_model)
+            self.agent.load_model(alg_args.pretrained_model, getattr(alg_args, 'pretrained_modules', None))
+
+    def stateKey(self):
+        return f"{self.logger.prefix}/runner"
+
+    def state_dict(self):
+        state_dict = {'iter': self.iter, 'counters': dict(self.logger.buffer)}
+        if self.model_based:
+            state_dict['model_buffer'] = self.model_buffer.state_dict()
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        self.start_iter = state_dict['iter']
+        self.logger.buffer.update(state_dict['counters'])
+        if self.model_based and 'model_buffer' in state_dict:
+            self.model_buffer.load_state_dict(state_dict['model_buffer'])
+
+    def save(self, info=None):
+        # the runner state is written with the next checkpoint of the agent
+        self.logger.save(self, key=self.stateKey(), flush=False)
+        self.agent.save(info=info)
+        if self.policy is not None:
+            # the latest policy, for PolicyController
+            torch.jit.save(updatePolicy(self.policy, self.agent), f"checkpoints/{self.name}/policy.pt")
 
     def run(self):
-        if self.model_based and not self.load_pretrained_model:
+        if self.model_based and not self.load_pretrained_model and self.start_iter == 0:
             for _ in trange(self.n_warmup):
                 trajs = self.rollout_env()
                 self.model_buffer.storeTrajs(trajs)
             self.updateModel(self.n_model_update_warmup) # Sample trajectories, then shorten them.
-        for iter in trange(self.n_iter):
+        for iter in trange(self.start_iter, self.n_iter):
+            self.iter = iter
             if iter % self.test_interval == 0:
                 mean_return = self.test()
-                self.agent.save(info = mean_return)
+                if self.evaluator is not None and self.evaluator.background:
+                    # the result is the one of the weights of the previous test, not of the weights saved here
+                    mean_return = None
+                self.save(info = mean_return)
             trajs = self.rollout_env()  #  TO cheak: rollout n_step, maybe multi trajs
             if self.model_based:
                 self.model_buffer.storeTrajs(trajs)
@@ -271,30 +480,45 @@ class OnPolicyRunner:
                 if self.agent.checkConverged(agentInfo):
                     break
             self.logger.log(inner_iter = inner + 1, iter=iter)
+        if self.evaluator is not None:
+            result = self.evaluator.result(wait=True)
+            if result is not None:
+                self._logTest(result, 0)
+            self.evaluator.close()
 
     def test(self):
         """
         The environment should return sth like [n_agent, dim] or [batch_size, n_agent, dim] in either numpy or torch.
+        With an Evaluator, the episodes run in parallel.
+        If it runs in the background, this starts the test of the current weights and returns the result of the previous one (None the first time).
         """
         time_t = time.time()
+        if self.evaluator is not None:
+            if self.evaluator.background:
+                result = self.evaluator.result(wait=True)
+                self.evaluator.evaluate()
+            else:
+                result = self.evaluator.evaluate()
+            if result is None:
+                return None
+            return self._logTest(result, time.time()-time_t)
         length = self.test_length
         returns = []
         scaled = []
         lengths = []
-        episodes = []
+        recorder = EpisodeRecorder(f"checkpoints/{self.name}/test", self.n_test, length)
         for i in trange(self.n_test):
-            episode = []
             env = self.env_test
             env.reset()
             d, ep_ret, ep_len = np.array([False]), 0, 0
             while not(d.any() or (ep_len == length)):
                 s = env.get_state_() # dim = 2 or 3 (vectorized)
                 s = torch.as_tensor(s, dtype=torch.float, device=self.device)
-                a = self.agent.act(s).sample() # a is a tensor
+                a = self._act(s)[0] # a is a tensor
                 a = a.detach().cpu().numpy() # might not be squeezed at the last dimension. env should deal with this though.
                 s1, r, d, _ = env.step(a)
-                episode += [(s.tolist(), a.tolist(), r.tolist())]
                 d = np.array(d)
+                recorder.store(i, s=s, a=a, r=r, d=d)
                 ep_ret += r.sum()
                 ep_len += 1
                 self.logger.log(interaction=None)
@@ -303,7 +527,7 @@ class OnPolicyRunner:
                 ep_ret = env.rescaleReward(ep_ret, ep_len)
             returns += [ep_ret]
             lengths += [ep_len]
-            episodes += [episode]
+        recorder.close()
         returns = np.stack(returns, axis=0)
         lengths = np.stack(lengths, axis=0)
         self.logger.log(test_episode_reward=returns, test_episode_len=lengths, test_round=None)
@@ -311,16 +535,20 @@ class OnPolicyRunner:
         print(f"{self.n_test} episodes average accumulated reward: {returns.mean()}")
         if hasattr(env, 'rescaleReward'):
             print(f"scaled reward {np.mean(scaled)}")
-        with open(f"checkpoints/{self.name}/test.pickle", "wb") as f:
-            pickle.dump(episodes, f)
-        with open(f"checkpoints/{self.name}/test.txt", "w") as f:
-            for episode in episodes:
-                for step in episode:
-                    f.write(f"{step[0]}, {step[1]}, {step[2]}\n")
-                f.write("\n")
         self.logger.log(test_time=time.time()-time_t)
         return returns.mean()
 
+    def _logTest(self, result, test_time):
+        returns, lengths = result['returns'], result['lengths']
+        self.logger.count('interaction', int(lengths.sum()))
+        self.logger.log(test_episode_reward=returns, test_episode_len=lengths, test_round=None)
+        print(returns)
+        print(f"{self.n_test} episodes average accumulated reward: {returns.mean()}")
+        if result['scaled'] is not None:
+            print(f"scaled reward {np.mean(result['scaled'])}")
+        self.logger.log(test_time=test_time)
+        return returns.mean()
+
     def rollout_env(self, length = 0):
         """
         The environment should return sth like [n_agent, dim] or [batch_size, n_agent, dim] in either numpy or torch.
@@ -328,41 +556,139 @@ class OnPolicyRunner:
         time_t = time.time()
         if length <= 0:
             length = self.rollout_length
+        if self.policy is not None:
+            updatePolicy(self.policy, self.agent)
+        if self.async_rollout and self._canRolloutAsync():
+            return self._rollout_env_async(length, time_t)
         env = self.env_learn
         trajs = []
-        traj = TrajectoryBuffer(device=self.device)
+        timing = {'inference': 0., 'env': 0., 'store': 0.}
+        traj = TrajectoryBuffer(device=self.device, max_length=min(length, self.max_episode_len), start=self.episode_len)
         for t in range(length):
+            time_phase = time.time()
             s = env.get_state_()
             s = torch.as_tensor(s, dtype=torch.float, device=self.device)
-            dist = self.agent.act(s)
-            a = dist.sample()
-            logp = dist.log_prob(a)
+            a, logp = self._act(s)
             a = a.detach().cpu().numpy()
+            timing['inference'] += time.time() - time_phase
+            time_phase = time.time()
             s1, r, d, _ = env.step(a)
+            timing['env'] += time.time() - time_phase
+            time_phase = time.time()
             traj.store(s, a, r, s1, d, logp)
-            episode_r = r
-            if hasattr(env, '_comparable_reward'):
-                episode_r = env._comparable_reward()
-            if episode_r.ndim > 1:
-                episode_r = episode_r.mean(axis=0)
-            self.episode_reward += episode_r
-            self.episode_len += 1
-            self.logger.log(interaction=None)
-            if self.episode_len == self.max_episode_len:
-                d = np.zeros(d.shape, dtype=np.float32)
-            d = np.array(d)
-            #if d.any() or (self.episode_len == self.max_episode_len):
-            if self.episode_len == self.max_episode_len:
-                self.logger.log(episode_reward=self.episode_reward.sum(), episode_len = self.episode_len, episode=None)
-                try:
-                    _, self.episode_reward, self.episode_len = self.env_learn.reset(), 0, 0#TODO:catch up the error
-                except Exception as e:
-                    print('reset error!:', e)
-                    _, self.episode_reward, self.episode_len = self.env_learn.reset(), 0, 0  # TODO:catch up the error
+            timing['store'] += time.time() - time_phase
+            if self._endStep(env, r):
+                trajs += traj.retrieve()
+                traj = TrajectoryBuffer(device=self.device, max_length=min(length, self.max_episode_len), start=self.episode_len)
+        trajs += traj.retrieve(length=self.max_episode_len)
+        self.logger.log(env_rollout_time=time.time()-time_t, **{f"env_rollout_{name}_time": value for name, value in timing.items()})
+        return trajs
+
+    def _act(self, s):
+        """
+        Returns the sampled actions and their log probs
+        """
+        if self.policy is not None:
+            with torch.no_grad():
+                return self.policy(s)
+        dist = self.agent.act(s)
+        a = dist.sample()
+        return a, dist.log_prob(a)
+
+    def _endStep(self, env, r):
+        """
+        Episode bookkeeping after each step, resets the environment at the end of an episode.
+        Returns whether the episode has ended.
+        """
+        episode_r = r
+        if hasattr(env, '_comparable_reward'):
+            episode_r = env._comparable_reward()
+        if episode_r.ndim > 1:
+            episode_r = episode_r.mean(axis=0)
+        self.episode_reward += episode_r
+        self.episode_len += 1
+        self.logger.log(interaction=None)
+        #if d.any() or (self.episode_len == self.max_episode_len):
+        if self.episode_len == self.max_episode_len:
+            self.logger.log(episode_reward=self.episode_reward.sum(), episode_len = self.episode_len, episode=None)
+            try:
+                _, self.episode_reward, self.episode_len = self.env_learn.reset(), 0, 0#TODO:catch up the error
+            except Exception as e:
+                print('reset error!:', e)
+                _, self.episode_reward, self.episode_len = self.env_learn.reset(), 0, 0  # TODO:catch up the error
+            return True
+        return False
+
+    def _canRolloutAsync(self):
+        """ _rollout_env_async() needs two non-empty halves of environments that can be stepped asynchronously """
+        env = self.env_learn
+        return hasattr(env, 'step_async') and hasattr(env, 'step_wait') and getattr(env, 'n_env', 1) >= 2
+
+    def _rollout_env_async(self, length, time_t):
+        """
+        rollout_env() with the vectorized environments split into two halves (EnvPool-like):
+        the policy computes the actions of one half while the other half is being stepped.
+        Requires an environment with step_async() and step_wait(), e.g. SubprocVectorizedEnv with n_env >= 2,
+        rollout_env() falls back to the synchronous rollout otherwise.
+        The env time is the time spent waiting for a half, the dispatch time the one of step_async(),
+        which includes stepping a local environment of this process.
+        """
+        env = self.env_learn
+        n_env = env.n_env
+        halves = [list(range(n_env // 2)), list(range(n_env // 2, n_env))]
+        trajs = []
+        timing = {'inference': 0., 'dispatch': 0., 'env': 0., 'store': 0.}
+        traj = TrajectoryBuffer(device=self.device, max_length=min(length, self.max_episode_len), start=self.episode_len)
+
+        def act(s):
+            time_phase = time.time()
+            s = torch.as_tensor(s, dtype=torch.float, device=self.device)
+            a, logp = self._act(s)
+            timing['inference'] += time.time() - time_phase
+            return s, a.detach().cpu().numpy(), logp
+
+        def dispatch(a, half):
+            time_phase = time.time()
+            env.step_async(a, half)
+            timing['dispatch'] += time.time() - time_phase
+
+        def wait(half):
+            time_phase = time.time()
+            result = env.step_wait(half)
+            timing['env'] += time.time() - time_phase
+            return result
+
+        s = env.get_state_()
+        pending = None # the first half, already being stepped
+        for t in range(length):
+            if pending is None:
+                s0, a0, logp0 = act(s[halves[0]])
+                dispatch(a0, halves[0])
+            else:
+                s0, a0, logp0 = pending
+            s1_, a1, logp1 = act(s[halves[1]]) # overlaps with the first half
+            dispatch(a1, halves[1])
+            s1_0, r0, d0, _ = wait(halves[0])
+            pending = None
+            last_step = t == length - 1 or self.episode_len + 1 == self.max_episode_len
+            if not last_step:
+                pending = act(s1_0) # overlaps with the second half
+                dispatch(pending[1], halves[0])
+            s1_1, r1, d1, _ = wait(halves[1])
+
+            time_phase = time.time()
+            s1 = np.concatenate([s1_0, s1_1], axis=0)
+            r = np.concatenate([r0, r1], axis=0)
+            d = np.concatenate([d0, d1], axis=0)
+            traj.store(torch.cat([s0, s1_], dim=0), np.concatenate([a0, a1], axis=0), r, s1, d, torch.cat([logp0, logp1], dim=0))
+            timing['store'] += time.time() - time_phase
+            s = s1
+            if self._endStep(env, r):
                 trajs += traj.retrieve()
-                traj = TrajectoryBuffer(device=self.device)
+                traj = TrajectoryBuffer(device=self.device, max_length=min(length, self.max_episode_len), start=self.episode_len)
+                s = env.get_state_()
         trajs += traj.retrieve(length=self.max_episode_len)
-        self.logger.log(env_rollout_time=time.time()-time_t)
+        self.logger.log(env_rollout_time=time.time()-time_t, **{f"env_rollout_{name}_time": value for name, value in timing.items()})
         return trajs
     
     def rollout_model(self, trajs, length=0):
@@ -370,48 +696,41 @@ class OnPolicyRunner:
         n_traj = self.n_traj
         if length <= 0:
             length = self.model_traj_length
-        s = [traj['s'] for traj in trajs]
-        s = torch.stack(s, dim=0)
+        s = collateTrajectories(trajs)['s']
         b, T, n, depth = s.shape
-        s = s.view(-1, n, depth)
-        idxs = torch.randint(low=0, high=b * T, size=(n_traj,), device=self.device)
+        s = s.reshape(-1, n, depth)
+        idxs = torch.randint(low=0, high=b * T, size=(n_traj,), device=s.device)
         s = s.index_select(dim=0, index=idxs)
         # s.dim() == 3
-
-        trajs = TrajectoryBuffer(device=self.device)
-        for _ in range(length):
-            #a, logp = self.agent.act(s, requires_log=True)
-            dist = self.agent.act(s)
-            a = dist.sample()
-            logp = dist.log_prob(a)
-            r, s1, d, _ = self.agent.model_step(s, a)
-            trajs.store(s, a, r, s1, d, logp)
-            s = s1
-        trajs = trajs.retrieve()
-        self.logger.log(model_rollout_time=time.time()-time_t)
-        return trajs
+        t = None # the time index of each s in its episode, for the reward oracle
+        if not isinstance(trajs, dict) and all(traj.start is not None for traj in trajs):
+            starts = torch.tensor([traj.start for traj in trajs], dtype=torch.long, device=s.device)
+            t = starts.index_select(0, idxs // T) + idxs % T
+
+        batch, n_step = self.model_rollout(s, length, t=t)
+        self.logger.log(model_rollout_time=time.time()-time_t, model_rollout_len=n_step / n_traj)
+        return batch
     
     def updateModel(self, n=0):
         if n <= 0:
             n = self.n_model_update
+        # one bootstrap batch per member of the model ensemble
+        batch_size = self.model_batch_size * getattr(self.agent, "n_ensemble", 1)
         for i_model_update in trange(n):
-            trajs = self.model_buffer.sampleTrajs(self.model_batch_size)
-            trajs = [traj.getFraction(length=self.model_update_length) for traj in trajs]
-            self.agent.updateModel(trajs, length=self.model_update_length)
+            batch = self.model_buffer.sampleBatch(batch_size, self.model_update_length)
+            self.agent.updateModel(batch, length=self.model_update_length)
             if i_model_update % self.model_validate_interval == 0:
-                validate_trajs = self.model_buffer.sampleTrajs(self.model_batch_size)
-                validate_trajs = [traj.getFraction(length=self.model_update_length) for traj in validate_trajs]
-                rel_error = self.agent.validateModel(validate_trajs, length=self.model_update_length)
+                validate_batch = self.model_buffer.sampleBatch(batch_size, self.model_update_length)
+                rel_error = self.agent.validateModel(validate_batch, length=self.model_update_length)
                 if rel_error < self.model_error_thres:
                     break
         self.logger.log(model_update = i_model_update + 1)
     
     def testModel(self, n = 0):
-        trajs = self.model_buffer.sampleTrajs(self.model_batch_size)
-        trajs = [traj.getFraction(length=self.model_update_length) for traj in trajs]
-        return self.agent.validateModel(trajs, length=self.model_update_length)
+        batch = self.model_buffer.sampleBatch(self.model_batch_size * getattr(self.agent, "n_ensemble", 1), self.model_update_length)
+        return self.agent.validateModel(batch, length=self.model_update_length)
 
-class IA2C(nn.ModuleList):
+class IA2C(TrajectoryProcessor, nn.ModuleList):
     def __init__(self, logger, device, agent_args, **kwargs):
         super().__init__()
         self.logger = logger
@@ -430,6 +749,7 @@ class IA2C(nn.ModuleList):
         self.n_update_v = agent_args.n_update_v
         self.n_update_pi = agent_args.n_update_pi
         self.n_minibatch = agent_args.n_minibatch
+        self.minibatch = MinibatchEngine.fromArgs(agent_args)
         self.use_reduced_v = agent_args.use_reduced_v
         self.use_rtg = agent_args.use_rtg
         self.use_gae_returns = agent_args.use_gae_returns
@@ -457,8 +777,11 @@ class IA2C(nn.ModuleList):
         self.radius_pi = agent_args.radius_pi
         self.pi_args = agent_args.pi_args
         self.v_args = agent_args.v_args
+        self.stacked = False if (not hasattr(agent_args, "stacked")) else agent_args.stacked
         self.collect_pi, self.actors = self._init_actors()
         self.collect_v, self.vs = self._init_vs()
+        self.advantage_estimator = AdvantageEstimator(self.gamma, self.lamda, self.use_rtg, self.use_gae_returns,
+                                                      self.advantage_norm, reduce=self.collect_v.reduce_sum)
 
         self.optimizer_v = Adam(self.vs.parameters(), lr=self.lr_v)
         self.optimizer_pi = Adam(self.actors.parameters(), lr=self.lr)
@@ -475,16 +798,8 @@ class IA2C(nn.ModuleList):
             a = a.unsqueeze(0)
         while a.dim() < s.dim():
             a = a.unsqueeze(-1)
-        s = self.collect_pi.gather(s)
-        # Now s[i].dim() == 2, a.dim() == 3
-        log_prob = []
-        for i in range(self.n_agent):
-            if self.discrete:
-                probs = self.actors[i](s[i])
-                log_prob.append(torch.log(torch.gather(probs, dim=-1, index=torch.select(a, dim=1, index=i).long())))
-            else:
-                log_prob.append(self.actors[i](s[i], a.select(dim=1, index=i)))
-        log_prob = torch.stack(log_prob, dim=1)
+        # Now a.dim() == 3
+        log_prob = self._evalPi(s, a)
         while log_prob.dim() < 3:
             log_prob = log_prob.unsqueeze(-1)
         return log_prob
@@ -500,64 +815,18 @@ class IA2C(nn.ModuleList):
             while s.dim() <= 2:
                 s = s.unsqueeze(0)
             s = s.to(self.device)
-            s = self.collect_pi.gather(s)  # all state into [ self +  ]
-            # Now s[i].dim() == 2 ([batch_size, dim])
 
             if self.discrete:
-                probs = []
-                for i in range(self.n_agent):
-                    probs.append(self.actors[i](s[i]))
-                probs = torch.stack(probs, dim=1)
+                probs = self._evalPi(s)
                 return Categorical(probs)
             else:
-                means, stds = [], []
-                for i in range(self.n_agent):
-                    mean, std = self.actors[i](s[i])
-                    means.append(mean)
-                    stds.append(std)
-                means = torch.stack(means, dim=1)
-                stds = torch.stack(stds, dim=1)
+                means, stds = self._evalPi(s)
                 while means.dim() > dim:
                     means = means.squeeze(0)
                     stds = stds.squeeze(0)
                 return Normal(means, stds)
 
 
-    def _process_traj(self, s, a, r, s1, d, logp):
-        """
-        Input are all in shape [batch_size, T, n_agent, dim]
-        """
-        with torch.no_grad():
-            b, T, n, dim_s = s.shape
-            s, a, r, s1, d, logp = [item.to(self.device) for item in [s, a, r, s1, d, logp]]
-            value = self._evalV(s.view(-1, n, dim_s)).view(b, T, n, -1)
-
-            returns = torch.zeros(value.size(), device=self.device)
-            deltas, advantages = torch.zeros_like(returns), torch.zeros_like(returns)
-            prev_value = self._evalV(s1.select(1, T - 1))
-            if not self.use_rtg:
-                prev_return = prev_value
-            else:
-                prev_return = torch.zeros_like(prev_value)
-            prev_advantage = torch.zeros_like(prev_return)
-            d_mask = d.float()
-            for t in reversed(range(T)):
-                deltas[:, t, :, :]= r.select(1, t) + self.gamma * (1-d_mask.select(1,t)) * prev_value - value.select(1, t).detach()
-                advantages[:, t, :, :] = deltas.select(1, t) + self.gamma * self.lamda * (1-d_mask.select(1,t)) * prev_advantage
-                if self.use_gae_returns:
-                    returns[:, t, :, :] = value.select(1, t).detach() + advantages.select(1, t)
-                else:
-                    returns[:, t, :, :] = r.select(1, t) + self.gamma * (1-d_mask.select(1, t)) * prev_return
-
-                prev_return = returns.select(1, t)
-                prev_value = value.select(1, t)
-                prev_advantage = advantages.select(1, t)
-            reduced_advantages = self.collect_v.reduce_sum(advantages.view(-1, n, 1)).view(advantages.size())
-            if self.advantage_norm and reduced_advantages.size()[1] > 1:
-                reduced_advantages = (reduced_advantages - reduced_advantages.mean(dim=1, keepdim=True)) / (reduced_advantages.std(dim=1, keepdim=True) + 1e-5)
-                advantages = (advantages - advantages.mean(dim=1, keepdim=True)) / (advantages.std(dim=1, keepdim=True) + 1e-5)
-        return value, returns, advantages, reduced_advantages
-
     def load(self):
         # set  run_args.init_checkpoint  = None
         pass
@@ -569,9 +838,59 @@ class IA2C(nn.ModuleList):
     def save(self, info=None):
         self.logger.save(self, info=info)
 
+    def unstackedStateDict(self):
+        """
+        Returns the state_dict with the per-agent networks in the nn.ModuleList layout,
+        i.e. a checkpoint loadable by a non-stacked agent. Stacked agents load both layouts.
+        """
+        state_dict = self.state_dict()
+        if self.stacked:
+            for name in ['actors', 'vs']:
+                state_dict = {key: value for key, value in state_dict.items() if not key.startswith(name + '.')}
+                state_dict.update(unstackStateDict(getattr(self, name), prefix=name + '.'))
+        return state_dict
+
+    def _evalPi(self, s, a=None):
+        """
+        Requires input in shape [-1, n_agent, dim].
+        Returns the actor outputs stacked at dim 1, i.e. probs (discrete) or (means, stds) (continuous),
+        or the log probability of a if it is given.
+        """
+        if self.stacked:
+            s = self.collect_pi.gather_padded(s) # [batch_size, n_agent, max_degree*dim], evaluated in one batched op
+            if a is None:
+                return self.actors(s)
+            if self.discrete:
+                return torch.log(torch.gather(self.actors(s), dim=-1, index=a.long()))
+            return self.actors(s, a)
+        s = self.collect_pi.gather(s) # all state into [ self +  ]
+        # Now s[i].dim() == 2 ([batch_size, dim])
+        if a is not None:
+            log_prob = []
+            for i in range(self.n_agent):
+                if self.discrete:
+                    probs = self.actors[i](s[i])
+                    log_prob.append(torch.log(torch.gather(probs, dim=-1, index=torch.select(a, dim=1, index=i).long())))
+                else:
+                    log_prob.append(self.actors[i](s[i], a.select(dim=1, index=i)))
+            return torch.stack(log_prob, dim=1)
+        if self.discrete:
+            probs = []
+            for i in range(self.n_agent):
+                probs.append(self.actors[i](s[i]))
+            return torch.stack(probs, dim=1)
+        means, stds = [], []
+        for i in range(self.n_agent):
+            mean, std = self.actors[i](s[i])
+            means.append(mean)
+            stds.append(std)
+        return torch.stack(means, dim=1), torch.stack(stds, dim=1)
+
     def _evalV(self, s):
         # Requires input in shape [-1, n_agent, dim]
         s = s.to(self.device)
+        if self.stacked:
+            return self.vs(self.collect_v.gather_padded(s))
         s = self.collect_v.gather(s)
         values = []
         for i in range(self.n_agent):
@@ -580,6 +899,13 @@ class IA2C(nn.ModuleList):
 
     def _init_actors(self):
         collect_pi = MultiCollect(torch.matrix_power(self.adj, self.radius_pi), device=self.device)
+        if self.stacked:
+            self.pi_args.sizes[0] = [degree * self.observation_dim for degree in collect_pi.degree.tolist()]
+            if self.discrete:
+                actors = StackedCategoricalActor(self.n_agent, **self.pi_args._toDict())
+            else:
+                actors = StackedGaussianActor(self.n_agent, action_dim=self.action_dim, **self.pi_args._toDict())
+            return collect_pi, actors.to(self.device)
         actors = nn.ModuleList()
         for i in range(self.n_agent):
             self.pi_args.sizes[0] = collect_pi.degree[i] * self.observation_dim
@@ -591,6 +917,9 @@ class IA2C(nn.ModuleList):
 
     def _init_vs(self):
         collect_v = MultiCollect(torch.matrix_power(self.adj, self.radius_v), device=self.device)
+        if self.stacked:
+            self.v_args.sizes[0] = [degree * self.observation_dim for degree in collect_v.degree.tolist()]
+            return collect_v, StackedMLP(self.n_agent, **self.v_args._toDict()).to(self.device)
         vs = nn.ModuleList()
         for i in range(self.n_agent):
             self.v_args.sizes[0] = collect_v.degree[i] * self.observation_dim
@@ -598,93 +927,77 @@ class IA2C(nn.ModuleList):
             vs.append(v_fn(**self.v_args._toDict()))
         return collect_v, vs
 
+    def _lossV(self, s, returns, valid):
+        loss_v = maskedMean((self._evalV(s) - returns) ** 2, valid)
+        return loss_v, {}
+
+    def _lossActor(self, s, a, advantages, valid, entropy_coeff):
+        # - A * logp - entropy_loss
+        logp_new = self.get_logp(s, a)
+        loss_pi = maskedMean(- advantages * logp_new, valid)
+        loss_entropy = - maskedMean(logp_new, valid)
+        loss_actor = loss_pi + loss_entropy * entropy_coeff
+        return loss_actor, {'pi_loss': loss_pi, 'entropy': loss_entropy}
+
     def updateAgent(self, trajs, clip=None):
+        """
+        n_update_v value epochs, then n_update_pi policy epochs on the advantages of the updated critic (see MinibatchEngine)
+        """
         time_t = time.time()
         if clip is None:
             clip = self.clip
-        n_minibatch = self.n_minibatch
-
-        names = Trajectory.names()
-        traj_all = {name:[] for name in names}
-        max_traj_length = max([i.length for i in trajs])
-        for traj in trajs:
-            for name in names:
-                tensor_shape = traj[name].shape
-                full_part_shape = [max_traj_length - tensor_shape[0]] + list(tensor_shape[1:])
-                if name == 'd':
-                    traj_all[name].append(torch.cat([traj[name], torch.ones(full_part_shape, dtype=torch.bool)], dim = 0))
-                else:
-                    traj_all[name].append(torch.cat([traj[name], torch.zeros(full_part_shape, dtype=traj[name].dtype)], dim = 0))
-        # should be 4-dim [batch * step * n_agent * dim]
-        traj = {name:torch.stack(value, dim=0) for name, value in traj_all.items()}
 
-
-        s, a, r, s1, d, logp = traj['s'], traj['a'], traj['r'], traj['s1'], traj['d'], traj['logp']
-        s, a, r, s1, d, logp = [item.to(self.device) for item in [s, a, r, s1, d, logp]]
+        traj = collateTrajectories(trajs)
+        s, a, r, logp = [traj[key].to(self.device) for key in ['s', 'a', 'r', 'logp']]
         # all in shape [batch_size, T, n_agent, dim]
         value_old, returns, advantages, reduced_advantages = self._process_traj(**traj)
 
-        advantages_old = reduced_advantages if self.use_reduced_v else advantages #  set use_reduced_v as False
-
         b, T, n, d_s = s.size()
         d_a = a.size()[-1]
         s = s.view(-1, n, d_s)
         a = a.view(-1, n, d_a)
         logp = logp.view(-1, n, 1)
-        advantages_old = advantages_old.view(-1, n, 1)
         returns = returns.view(-1, n, 1)
         value_old = value_old.view(-1, n, 1)
+        valid = _validMask(traj).to(self.device).view(-1, n, 1)
         # s, a, logp, adv, ret, v are now all in shape [-1, n_agent, dim]
 
-        batch_total = logp.size()[0]
-        batch_size = int(batch_total/n_minibatch)
-
         # critic update
+        i_v = 0
+        converged = False
         for i_v in range(self.n_update_v):
-            batch_returns = returns
-            batch_state = s
-            if n_minibatch > 1:
-                idxs = np.random.randint(0, len(batch_total), size=batch_size)
-                [batch_returns, batch_state] = [item[idxs] for item in [batch_returns, batch_state]]
-            batch_v_new = self._evalV(batch_state)
-            loss_v = ((batch_v_new - batch_returns) ** 2).mean()
-            self.optimizer_v.zero_grad()
-            loss_v.backward()
-            self.optimizer_v.step()
-            var_v = ((batch_returns - batch_returns.mean()) ** 2).mean()
-            rel_v_loss = loss_v / (var_v + 1e-8)
-            self.logger.log(v_loss=loss_v, v_update=None, v_var=var_v, rel_v_loss=rel_v_loss)
-            if rel_v_loss < self.v_thres:
+            for batch_state, batch_returns, batch_valid in self.minibatch.epoch(s, returns, valid):
+                loss_v, _ = self.minibatch.step(self.optimizer_v, self._lossV, [batch_state, batch_returns], valid=batch_valid)
+                var_v = maskedMean((batch_returns - maskedMean(batch_returns, batch_valid)) ** 2, batch_valid)
+                rel_v_loss = loss_v / (var_v + 1e-8)
+                self.logger.log(v_loss=loss_v, v_update=None, v_var=var_v, rel_v_loss=rel_v_loss)
+                if rel_v_loss < self.v_thres:
+                    converged = True
+                    break
+            if converged:
                 break
         self.logger.log(v_update_step=i_v)
 
 
         # use the updated value
-        _, _, advantages, _ = self._process_traj(**traj)
+        _, _, advantages, reduced_advantages = self._process_traj(**traj)
         advantages_old = reduced_advantages if self.use_reduced_v else advantages  # set use_reduced_v as False
         advantages_old = advantages_old.view(-1, n, 1)
 
 
         # actor update
         i_pi = 0
+        updata_entropy_coff = max(self.entropy_coeff - self.entropy_coeff_decay * self.logger.buffer['interaction'], 0)
+        loss_actor = lambda *chunk: self._lossActor(*chunk, updata_entropy_coff)
         for i_pi in range(self.n_update_pi):
-            batch_state, batch_action, batch_logp, batch_advantages_old = [s, a, logp, advantages_old]
-            if n_minibatch > 1:
-                idxs = np.random.choice(range(batch_total), size=batch_size, replace=False)
-                [batch_state, batch_action, batch_logp, batch_advantages_old] = [item[idxs] for item in [batch_state, batch_action, batch_logp, batch_advantages_old]]
-            batch_logp_new = self.get_logp(batch_state, batch_action)
-
-            # - A * logp - entropy_loss
-            loss_pi =  torch.mean(- batch_advantages_old * batch_logp_new)
-            loss_entropy = - torch.mean(batch_logp_new)
-            updata_entropy_coff = max(self.entropy_coeff - self.entropy_coeff_decay * self.logger.buffer['interaction'], 0)
-            loss_actor = loss_pi + loss_entropy * updata_entropy_coff
-            self.optimizer_pi.zero_grad()
-            loss_actor.backward()
-            self.optimizer_pi.step()
-            logp_diff = torch.exp(batch_logp_new) * (batch_logp_new - self.get_logp(batch_state, batch_action) )
-            kl = logp_diff.mean()
-            self.logger.log(pi_loss=loss_pi, entropy=loss_entropy, kl_divergence = kl, entropy_coff=updata_entropy_coff ,pi_update=None)
+            for batch_state, batch_action, batch_advantages_old, batch_valid in self.minibatch.epoch(s, a, advantages_old, valid):
+                with torch.no_grad():
+                    batch_logp = self.get_logp(batch_state, batch_action)
+                _, info = self.minibatch.step(self.optimizer_pi, loss_actor, [batch_state, batch_action, batch_advantages_old], valid=batch_valid)
+                loss_entropy = info['entropy']
+                with torch.no_grad():
+                    kl = maskedMean(torch.exp(batch_logp) * (batch_logp - self.get_logp(batch_state, batch_action)), batch_valid)
+                self.logger.log(pi_loss=info['pi_loss'], entropy=loss_entropy, kl_divergence=kl, entropy_coff=updata_entropy_coff, pi_update=None)
         self.logger.log(pi_update_step=i_pi)
 
 
@@ -693,7 +1006,7 @@ class IA2C(nn.ModuleList):
         return [r.mean().item(), loss_entropy.item()]
 
 
-class IC3Net(nn.ModuleList):
+class IC3Net(TrajectoryProcessor, nn.ModuleList):
     def __init__(self, logger, device, agent_args, **kwargs):
         super().__init__()
         self.logger = logger
@@ -713,6 +1026,7 @@ class IC3Net(nn.ModuleList):
         self.n_update_v = agent_args.n_update_v
         self.n_update_pi = agent_args.n_update_pi
         self.n_minibatch = agent_args.n_minibatch
+        self.minibatch = MinibatchEngine.fromArgs(agent_args)
         self.use_reduced_v = agent_args.use_reduced_v
         self.use_rtg = agent_args.use_rtg
         self.use_gae_returns = agent_args.use_gae_returns
@@ -745,15 +1059,20 @@ class IC3Net(nn.ModuleList):
         #self.collect_pi, self.actors = self._init_actors()
         #self.collect_v, self.vs = self._init_vs()
         self.hidden_dim = agent_args.v_args.hidden_dim
+        self.stacked = False if (not hasattr(agent_args, "stacked")) else agent_args.stacked
 
 
         self.initNetwork(agent_args)
+        self.advantage_estimator = AdvantageEstimator(self.gamma, self.lamda, self.use_rtg, self.use_gae_returns)
         self.optimizer = Adam(list(self.obs_encoder.parameters())+list(self.comm_gate_head.parameters())+ list(self.message_models.parameters())+list(self.main_models.parameters())+list(self.value_heads.parameters())+list(self.actors.parameters()), lr=self.lr)
         #self.optimizer_pi = Adam(self.actors.parameters(), lr=self.lr)
 
     def initNetwork(self, agent_args):
         # [one for all]observation encoding layer
         self.obs_encoder = nn.Linear(self.observation_dim, self.hidden_dim)
+        if self.stacked:
+            self.initStackedNetwork(agent_args)
+            return
 
         # [1 v 1] communication gated action layer, first dim for comm, second dim for not
         self.comm_gate_head = nn.ModuleList([nn.Linear(self.hidden_dim, 2) for i in range(self.n_agent)])
@@ -778,30 +1097,42 @@ class IC3Net(nn.ModuleList):
         # activation function
         self.activation_function = torch.nn.ReLU(inplace=True) #TODO: add to config file
 
+    def initStackedNetwork(self, agent_args):
+        """
+        The [1 v 1] layers and the actors of initNetwork() as stacked modules, evaluated in one batched matmul for all the agents.
+        They load the state_dicts of both layouts.
+        """
+        self.comm_gate_head = StackedLinear(self.n_agent, self.hidden_dim, 2)
+        self.message_models = StackedLinear(self.n_agent, self.hidden_dim, self.hidden_dim)
+        self.main_models = StackedLinear(self.n_agent, self.hidden_dim, self.hidden_dim)
+        self.value_heads = StackedLinear(self.n_agent, self.hidden_dim, 1)
+        self.pi_args.sizes[0] = self.hidden_dim
+        if self.discrete:
+            self.actors = StackedCategoricalActor(self.n_agent, **self.pi_args._toDict()).to(self.device)
+        else:
+            self.actors = StackedGaussianActor(self.n_agent, action_dim=self.action_dim, **self.pi_args._toDict()).to(self.device)
+        self.activation_function = torch.nn.ReLU(inplace=True)
+
+    def _loss(self, s, a, returns, advantages, valid, entropy_coeff):
+        loss_v = maskedMean((self._evalV(s) - returns) ** 2, valid)
+        # - A * logp - entropy_loss
+        logp_new = self.get_logp(s, a)
+        loss_pi = maskedMean(- advantages * logp_new, valid)
+        loss_entropy = - maskedMean(logp_new, valid)
+        loss_actor = loss_pi + loss_entropy * entropy_coeff
+        loss = self.lr_v * loss_v + self.lr_p * loss_actor
+        return loss, {'v_loss': loss_v, 'pi_loss': loss_pi, 'entropy': loss_entropy}
 
     def updateAgent(self, trajs, clip=None):
+        """
+        One epoch of joint critic and actor steps (see MinibatchEngine)
+        """
         time_t = time.time()
         if clip is None:
             clip = self.clip
-        n_minibatch = self.n_minibatch
 
-        names = Trajectory.names()
-        traj_all = {name: [] for name in names}
-        max_traj_length = max([i.length for i in trajs])
-        for traj in trajs:
-            for name in names:
-                tensor_shape = traj[name].shape
-                full_part_shape = [max_traj_length - tensor_shape[0]] + list(tensor_shape[1:])
-                if name == 'd':
-                    traj_all[name].append(torch.cat([traj[name], torch.ones(full_part_shape, dtype=torch.bool)], dim=0))
-                else:
-                    traj_all[name].append(
-                        torch.cat([traj[name], torch.zeros(full_part_shape, dtype=traj[name].dtype)], dim=0))
-        # should be 4-dim [batch * step * n_agent * dim]
-        traj = {name: torch.stack(value, dim=0) for name, value in traj_all.items()}
-
-        s, a, r, s1, d, logp = traj['s'], traj['a'], traj['r'], traj['s1'], traj['d'], traj['logp']
-        s, a, r, s1, d, logp = [item.to(self.device) for item in [s, a, r, s1, d, logp]]
+        traj = collateTrajectories(trajs)
+        s, a, r, logp = [traj[key].to(self.device) for key in ['s', 'a', 'r', 'logp']]
         # all in shape [batch_size, T, n_agent, dim]
         value_old, returns, advantages, reduced_advantages = self._process_traj(**traj)
 
@@ -817,50 +1148,24 @@ class IC3Net(nn.ModuleList):
         value_old = value_old.view(-1, n, 1)
         # s, a, logp, adv, ret, v are now all in shape [-1, n_agent, dim]
 
-        batch_total = logp.size()[0]
-        batch_size = int(batch_total / n_minibatch)
-
-        # critic loss
-        batch_returns = returns
-        batch_state = s
-        if n_minibatch > 1:
-            idxs = np.random.randint(0, len(batch_total), size=batch_size)
-            [batch_returns, batch_state] = [item[idxs] for item in [batch_returns, batch_state]]
-        batch_v_new = self._evalV(batch_state)
-        loss_v = ((batch_v_new - batch_returns) ** 2).mean()
-        var_v = ((batch_returns - batch_returns.mean()) ** 2).mean()
-        rel_v_loss = loss_v / (var_v + 1e-8)
-        self.logger.log(v_loss=loss_v, v_update=None, v_var=var_v, rel_v_loss=rel_v_loss)
-        # if rel_v_loss < self.v_thres:
-        #     break
-        self.logger.log(v_update_step=1)
-
-        # actor loss
-        batch_state, batch_action, batch_logp, batch_advantages_old = [s, a, logp, advantages_old]
-        if n_minibatch > 1:
-            idxs = np.random.choice(range(batch_total), size=batch_size, replace=False)
-            [batch_state, batch_action, batch_logp, batch_advantages_old] = [item[idxs] for item in
-                                                                             [batch_state, batch_action, batch_logp,
-                                                                              batch_advantages_old]]
-        batch_logp_new = self.get_logp(batch_state, batch_action)
-
-        # - A * logp - entropy_loss
-        loss_pi = torch.mean(- batch_advantages_old * batch_logp_new)
-        loss_entropy = - torch.mean(batch_logp_new)
         updata_entropy_coff = max(self.entropy_coeff - self.entropy_coeff_decay * self.logger.buffer['interaction'],
                                   0)
-        loss_actor = loss_pi + loss_entropy * updata_entropy_coff
-
-        loss = self.lr_v * loss_v + self.lr_p * loss_actor
-
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-
-        logp_diff = torch.exp(batch_logp_new) * (batch_logp_new - self.get_logp(batch_state, batch_action))
-        kl = logp_diff.mean()
-        self.logger.log(pi_loss=loss_pi, entropy=loss_entropy, kl_divergence=kl, entropy_coff=updata_entropy_coff,
-                        pi_update=None)
+        loss_fn = lambda *chunk: self._loss(*chunk, updata_entropy_coff)
+        valid = _validMask(traj).to(self.device).view(-1, n, 1)
+        for batch in self.minibatch.epoch(s, a, returns, advantages_old, valid):
+            batch_state, batch_action, batch_returns, _, batch_valid = batch
+            with torch.no_grad():
+                batch_logp = self.get_logp(batch_state, batch_action)
+            _, info = self.minibatch.step(self.optimizer, loss_fn, batch[:-1], valid=batch_valid)
+            loss_v, loss_entropy = info['v_loss'], info['entropy']
+            var_v = maskedMean((batch_returns - maskedMean(batch_returns, batch_valid)) ** 2, batch_valid)
+            rel_v_loss = loss_v / (var_v + 1e-8)
+            self.logger.log(v_loss=loss_v, v_update=None, v_var=var_v, rel_v_loss=rel_v_loss)
+            with torch.no_grad():
+                kl = maskedMean(torch.exp(batch_logp) * (batch_logp - self.get_logp(batch_state, batch_action)), batch_valid)
+            self.logger.log(pi_loss=info['pi_loss'], entropy=loss_entropy, kl_divergence=kl, entropy_coff=updata_entropy_coff,
+                            pi_update=None)
+        self.logger.log(v_update_step=1)
         self.logger.log(pi_update_step=1)
 
     def checkConverged(self, ls_info):
@@ -868,8 +1173,10 @@ class IC3Net(nn.ModuleList):
         return False
 
     def group_inference(self, model, data):
-        # model is a modelList
+        # model is a modelList (or a stacked module)
         # data is a [batch * n_agent *dim]
+        if self.stacked:
+            return model(data)
         outs = []
         for i in range(self.n_agent):
             agent_data = data.select(1, i)
@@ -878,35 +1185,24 @@ class IC3Net(nn.ModuleList):
         return outs
 
     def inference_hidden_state(self, s):
+        """
+        Input: s [batch_size, n_agent, obs_dim], Output: [batch_size, n_agent, hidden_dim]
+        The messages of all the samples are merged in one batched matmul.
+        """
         # encode the state
         s_encoding = self.activation_function(self.obs_encoder(s))
 
-        # decide which agent to communication
-        # [batch_size, n_agent, 2]
-        comm_gate_distirbution = self.group_inference(self.comm_gate_head, s_encoding)
-
-
-        # merge the message by mean
+        # merge the message by sum over the communication graph
         if self.all_comm == True:
-            batch_comm_adj = self.adj.unsqueeze(0).repeat(s.shape[0], 1, 1)
+            batch_message = torch.matmul(self.adj, s_encoding)
         else:
-            # TODO: check if need detach
-            comm_gate = torch.stack(
-                [torch.stack([torch.multinomial(dis, 1).detach() for dis in n_dis]) for n_dis in
-                 comm_gate_distirbution])
-            comm_gate_tensor = comm_gate.unsqueeze(2).repeat(1, 1, self.n_agent)
-            comm_gate_tensor_T = comm_gate_tensor.permute(0, 2, 1)
-            comm_gate = comm_gate_tensor * comm_gate_tensor_T
-            batch_comm_adj = self.adj.unsqueeze(0).repeat(comm_gate.shape[0], 1, 1) | comm_gate
-
-        batch_message_ls = []
-        for i in range(s.shape[0]):
-            # for each batch
-            comm_adj = batch_comm_adj.select(0, i)
-            single_s_encoding = s_encoding.select(0, i)
-
-            batch_message_ls.append(torch.mm(comm_adj, single_s_encoding))
-        batch_message = torch.stack(batch_message_ls, dim=0)
+            # decide which agent to communication, [batch_size, n_agent, 2], first dim for comm, second dim for not
+            comm_gate_distirbution = torch.softmax(self.group_inference(self.comm_gate_head, s_encoding), dim=-1)
+            b, n, _ = comm_gate_distirbution.shape
+            comm_gate = (torch.multinomial(comm_gate_distirbution.detach().view(-1, 2), 1).view(b, n) == 0).float()
+            comm_gate = comm_gate.unsqueeze(2) * comm_gate.unsqueeze(1) # both agents communicate
+            batch_comm_adj = torch.max(self.adj.unsqueeze(0), comm_gate)
+            batch_message = torch.bmm(batch_comm_adj, s_encoding)
 
         # deal with the meassage
         deal_message = self.group_inference(self.message_models, batch_message)
@@ -915,6 +1211,40 @@ class IC3Net(nn.ModuleList):
         hidden_state = s_encoding + self.group_inference(self.main_models, s_encoding) + deal_message
         return hidden_state
 
+    def _evalPi(self, hidden_state, a=None):
+        """
+        Requires hidden_state in shape [-1, n_agent, hidden_dim].
+        Returns the actor outputs stacked at dim 1, i.e. probs (discrete) or (means, stds) (continuous),
+        or the log probability of a if it is given.
+        """
+        if self.stacked:
+            if a is None:
+                return self.actors(hidden_state)
+            if self.discrete:
+                return torch.log(torch.gather(self.actors(hidden_state), dim=-1, index=a.long()))
+            return self.actors(hidden_state, a)
+        hidden_state = hidden_state.permute(1, 0, 2) # Now s[i].dim() == 2 ([batch_size, dim])
+        if a is not None:
+            log_prob = []
+            for i in range(self.n_agent):
+                if self.discrete:
+                    probs = self.actors[i](hidden_state[i])
+                    log_prob.append(torch.log(torch.gather(probs, dim=-1, index=torch.select(a, dim=1, index=i).long())))
+                else:
+                    log_prob.append(self.actors[i](hidden_state[i], a.select(dim=1, index=i)))
+            return torch.stack(log_prob, dim=1)
+        if self.discrete:
+            probs = []
+            for i in range(self.n_agent):
+                probs.append(self.actors[i](hidden_state[i]))
+            return torch.stack(probs, dim=1)
+        means, stds = [], []
+        for i in range(self.n_agent):
+            mean, std = self.actors[i](hidden_state[i])
+            means.append(mean)
+            stds.append(std)
+        return torch.stack(means, dim=1), torch.stack(stds, dim=1)
+
     def save(self, info=None):
         self.logger.save(self, info=info)
 
@@ -932,23 +1262,13 @@ class IC3Net(nn.ModuleList):
             s = s.to(self.device)
 
             hidden_state = self.inference_hidden_state(s)
-            hidden_state =  hidden_state.permute(1, 0, 2) # Now s[i].dim() == 2 ([batch_size, dim])
 
             # cal the action
             if self.discrete:
-                probs = []
-                for i in range(self.n_agent):
-                    probs.append(self.actors[i](hidden_state[i]))
-                probs = torch.stack(probs, dim=1)
+                probs = self._evalPi(hidden_state)
                 return Categorical(probs)
             else:
-                means, stds = [], []
-                for i in range(self.n_agent):
-                    mean, std = self.actors[i](hidden_state[i])
-                    means.append(mean)
-                    stds.append(std)
-                means = torch.stack(means, dim=1)
-                stds = torch.stack(stds, dim=1)
+                means, stds = self._evalPi(hidden_state)
                 while means.dim() > dim:
                     means = means.squeeze(0)
                     stds = stds.squeeze(0)
@@ -964,66 +1284,19 @@ class IC3Net(nn.ModuleList):
             a = a.unsqueeze(-1)
 
         hidden_state = self.inference_hidden_state(s)
-        hidden_state = hidden_state.permute(1, 0, 2)  # Now s[i].dim() == 2 ([batch_size, dim])
-
-        log_prob = []
-        for i in range(self.n_agent):
-            if self.discrete:
-                probs = self.actors[i](hidden_state[i])
-                log_prob.append(torch.log(torch.gather(probs, dim=-1, index=torch.select(a, dim=1, index=i).long())))
-            else:
-                log_prob.append(self.actors[i](hidden_state[i], a.select(dim=1, index=i)))
-        log_prob = torch.stack(log_prob, dim=1)
+        log_prob = self._evalPi(hidden_state, a)
         while log_prob.dim() < 3:
             log_prob = log_prob.unsqueeze(-1)
         return log_prob
 
     def _evalV(self, s):
-        # TODO：
         # Requires input in shape [-1, n_agent, dim]
         s = s.to(self.device)
 
         hidden_state = self.inference_hidden_state(s)
-        hidden_state = hidden_state.permute(1, 0, 2)  # Now s[i].dim() == 2 ([batch_size, dim])
-
-        values = []
-        for i in range(self.n_agent):
-            values.append(self.value_heads[i](hidden_state[i]))
-        return torch.stack(values, dim=1)
-
-    def _process_traj(self, s, a, r, s1, d, logp):
-        """
-        Input are all in shape [batch_size, T, n_agent, dim]
-        """
-        with torch.no_grad():
-            b, T, n, dim_s = s.shape
-            s, a, r, s1, d, logp = [item.to(self.device) for item in [s, a, r, s1, d, logp]]
-            value = self._evalV(s.view(-1, n, dim_s)).view(b, T, n, -1)
-
-            returns = torch.zeros(value.size(), device=self.device)
-            deltas, advantages = torch.zeros_like(returns), torch.zeros_like(returns)
-            prev_value = self._evalV(s1.select(1, T - 1))
-            if not self.use_rtg:
-                prev_return = prev_value
-            else:
-                prev_return = torch.zeros_like(prev_value)
-            prev_advantage = torch.zeros_like(prev_return)
-            d_mask = d.float()
-            for t in reversed(range(T)):
-                deltas[:, t, :, :]= r.select(1, t) + self.gamma * (1-d_mask.select(1,t)) * prev_value - value.select(1, t).detach()
-                advantages[:, t, :, :] = deltas.select(1, t) + self.gamma * self.lamda * (1-d_mask.select(1,t)) * prev_advantage
-                if self.use_gae_returns:
-                    returns[:, t, :, :] = value.select(1, t).detach() + advantages.select(1, t)
-                else:
-                    returns[:, t, :, :] = r.select(1, t) + self.gamma * (1-d_mask.select(1, t)) * prev_return
-
-                prev_return = returns.select(1, t)
-                prev_value = value.select(1, t)
-                prev_advantage = advantages.select(1, t)
+        return self.group_inference(self.value_heads, hidden_state)
 
-        return value, returns, advantages, None
-
-class DPPOAgent(nn.ModuleList):
+class DPPOAgent(TrajectoryProcessor, nn.ModuleList):
     """
     Everything in and out is torch Tensor.
     """
@@ -1044,6 +1317,7 @@ class DPPOAgent(nn.ModuleList):
         self.n_update_v = agent_args.n_update_v
         self.n_update_pi = agent_args.n_update_pi
         self.n_minibatch = agent_args.n_minibatch
+        self.minibatch = MinibatchEngine.fromArgs(agent_args)
         self.use_reduced_v = agent_args.use_reduced_v
         self.use_rtg = agent_args.use_rtg
         self.use_gae_returns = agent_args.use_gae_returns
@@ -1070,8 +1344,11 @@ class DPPOAgent(nn.ModuleList):
         self.radius_pi = agent_args.radius_pi
         self.pi_args = agent_args.pi_args
         self.v_args = agent_args.v_args
+        self.stacked = False if (not hasattr(agent_args, "stacked")) else agent_args.stacked
         self.collect_pi, self.actors = self._init_actors()
         self.collect_v, self.vs = self._init_vs()
+        self.advantage_estimator = AdvantageEstimator(self.gamma, self.lamda, self.use_rtg, self.use_gae_returns,
+                                                      self.advantage_norm, reduce=self.collect_v.reduce_sum)
 
         self.optimizer_v = Adam(self.vs.parameters(), lr=self.lr_v)
         self.optimizer_pi = Adam(self.actors.parameters(), lr=self.lr)
@@ -1087,25 +1364,14 @@ class DPPOAgent(nn.ModuleList):
             while s.dim() <= 2:
                 s = s.unsqueeze(0)
             s = s.to(self.device)
-            s = self.collect_pi.gather(s) # all state into [ self +  ]
-            # Now s[i].dim() == 2 ([batch_size, dim])
 
             if self.discrete:
-                probs = []
-                for i in range(self.n_agent):
-                    probs.append(self.actors[i](s[i]))
-                probs = torch.stack(probs, dim=1)
+                probs = self._evalPi(s)
                 while probs.dim() > dim:
                     probs = probs.squeeze(0)
                 return Categorical(probs)
             else:
-                means, stds = [], []
-                for i in range(self.n_agent):
-                    mean, std = self.actors[i](s[i])
-                    means.append(mean)
-                    stds.append(std)
-                means = torch.stack(means, dim=1)
-                stds = torch.stack(stds, dim=1)
+                means, stds = self._evalPi(s)
                 while means.dim() > dim:
                     means = means.squeeze(0)
                     stds = stds.squeeze(0)
@@ -1123,96 +1389,72 @@ class DPPOAgent(nn.ModuleList):
             a = a.unsqueeze(0)
         while a.dim() < s.dim():
             a = a.unsqueeze(-1)
-        s = self.collect_pi.gather(s)
-        # Now s[i].dim() == 2, a.dim() == 3
-        log_prob = []
-        for i in range(self.n_agent):
-            if self.discrete:
-                probs = self.actors[i](s[i])
-                log_prob.append(torch.log(torch.gather(probs, dim=-1, index=torch.select(a, dim=1, index=i).long())))
-            else:
-                log_prob.append(self.actors[i](s[i], a.select(dim=1, index=i)))
-        log_prob = torch.stack(log_prob, dim=1)
+        # Now a.dim() == 3
+        log_prob = self._evalPi(s, a)
         while log_prob.dim() < 3:
             log_prob = log_prob.unsqueeze(-1)
         return log_prob
 
+    def _lossPi(self, s, a, logp, advantages, valid, clip):
+        logp_new = self.get_logp(s, a)
+        logp_diff = logp_new - logp
+        kl = maskedMean(logp_diff, valid)
+        ratio = torch.exp(logp_new - logp)
+        surr1 = ratio * advantages
+        surr2 = ratio.clamp(1 - clip, 1 + clip) * advantages
+        loss_surr = maskedMean(torch.min(surr1, surr2), valid)
+        loss_entropy = - maskedMean(logp_new, valid)
+        loss_pi = - loss_surr - self.entropy_coeff * loss_entropy
+        return loss_pi, {'surr_loss': loss_surr, 'entropy': loss_entropy, 'kl_divergence': kl}
+
+    def _lossV(self, s, returns, valid):
+        loss_v = maskedMean((self._evalV(s) - returns) ** 2, valid)
+        return loss_v, {}
+
     def updateAgent(self, trajs, clip=None):
+        """
+        n_update_pi rounds of one policy epoch and one value epoch (see MinibatchEngine),
+        the advantages are recomputed with the updated critic at each round.
+        The policy stops updating once the kl exceeds target_kl.
+        """
         time_t = time.time()
         if clip is None:
             clip = self.clip
-        n_minibatch = self.n_minibatch
 
-        names = Trajectory.names()
-        traj_all = {name:[] for name in names}
-        max_traj_length = max([i.length for i in trajs])
-        for traj in trajs:
-            for name in names:
-                tensor_shape = traj[name].shape
-                full_part_shape = [max_traj_length - tensor_shape[0]] + list(tensor_shape[1:])
-                if name == 'd':
-                    traj_all[name].append(torch.cat([traj[name], torch.ones(full_part_shape, dtype=torch.bool)], dim=0))
-                else:
-                    traj_all[name].append(torch.cat([traj[name], torch.zeros(full_part_shape, dtype=traj[name].dtype)], dim=0))
-        traj = {name:torch.stack(value, dim=0) for name, value in traj_all.items()}
+        traj = collateTrajectories(trajs)
+        s, a, r, logp = [traj[key].to(self.device) for key in ['s', 'a', 'r', 'logp']]
+        # all in shape [batch_size, T, n_agent, dim]
+        b, T, n, d_s = s.size()
+        d_a = a.size()[-1]
+        s = s.view(-1, n, d_s)
+        a = a.view(-1, n, d_a)
+        logp = logp.view(-1, n, 1)
+        valid = _validMask(traj).to(self.device).view(-1, n, 1)
 
+        kl_all = []
+        pi_stopped = False
         for i_update in range(self.n_update_pi):
-            s, a, r, s1, d, logp = traj['s'], traj['a'], traj['r'], traj['s1'], traj['d'], traj['logp']
-            s, a, r, s1, d, logp = [item.to(self.device) for item in [s, a, r, s1, d, logp]]
-            # all in shape [batch_size, T, n_agent, dim]
             value_old, returns, advantages, reduced_advantages = self._process_traj(**traj)
-
             advantages_old = reduced_advantages if self.use_reduced_v else advantages
-
-            b, T, n, d_s = s.size()
-            d_a = a.size()[-1]
-            s = s.view(-1, n, d_s)
-            a = a.view(-1, n, d_a)
-            logp = logp.view(-1, n, 1)
             advantages_old = advantages_old.view(-1, n, 1)
             returns = returns.view(-1, n, 1)
             value_old = value_old.view(-1, n, 1)
             # s, a, logp, adv, ret, v are now all in shape [-1, n_agent, dim]
 
-            batch_total = logp.size()[0]
-            batch_size = int(batch_total/n_minibatch)
-            kl_all = []
-            i_pi = 0
-            for i_pi in range(1):
-                batch_state, batch_action, batch_logp, batch_advantages_old = [s, a, logp, advantages_old]
-                if n_minibatch > 1:
-                    idxs = np.random.choice(range(batch_total), size=batch_size, replace=False)
-                    [batch_state, batch_action, batch_logp, batch_advantages_old] = [item[idxs] for item in [batch_state, batch_action, batch_logp, batch_advantages_old]]
-                batch_logp_new = self.get_logp(batch_state, batch_action)
-                logp_diff = batch_logp_new - batch_logp
-                kl = logp_diff.mean()
-                ratio = torch.exp(batch_logp_new - batch_logp)
-                surr1 = ratio * batch_advantages_old
-                surr2 = ratio.clamp(1 - clip, 1 + clip) * batch_advantages_old
-                loss_surr = torch.min(surr1, surr2).mean()
-                loss_entropy = - torch.mean(batch_logp_new)
-                loss_pi = - loss_surr - self.entropy_coeff * loss_entropy
-                self.optimizer_pi.zero_grad()
-                loss_pi.backward()
-                self.optimizer_pi.step()
-                self.logger.log(surr_loss = loss_surr, entropy = loss_entropy, kl_divergence = kl, pi_update=None)
-                kl_all.append(kl.abs().item())
-                if self.target_kl is not None and kl.abs() > 1.5 * self.target_kl:
-                    break
-            self.logger.log(pi_update_step=i_update)
-
-            for i_v in range(1):
-                batch_returns = returns
-                batch_state = s
-                if n_minibatch > 1:
-                    idxs = np.random.randint(0, len(batch_total), size=batch_size)
-                    [batch_returns, batch_state] = [item[idxs] for item in [batch_returns, batch_state]]
-                batch_v_new = self._evalV(batch_state)
-                loss_v = ((batch_v_new - batch_returns) ** 2).mean()
-                self.optimizer_v.zero_grad()
-                loss_v.backward()
-                self.optimizer_v.step()
-                var_v = ((batch_returns - batch_returns.mean()) ** 2).mean()
+            if not pi_stopped:
+                for batch in self.minibatch.epoch(s, a, logp, advantages_old, valid):
+                    _, info = self.minibatch.step(self.optimizer_pi, lambda *chunk: self._lossPi(*chunk, clip), batch[:-1], valid=batch[-1])
+                    loss_entropy, kl = info['entropy'], info['kl_divergence']
+                    self.logger.log(surr_loss=info['surr_loss'], entropy=loss_entropy, kl_divergence=kl, pi_update=None)
+                    kl_all.append(kl.abs().item())
+                    if self.minibatch.klExceeded(kl):
+                        pi_stopped = True
+                        break
+                self.logger.log(pi_update_step=i_update)
+
+            for batch_state, batch_returns, batch_valid in self.minibatch.epoch(s, returns, valid):
+                loss_v, _ = self.minibatch.step(self.optimizer_v, self._lossV, [batch_state, batch_returns], valid=batch_valid)
+                var_v = maskedMean((batch_returns - maskedMean(batch_returns, batch_valid)) ** 2, batch_valid)
                 rel_v_loss = loss_v / (var_v + 1e-8)
                 self.logger.log(v_loss=loss_v, v_update=None, v_var=var_v, rel_v_loss=rel_v_loss)
                 if rel_v_loss < self.v_thres:
@@ -1229,11 +1471,64 @@ class DPPOAgent(nn.ModuleList):
         self.logger.save(self, info=info)
 
     def load(self, state_dict):
+        if isinstance(state_dict, str):
+            state_dict = loadCheckpoint(state_dict)
         self.load_state_dict(state_dict[self.logger.prefix])
+        loadOptimizerStateDicts(self, state_dict.get(f"{self.logger.prefix}/optimizer", {}))
+
+    def unstackedStateDict(self):
+        """
+        Returns the state_dict with the per-agent networks in the nn.ModuleList layout,
+        i.e. a checkpoint loadable by a non-stacked agent. Stacked agents load both layouts.
+        """
+        state_dict = self.state_dict()
+        if self.stacked:
+            for name in ['actors', 'vs']:
+                state_dict = {key: value for key, value in state_dict.items() if not key.startswith(name + '.')}
+                state_dict.update(unstackStateDict(getattr(self, name), prefix=name + '.'))
+        return state_dict
+
+    def _evalPi(self, s, a=None):
+        """
+        Requires input in shape [-1, n_agent, dim].
+        Returns the actor outputs stacked at dim 1, i.e. probs (discrete) or (means, stds) (continuous),
+        or the log probability of a if it is given.
+        """
+        if self.stacked:
+            s = self.collect_pi.gather_padded(s) # [batch_size, n_agent, max_degree*dim], evaluated in one batched op
+            if a is None:
+                return self.actors(s)
+            if self.discrete:
+                return torch.log(torch.gather(self.actors(s), dim=-1, index=a.long()))
+            return self.actors(s, a)
+        s = self.collect_pi.gather(s) # all state into [ self +  ]
+        # Now s[i].dim() == 2 ([batch_size, dim])
+        if a is not None:
+            log_prob = []
+            for i in range(self.n_agent):
+                if self.discrete:
+                    probs = self.actors[i](s[i])
+                    log_prob.append(torch.log(torch.gather(probs, dim=-1, index=torch.select(a, dim=1, index=i).long())))
+                else:
+                    log_prob.append(self.actors[i](s[i], a.select(dim=1, index=i)))
+            return torch.stack(log_prob, dim=1)
+        if self.discrete:
+            probs = []
+            for i in range(self.n_agent):
+                probs.append(self.actors[i](s[i]))
+            return torch.stack(probs, dim=1)
+        means, stds = [], []
+        for i in range(self.n_agent):
+            mean, std = self.actors[i](s[i])
+            means.append(mean)
+            stds.append(std)
+        return torch.stack(means, dim=1), torch.stack(stds, dim=1)
 
     def _evalV(self, s):
         # Requires input in shape [-1, n_agent, dim]
         s = s.to(self.device)
+        if self.stacked:
+            return self.vs(self.collect_v.gather_padded(s))
         s = self.collect_v.gather(s)
         values = []
         for i in range(self.n_agent):
@@ -1242,6 +1537,13 @@ class DPPOAgent(nn.ModuleList):
 
     def _init_actors(self):
         collect_pi = MultiCollect(torch.matrix_power(self.adj, self.radius_pi), device=self.device)
+        if self.stacked:
+            self.pi_args.sizes[0] = [degree * self.observation_dim for degree in collect_pi.degree.tolist()]
+            if self.discrete:
+                actors = StackedCategoricalActor(self.n_agent, **self.pi_args._toDict())
+            else:
+                actors = StackedGaussianActor(self.n_agent, action_dim=self.action_dim, **self.pi_args._toDict())
+            return collect_pi, actors.to(self.device)
         actors = nn.ModuleList()
         for i in range(self.n_agent):
             self.pi_args.sizes[0] = collect_pi.degree[i] * self.observation_dim
@@ -1253,46 +1555,15 @@ class DPPOAgent(nn.ModuleList):
     
     def _init_vs(self):
         collect_v = MultiCollect(torch.matrix_power(self.adj, self.radius_v), device=self.device)
+        if self.stacked:
+            self.v_args.sizes[0] = [degree * self.observation_dim for degree in collect_v.degree.tolist()]
+            return collect_v, StackedMLP(self.n_agent, **self.v_args._toDict()).to(self.device)
         vs = nn.ModuleList()
         for i in range(self.n_agent):
             self.v_args.sizes[0] = collect_v.degree[i] * self.observation_dim
             v_fn = self.v_args.network
             vs.append(v_fn(**self.v_args._toDict()).to(self.device))
         return collect_v, vs
-    
-    def _process_traj(self, s, a, r, s1, d, logp):
-        """
-        Input are all in shape [batch_size, T, n_agent, dim]
-        """
-        b, T, n, dim_s = s.shape
-        s, a, r, s1, d, logp = [item.to(self.device) for item in [s, a, r, s1, d, logp]]
-        value = self._evalV(s.view(-1, n, dim_s)).view(b, T, n, -1)
-
-        returns = torch.zeros(value.size(), device=self.device)
-        deltas, advantages = torch.zeros_like(returns), torch.zeros_like(returns)
-        prev_value = self._evalV(s1.select(1, T - 1))
-        if not self.use_rtg:
-            prev_return = prev_value
-        else:
-            prev_return = torch.zeros_like(prev_value)
-        prev_advantage = torch.zeros_like(prev_return)
-        d_mask = d.float()
-        for t in reversed(range(T)):
-            deltas[:, t, :, :]= r.select(1, t) + self.gamma * (1-d_mask.select(1,t)) * prev_value - value.select(1, t).detach()
-            advantages[:, t, :, :] = deltas.select(1, t) + self.gamma * self.lamda * (1-d_mask.select(1,t)) * prev_advantage
-            if self.use_gae_returns:
-                returns[:, t, :, :] = value.select(1, t).detach() + advantages.select(1, t)
-            else:
-                returns[:, t, :, :] = r.select(1, t) + self.gamma * (1-d_mask.select(1, t)) * prev_return
-
-            prev_return = returns.select(1, t)
-            prev_value = value.select(1, t)
-            prev_advantage = advantages.select(1, t)
-        reduced_advantages = self.collect_v.reduce_sum(advantages.view(-1, n, 1)).view(advantages.size())
-        if self.advantage_norm and reduced_advantages.size()[1] > 1:
-            reduced_advantages = (reduced_advantages - reduced_advantages.mean(dim=1, keepdim=True)) / (reduced_advantages.std(dim=1, keepdim=True) + 1e-5)
-            advantages = (advantages - advantages.mean(dim=1, keepdim=True)) / (advantages.std(dim=1, keepdim=True) + 1e-5)
-        return value.detach(), returns, advantages.detach(), reduced_advantages.detach()
 
 class ModelBasedAgent(nn.ModuleList):
     def __init__(self, logger, device, agent_args, **kwargs):
@@ -1302,6 +1573,9 @@ class ModelBasedAgent(nn.ModuleList):
         self.lr_p = agent_args.lr_p
         self.p_args = agent_args.p_args
         self.ps = GraphConvolutionalModel(self.logger, self.adj, self.observation_dim, self.action_dim, self.n_agent, self.p_args).to(self.device)
+        self.n_ensemble = self.ps.n_ensemble
+        # an analytic reward and done of the environment (e.g. env.rewardOracle()), replacing the reward and done heads of the model
+        self.reward_oracle = None if (not hasattr(agent_args, "reward_oracle")) or agent_args.reward_oracle is None else agent_args.reward_oracle.to(self.device)
         self.optimizer_p = Adam(self.ps.parameters(), lr=self.lr)
 
     def updateModel(self, trajs, length=1):
@@ -1309,19 +1583,12 @@ class ModelBasedAgent(nn.ModuleList):
         Input dim: 
         s: [[T, n_agent, state_dim]]
         a: [[T, n_agent, action_dim]]
+        or a batch {name: [n_traj, T, n_agent, dim]} (e.g. from ModelBuffer.sampleBatch())
         """
         time_t = time.time()
         loss_total = 0.
-        ss, actions, rs, s1s, ds = [], [], [], [], []
-        for traj in trajs:
-            s, a, r, s1, d = traj["s"], traj["a"], traj["r"], traj["s1"], traj["d"]
-            s, a, r, s1, d = [torch.as_tensor(item, device=self.device) for item in [s, a, r, s1, d]]
-            ss.append(s)
-            actions.append(a)
-            rs.append(r)
-            s1s.append(s1)
-            ds.append(d)
-        ss, actions, rs, s1s, ds = [torch.stack(item, dim=0) for item in [ss, actions, rs, s1s, ds]]
+        batch = collateTrajectories(trajs)
+        ss, actions, rs, s1s, ds = [batch[name].to(self.device) for name in ["s", "a", "r", "s1", "d"]]
         loss, rel_state_error = self.ps.train(ss, actions, rs, s1s, ds, length) # [n_traj, T, n_agent, dim]
         self.optimizer_p.zero_grad()
         loss.sum().backward()
@@ -1333,24 +1600,19 @@ class ModelBasedAgent(nn.ModuleList):
     
     def validateModel(self, trajs, length=1):
         with torch.no_grad():
-            ss, actions, rs, s1s, ds = [], [], [], [], []
-            for traj in trajs:
-                s, a, r, s1, d = traj["s"], traj["a"], traj["r"], traj["s1"], traj["d"]
-                s, a, r, s1, d = [torch.as_tensor(item, device=self.device) for item in [s, a, r, s1, d]]
-                ss.append(s)
-                actions.append(a)
-                rs.append(r)
-                s1s.append(s1)
-                ds.append(d)
-            ss, actions, rs, s1s, ds = [torch.stack(item, dim=0) for item in [ss, actions, rs, s1s, ds]]
+            batch = collateTrajectories(trajs)
+            ss, actions, rs, s1s, ds = [batch[name].to(self.device) for name in ["s", "a", "r", "s1", "d"]]
             _, rel_state_error = self.ps.train(ss, actions, rs, s1s, ds, length) # [n_traj, T, n_agent, dim]
             return rel_state_error.item()
     
-    def model_step(self, s, a):
+    def model_step(self, s, a, uncertainty=False, member=None, t=None):
         """
         Input dim: 
         s: [batch_size, n_agent, state_dim]
         a: [batch_size, n_agent] (discrete) or [batch_size, n_agent, action_dim] (continuous)
+        member: [batch_size], the member of the model ensemble predicting each sample, random if None
+        t: [batch_size], the time index of each s in its episode, passed to the reward oracle (as the one of s1), if known
+        With uncertainty, the disagreement of the members [batch_size] is returned as well.
 
         Return dim == 3.
         """
@@ -1362,12 +1624,23 @@ class ModelBasedAgent(nn.ModuleList):
                 a = a.unsqueeze(-1)
             s = s.to(self.device)
             a = a.to(self.device)
-            rs, s1s, ds = self.ps.predict(s, a)
+            if uncertainty:
+                rs, s1s, ds, disagreement = self.ps.predict(s, a, member=member, uncertainty=True)
+            else:
+                rs, s1s, ds = self.ps.predict(s, a, member=member)
+            if self.reward_oracle is not None:
+                rs, ds = self.reward_oracle(s, a, s1s, t=None if t is None else t.to(self.device) + 1)
+                rs, ds = rs.unsqueeze(-1), ds.unsqueeze(-1)
+            if uncertainty:
+                return rs.detach(), s1s.detach(), ds.detach(), s.detach(), disagreement
             return rs.detach(), s1s.detach(), ds.detach(), s.detach()
     
-    def load_model(self, pretrained_model):
-        dic = torch.load(pretrained_model)
-        self.load_state_dict(dic[''])
+    def load_model(self, pretrained_model, modules=None):
+        """
+        modules: only loads these modules, e.g. ['ps'] for the world model, all of them if None
+        """
+        state_dict = loadCheckpoint(pretrained_model, key='', modules=modules)
+        self.load_state_dict(state_dict, strict=modules is None)
 
 
 
@@ -1376,6 +1649,9 @@ class HiddenAgent(ModelBasedAgent):
         super().__init__(logger, device, agent_args, **kwargs)
         self.hidden_state_dim = agent_args.hidden_state_dim
         self.embedding_sizes = agent_args.embedding_sizes
+        if self.reward_oracle is not None:
+            # the model predicts embeddings, from which the oracle cannot read the features of the environment
+            raise ValueError("reward_oracle is not supported with hidden states")
         self.embedding_layers = self._init_embedding_layers()
         self.optimizer_p.add_param_group({'params': self.embedding_layers.parameters()})
     
@@ -1398,10 +1674,10 @@ class HiddenAgent(ModelBasedAgent):
             s1 = self._state_embedding(s1)
         return super().updateModel(s, a, r, s1, d)
     
-    def model_step(self, s, a):
+    def model_step(self, s, a, uncertainty=False, member=None, t=None):
         if s.size()[-1] != self.hidden_state_dim:
             s = self._state_embedding(s)
-        return super().model_step(s, a)
+        return super().model_step(s, a, uncertainty, member, t)
 
     def _init_embedding_layers(self):
         embedding_layers = nn.ModuleList()
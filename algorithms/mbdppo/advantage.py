@@ -0,0 +1,117 @@
+import torch
+
+
+def discountedCumsum(x, discount, dim=1):
+    """
+    y_t = x_t + discount_t * y_{t+1} along dim, with y_T = 0.
+    Evaluated as a log-depth (Hillis-Steele) scan, i.e. O(log T) vectorized steps instead of T python iterations.
+    x and discount should have the same shape.
+    """
+    x, discount = x.flip(dim), discount.flip(dim) # now y_t = x_t + discount_t * y_{t-1}
+    T = x.shape[dim]
+    step = 1
+    while step < T:
+        # after this step, (discount_t, x_t) represents y_t = x_t + discount_t * y_{t-2*step}
+        x = torch.cat([x.narrow(dim, 0, step),
+                       x.narrow(dim, step, T - step) + discount.narrow(dim, step, T - step) * x.narrow(dim, 0, T - step)], dim=dim)
+        discount = torch.cat([discount.narrow(dim, 0, step),
+                              discount.narrow(dim, step, T - step) * discount.narrow(dim, 0, T - step)], dim=dim)
+        step *= 2
+    return x.flip(dim)
+
+
+class AdvantageEstimator:
+    """
+    GAE shared by all the agents, vectorized over the time dimension.
+        use_rtg: the returns are not bootstrapped from the value of the last state
+        use_gae_returns: returns = value + advantages instead of the discounted sum of rewards
+        reduce: MultiCollect.reduce_sum of the critic, the reduced advantages are None if it is not given
+        advantage_norm: normalizes the (reduced) advantages over the time dimension, only when reduce is given
+    """
+    def __init__(self, gamma, lamda, use_rtg=False, use_gae_returns=False, advantage_norm=False, reduce=None):
+        self.gamma = gamma
+        self.lamda = lamda
+        self.use_rtg = use_rtg
+        self.use_gae_returns = use_gae_returns
+        self.advantage_norm = advantage_norm
+        self.reduce = reduce
+
+    def __call__(self, value, last_value, r, d, valid=None):
+        """
+        Input:
+            value, r, d: [batch_size, T, n_agent, 1]
+            last_value: [batch_size, n_agent, 1], the value of s1 at the last step
+            valid: [batch_size, T, n_agent, 1], False for the padding steps after the end of a trajectory,
+                their advantages are zero and they are left out of the normalization. None if all the steps are valid.
+                The last valid step of a trajectory is bootstrapped from the value of the first padding step,
+                whose s should then be the s1 of the last valid step (see ModelRollout and collateTrajectories).
+        Output: returns, advantages, reduced_advantages, all in shape [batch_size, T, n_agent, 1]
+        """
+        with torch.no_grad():
+            b, T, n, _ = value.shape
+            mask = 1 - d.float().view(value.shape)
+            r = r.view(value.shape)
+            next_value = torch.cat([value.narrow(1, 1, T - 1), last_value.unsqueeze(1)], dim=1)
+            deltas = r + self.gamma * mask * next_value - value
+            if valid is not None:
+                valid = valid.float().view(value.shape)
+                deltas = deltas * valid
+            advantages = discountedCumsum(deltas, self.gamma * self.lamda * mask)
+            if self.use_gae_returns:
+                returns = value + advantages
+            else:
+                if not self.use_rtg:
+                    # bootstraps from the value after the last valid step, folded into its reward
+                    if valid is None:
+                        end = torch.zeros_like(r)
+                        end[:, -1] = 1
+                    else:
+                        end = valid * (1 - torch.cat([valid.narrow(1, 1, T - 1), torch.zeros_like(valid.narrow(1, 0, 1))], dim=1))
+                    r = r + self.gamma * mask * next_value * end
+                returns = discountedCumsum(r, self.gamma * mask)
+            if self.reduce is None:
+                return returns, advantages, None
+            reduced_advantages = self.reduce(advantages.view(-1, n, 1)).view(advantages.size())
+            if self.advantage_norm and T > 1:
+                reduced_advantages = self._normalize(reduced_advantages, valid)
+                advantages = self._normalize(advantages, valid)
+            return returns, advantages, reduced_advantages
+
+    @staticmethod
+    def _normalize(x, valid=None):
+        """ Normalizes x over the time dimension, only over the valid steps if valid is given """
+        if valid is None:
+            return (x - x.mean(dim=1, keepdim=True)) / (x.std(dim=1, keepdim=True) + 1e-5)
+        count = valid.sum(dim=1, keepdim=True)
+        mean = (x * valid).sum(dim=1, keepdim=True) / count.clamp(min=1)
+        std = (((x - mean) ** 2 * valid).sum(dim=1, keepdim=True) / (count - 1).clamp(min=1)).sqrt()
+        return (x - mean) / (std + 1e-5) * valid
+
+
+class TrajectoryProcessor:
+    """
+    Mixin implementing _process_traj() with an AdvantageEstimator.
+    Expects self.advantage_estimator and self._evalV().
+    """
+    def _process_traj(self, s, a, r, s1, d, logp, valid=None):
+        """
+        Input are all in shape [batch_size, T, n_agent, dim], valid (optional) marks the steps that are not padding
+        """
+        with torch.no_grad():
+            value, last_value = self._evalValues(s, s1)
+            r, d = [item.to(self.device) for item in [r, d]]
+            if valid is not None:
+                valid = valid.to(self.device)
+            returns, advantages, reduced_advantages = self.advantage_estimator(value, last_value, r, d, valid)
+        return value, returns, advantages, reduced_advantages
+
+    def _evalValues(self, s, s1):
+        """
+        The values of s and of the last s1, evaluated in one forward pass.
+        Output: [batch_size, T, n_agent, 1], [batch_size, n_agent, 1]
+        """
+        b, T, n, dim_s = s.shape
+        states = torch.cat([s.reshape(-1, n, dim_s), s1.select(1, T - 1)], dim=0).to(self.device)
+        values = self._evalV(states)
+        value, last_value = values[:b * T].view(b, T, n, -1), values[b * T:]
+        return value, last_value
@@ -0,0 +1,125 @@
+import copy
+import threading
+import numpy as np
+import torch
+from algorithms.utils import Config, EpisodeRecorder
+from algorithms.envs.Vectorized import SubprocVectorizedEnv
+from algorithms.mbdppo.policy import exportPolicy
+
+
+class Evaluator:
+    """
+    Runs the test episodes of OnPolicyRunner.test() on n_env environments stepped together (SubprocVectorizedEnv),
+    with one agent.act() call per step for all the running episodes.
+    An environment that finishes its episode starts the next one, until the n_test episodes have run.
+    Episode i is seeded by seeds[i] (see seededReset), so the results do not depend on n_env.
+    All the environments run in subprocesses, so that seeding them leaves the RNGs of the learner as they are.
+        background: evaluate() snapshots the weights of the agent and runs in a thread,
+            so that training goes on in the meantime, see result()
+        compiled: acts with the policy exported by exportPolicy() instead of agent.act()
+    Returns {'returns', 'lengths', 'scaled'}, arrays of [n_test],
+        where scaled are the returns before rescaleReward() if the environment defines it, else None
+    """
+    def __init__(self, env_fn, agent, n_test, length, seeds, n_env, device="cpu", recorder_path=None, background=False, compiled=False):
+        self.agent = agent
+        self.n_test = n_test
+        self.length = length
+        self.seeds = list(seeds)
+        if len(self.seeds) < n_test:
+            raise ValueError(f"{len(self.seeds)} test seeds for {n_test} test episodes")
+        self.device = device
+        self.recorder_path = recorder_path
+        self.background = background
+        self.compiled = compiled
+        env_args = Config()
+        env_args.n_env = min(n_env, n_test)
+        env_args.local_env = False
+        self.envs = SubprocVectorizedEnv(env_fn, env_args)
+        self.snapshot = None
+        self.thread = None
+        self._result = None
+
+    def evaluate(self):
+        if not self.background:
+            return self._run(self.agent)
+        self.wait()
+        if self.snapshot is None:
+            # the logger is shared, the rest of the agent is copied once
+            self.snapshot = copy.deepcopy(self.agent, memo={id(self.agent.logger): self.agent.logger})
+        self.snapshot.load_state_dict(self.agent.state_dict())
+        self.thread = threading.Thread(target=self._runBackground, daemon=True)
+        self.thread.start()
+        return None
+
+    def _runBackground(self):
+        self._result = self._run(self.snapshot)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def result(self, wait=False):
+        """
+        Returns the result of the last background evaluation once, or None if it is still running (and wait is False)
+        """
+        if self.thread is not None:
+            if not wait and self.thread.is_alive():
+                return None
+            self.wait()
+        result, self._result = self._result, None
+        return result
+
+    def _run(self, agent):
+        envs, n_env = self.envs, self.envs.n_env
+        returns = np.zeros(self.n_test)
+        lengths = np.zeros(self.n_test, dtype=np.int64)
+        recorder = None
+        if self.recorder_path is not None:
+            recorder = EpisodeRecorder(self.recorder_path, self.n_test, self.length)
+        episodes = list(range(n_env)) # the episode of each environment, None once they are all done
+        s = envs.reset(seeds=self.seeds[:n_env])
+        next_episode = n_env
+        policy = exportPolicy(agent) if self.compiled else None
+        with torch.no_grad():
+            while True:
+                live = [i for i in range(n_env) if episodes[i] is not None]
+                if len(live) == 0:
+                    break
+                s_live = torch.as_tensor(s[live], dtype=torch.float, device=self.device)
+                if policy is not None:
+                    a, _ = policy(s_live)
+                else:
+                    a = agent.act(s_live).sample()
+                a = a.detach().cpu().numpy()
+                envs.step_async(a, live)
+                s1, r, d, _ = envs.step_wait(live)
+                s[live] = s1
+                finished, starts = [], []
+                for k, i in enumerate(live):
+                    episode = episodes[i]
+                    if recorder is not None:
+                        recorder.store(episode, s=s_live[k], a=a[k], r=r[k], d=d[k])
+                    returns[episode] += r[k].sum()
+                    lengths[episode] += 1
+                    if d[k].any() or lengths[episode] == self.length:
+                        if next_episode < self.n_test:
+                            episodes[i] = next_episode
+                            finished.append(i)
+                            starts.append(self.seeds[next_episode])
+                            next_episode += 1
+                        else:
+                            episodes[i] = None
+                if len(finished) > 0:
+                    s[finished] = envs.reset(seeds=starts, indices=finished)[finished]
+        if recorder is not None:
+            recorder.close()
+        scaled = None
+        if hasattr(envs, 'rescaleReward'):
+            scaled = returns
+            returns = np.array([envs.rescaleReward(ret, length) for ret, length in zip(returns, lengths)])
+        return {'returns': returns, 'lengths': lengths, 'scaled': scaled}
+
+    def close(self):
+        self.wait()
+        self.envs.close()
@@ -0,0 +1,77 @@
+import torch
+
+
+def maskedMean(x, valid=None):
+    """ The mean of x over the rows where valid (broadcastable to x) is nonzero, the plain mean if valid is None """
+    if valid is None:
+        return x.mean()
+    valid = valid.expand_as(x)
+    return (x * valid).sum() / valid.sum().clamp(min=1)
+
+
+class MinibatchEngine:
+    """
+    Epochs of minibatch updates over samples stacked along dim 0, e.g. s [b*T, n_agent, dim].
+    Each epoch draws one torch.randperm on the device of the samples and gathers each tensor once,
+    the minibatches are then contiguous views of the shuffled tensors (with n_minibatch == 1, the tensors themselves).
+        micro_batch_size: the gradients of a larger minibatch are accumulated over chunks of micro_batch_size samples,
+            so that the peak activation memory is bounded by micro_batch_size instead of the minibatch size
+        target_kl: see klExceeded()
+    """
+    def __init__(self, n_minibatch=1, micro_batch_size=None, target_kl=None):
+        self.n_minibatch = max(int(n_minibatch), 1)
+        self.micro_batch_size = micro_batch_size
+        self.target_kl = target_kl
+
+    @classmethod
+    def fromArgs(cls, agent_args):
+        micro_batch_size = None if (not hasattr(agent_args, "micro_batch_size")) else agent_args.micro_batch_size
+        return cls(agent_args.n_minibatch, micro_batch_size, agent_args.target_kl)
+
+    def epoch(self, *tensors):
+        """
+        Yields the n_minibatch minibatches of one epoch, as lists of views of the (shuffled) tensors.
+        The last minibatch takes the remainder of batch_total / n_minibatch.
+        """
+        batch_total = tensors[0].size(0)
+        n_minibatch = min(self.n_minibatch, batch_total)
+        if n_minibatch > 1:
+            perm = torch.randperm(batch_total, device=tensors[0].device)
+            tensors = [item.index_select(0, perm) for item in tensors]
+        batch_size = batch_total // n_minibatch
+        for i in range(n_minibatch):
+            end = batch_total if i == n_minibatch - 1 else (i + 1) * batch_size
+            yield [item[i * batch_size:end] for item in tensors]
+
+    def step(self, optimizer, loss_fn, batch, valid=None):
+        """
+        One optimizer step on a minibatch.
+        loss_fn(*chunk) returns the mean loss over a chunk of the minibatch, and a dict of (mean) stats to log.
+        With valid (a float mask of the rows, e.g. 0 for the padding of the trajectories), loss_fn(*chunk, valid_chunk)
+        should return means over the valid rows only (see maskedMean), the chunks are then weighted by their valid rows.
+        Returns the loss and the stats of the minibatch, detached, averaged over the chunks weighted by their sizes.
+        """
+        batch_total = batch[0].size(0)
+        chunk_size = batch_total if self.micro_batch_size is None else max(int(self.micro_batch_size), 1)
+        if valid is not None:
+            batch = list(batch) + [valid]
+            valid_total = valid.sum().clamp(min=1)
+        optimizer.zero_grad()
+        total, stats = 0., {}
+        for start in range(0, batch_total, chunk_size):
+            chunk = [item[start:start + chunk_size] for item in batch]
+            if valid is None:
+                weight = chunk[0].size(0) / batch_total
+            else:
+                weight = chunk[-1].sum() / valid_total
+            loss, info = loss_fn(*chunk)
+            (loss * weight).backward()
+            total = total + loss.detach() * weight
+            for key, value in info.items():
+                stats[key] = stats.get(key, 0.) + value.detach() * weight
+        optimizer.step()
+        return total, stats
+
+    def klExceeded(self, kl):
+        """ Whether the policy moved too far from the behavior policy (|kl| > 1.5 * target_kl), to stop its epochs early """
+        return self.target_kl is not None and kl.abs().item() > 1.5 * self.target_kl
@@ -0,0 +1,169 @@
+"""
+Compiled inference of the policies of DPPOAgent, IA2C and MB_DPPOAgent.
+
+StackedPolicy fuses the neighbor gather of collect_pi, the actors of all the agents (as stacked batched matmuls)
+and the sampling (or argmax) into one TorchScript graph, from s [batch_size, n_agent, obs_dim] to the actions and their log probs.
+This module only imports torch, so an exported policy can be run by a controller process without the training stack:
+
+    from algorithms.mbdppo.policy import PolicyController
+    controller = PolicyController("policy.pt")
+    a = controller(s)
+"""
+import math
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class StackedLayer(nn.Module):
+    """
+    n linear layers and their activation, Input: [n, batch_size, in_features], Output: [n, batch_size, out_features]
+    """
+    def __init__(self, weight, bias, activation):
+        super().__init__()
+        self.register_buffer('weight', weight) # [n, out_features, in_features]
+        self.register_buffer('bias', bias) # [n, out_features]
+        self.activation = activation
+
+    def forward(self, x):
+        return self.activation(torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2)))
+
+
+class StackedPolicy(nn.Module):
+    """
+    The policy of n_agent MLP actors with padded neighbor inputs (see MultiCollect.gather_padded and StackedLinear).
+    Input: s [batch_size, n_agent, obs_dim] or [n_agent, obs_dim]
+    Output: a and logp, with the same leading dimensions as s
+        discrete: a [..., n_agent] (long), logp [..., n_agent]
+        continuous: a [..., n_agent, action_dim], logp [..., n_agent, action_dim], as Normal.log_prob()
+    deterministic: argmax or mean instead of sampling
+    Build it with exportPolicy().
+    """
+    def __init__(self, flat_indices, pad_mask, layers, discrete, log_std=None, eps=1e-5):
+        super().__init__()
+        n_agent, max_degree = pad_mask.shape
+        self.n_agent = n_agent
+        self.max_degree = max_degree
+        self.discrete = discrete
+        self.eps = eps
+        self.register_buffer('flat_indices', flat_indices)
+        self.register_buffer('pad_mask', pad_mask.float().view(1, n_agent, max_degree, 1))
+        self.layers = nn.ModuleList(layers)
+        if log_std is None:
+            log_std = torch.zeros(n_agent, 1, device=flat_indices.device)
+        self.register_buffer('log_std', log_std)
+
+    def forward(self, s, deterministic: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+        squeeze = s.dim() == 2
+        if squeeze:
+            s = s.unsqueeze(0)
+        b = s.size(0)
+        x = s.index_select(1, self.flat_indices).view(b, self.n_agent, self.max_degree, -1) * self.pad_mask
+        x = x.view(b, self.n_agent, -1).transpose(0, 1)
+        for layer in self.layers:
+            x = layer(x)
+        x = x.transpose(0, 1) # [b, n_agent, out_features]
+        if self.discrete:
+            probs = torch.softmax(x, dim=-1) + self.eps
+            probs = probs / probs.sum(dim=-1, keepdim=True)
+            if deterministic:
+                a = probs.argmax(dim=-1)
+            else:
+                a = torch.multinomial(probs.view(-1, probs.size(-1)), 1).view(b, self.n_agent)
+            logp = torch.log(probs.gather(-1, a.unsqueeze(-1))).squeeze(-1)
+        else:
+            std = torch.exp(self.log_std)
+            if deterministic:
+                a = x
+            else:
+                a = x + std * torch.randn_like(x)
+            logp = -((a - x) ** 2) / (2 * std ** 2) - self.log_std - math.log(math.sqrt(2 * math.pi))
+        if squeeze:
+            a, logp = a.squeeze(0), logp.squeeze(0)
+        return a, logp
+
+
+def _stackedActors(agent):
+    """ agent.actors as a StackedCategoricalActor or StackedGaussianActor, restacked if they are an nn.ModuleList """
+    if agent.stacked:
+        return agent.actors
+    from algorithms.models import StackedCategoricalActor, StackedGaussianActor
+    net_args = agent.pi_args._toDict()
+    net_args['sizes'] = [[degree * agent.observation_dim for degree in agent.collect_pi.degree.tolist()]] + list(net_args['sizes'][1:])
+    if agent.discrete:
+        actors = StackedCategoricalActor(agent.n_agent, **net_args)
+    else:
+        actors = StackedGaussianActor(agent.n_agent, action_dim=agent.action_dim, **net_args)
+    actors = actors.to(agent.device)
+    actors.load_state_dict(agent.actors.state_dict())
+    return actors
+
+
+def _layers(actors):
+    """ (weight, bias, activation) of each layer of stacked actors """
+    from algorithms.models import StackedLinear
+    modules = list(actors.network)
+    if hasattr(actors, 'action_head'):
+        modules += [actors.action_head, nn.Identity()]
+    layers = []
+    for linear, activation in zip(modules[::2], modules[1::2]):
+        if not isinstance(linear, StackedLinear):
+            raise NotImplementedError("only MLP actors can be exported")
+        layers.append((linear.weight.detach(), linear.bias.detach(), activation))
+    return layers
+
+
+def exportPolicy(agent, path=None, script=True):
+    """
+    Returns the StackedPolicy of an agent with collect_pi and actors (DPPOAgent, IA2C, MB_DPPOAgent),
+    scripted with TorchScript and saved to path if it is given.
+    With stacked actors, the policy shares the parameters of the agent, otherwise refresh it with updatePolicy().
+    """
+    if not hasattr(agent, 'collect_pi') or hasattr(agent, 'embedding_layers'):
+        raise NotImplementedError(f"{type(agent).__name__} cannot be exported")
+    collect = agent.collect_pi
+    actors = _stackedActors(agent)
+    layers = [StackedLayer(weight, bias, activation) for weight, bias, activation in _layers(actors)]
+    log_std = None if agent.discrete else actors.log_std.detach()
+    policy = StackedPolicy(collect.flat_indices, collect.pad_mask, layers, agent.discrete, log_std=log_std, eps=getattr(actors, 'eps', 1e-5))
+    if script:
+        policy = torch.jit.script(policy)
+    if path is not None:
+        torch.jit.save(policy, path)
+    return policy
+
+
+def updatePolicy(policy, agent):
+    """ Copies the current parameters of the agent into an exported policy, in place """
+    actors = _stackedActors(agent)
+    with torch.no_grad():
+        for i, (weight, bias, _) in enumerate(_layers(actors)):
+            layer = getattr(policy.layers, str(i))
+            for target, source in [(layer.weight, weight), (layer.bias, bias)]:
+                if target.data_ptr() != source.data_ptr():
+                    target.copy_(source)
+        if not agent.discrete and policy.log_std.data_ptr() != actors.log_std.data_ptr():
+            policy.log_std.copy_(actors.log_std)
+    return policy
+
+
+def loadPolicy(path, device='cpu'):
+    return torch.jit.load(path, map_location=device)
+
+
+class PolicyController:
+    """
+    Acts with an exported policy, e.g. in a controller process. Takes and returns numpy arrays.
+    """
+    def __init__(self, path, device='cpu', deterministic=True):
+        self.policy = loadPolicy(path, device)
+        self.device = device
+        self.deterministic = deterministic
+
+    def __call__(self, s):
+        with torch.no_grad():
+            s = torch.as_tensor(np.asarray(s), dtype=torch.float, device=self.device)
+            a, _ = self.policy(s, self.deterministic)
+            return a.cpu().numpy()
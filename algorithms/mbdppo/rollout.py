@@ -0,0 +1,91 @@
+import torch
+
+
+class ModelRollout:
+    """
+    Imagined rollouts of a ModelBasedAgent, with all the branches stepped together on one device.
+    Each step is written into preallocated [n_traj, T, n_agent, dim] tensors,
+    i.e. the padded batch layout of collateTrajectories() that updateAgent() consumes.
+    Each branch is predicted by one member of the model ensemble, drawn at random when it starts.
+    valid [n_traj, T, n_agent, 1] marks the steps that were evaluated, the others are padding to leave out of the losses.
+        mask_done: a branch stops at the first step where any of its agents is predicted done,
+            it is then no longer evaluated and its remaining steps are padding (d True, valid False, the others zero)
+        uncertainty_thres: a branch also stops after the first step where the members of the model ensemble disagree more than this
+    The padding of a stopped branch starts with s1 (s of its first padding step), from which AdvantageEstimator bootstraps
+    the last valid step unless it is done.
+    """
+    def __init__(self, agent, device="cpu", mask_done=False, uncertainty_thres=None):
+        self.agent = agent
+        self.device = device
+        self.mask_done = mask_done
+        self.uncertainty_thres = uncertainty_thres
+
+    def __call__(self, s, length, t=None):
+        """
+        Input: s: [n_traj, n_agent, state_dim], the initial states of the branches
+            t: [n_traj], the time index of each initial state in its episode, if known;
+            each branch then advances its own index, which model_step() passes to the reward oracle
+        Output: {name: [n_traj, length, n_agent, dim]} (s, a, r, s1, d, logp and valid), the number of branch-steps evaluated
+        """
+        with torch.no_grad():
+            s = s.to(self.device)
+            if t is not None:
+                t = t.to(self.device)
+            n_traj = s.shape[0]
+            batch = None
+            active = None # indices of the running branches, None if all of them are running
+            n_ensemble = getattr(self.agent, "n_ensemble", 1)
+            member = torch.randint(low=0, high=n_ensemble, size=(n_traj,), device=self.device) if n_ensemble > 1 else None
+            n_step = 0
+            for i in range(length):
+                dist = self.agent.act(s)
+                a = dist.sample()
+                logp = dist.log_prob(a)
+                if self.uncertainty_thres is not None:
+                    r, s1, d, _, disagreement = self.agent.model_step(s, a, uncertainty=True, member=member, t=t)
+                else:
+                    r, s1, d, _ = self.agent.model_step(s, a, member=member, t=t)
+                b, n = s.shape[:2]
+                [s, r, s1, logp] = [item.float() for item in [s, r, s1, logp]]
+                items = dict(zip(["s", "a", "r", "s1", "d", "logp"], [item.reshape(b, n, -1) for item in [s, a, r, s1, d.bool(), logp]]))
+                if batch is None:
+                    batch = {}
+                    for name, item in items.items():
+                        shape = [n_traj, length] + list(item.shape[1:])
+                        if name == 'd':
+                            batch[name] = torch.ones(shape, dtype=item.dtype, device=self.device)
+                        else:
+                            batch[name] = torch.zeros(shape, dtype=item.dtype, device=self.device)
+                    batch['valid'] = torch.zeros(batch['d'].shape, dtype=torch.bool, device=self.device)
+                items['valid'] = torch.ones_like(items['d'])
+                for name, item in items.items():
+                    if active is None:
+                        batch[name][:, i] = item
+                    else:
+                        batch[name][:, i].index_copy_(0, active, item)
+                n_step += b
+                if self.mask_done or self.uncertainty_thres is not None:
+                    running = torch.ones(b, dtype=torch.bool, device=self.device)
+                    if self.mask_done:
+                        running = running & ~items['d'].view(b, -1).any(dim=1)
+                    if self.uncertainty_thres is not None:
+                        running = running & (disagreement.view(b) <= self.uncertainty_thres)
+                    if i + 1 < length and not running.all():
+                        # the padding of a stopped branch starts with s1, so that its last step is bootstrapped from V(s1)
+                        rows = (~running).nonzero().view(-1)
+                        target = rows if active is None else active.index_select(0, rows)
+                        batch['s'][:, i + 1].index_copy_(0, target, items['s1'].index_select(0, rows))
+                    if not running.all():
+                        keep = running.nonzero().view(-1)
+                        active = keep if active is None else active.index_select(0, keep)
+                        s1 = s1.index_select(0, keep)
+                        if member is not None:
+                            member = member.index_select(0, keep)
+                        if t is not None:
+                            t = t.index_select(0, keep)
+                        if active.numel() == 0:
+                            break
+                s = s1
+                if t is not None:
+                    t = t + 1
+            return batch, n_step
@@ -34,6 +34,103 @@ def CNN(sizes, kernels, strides, paddings, activation, output_activation=nn.Iden
     return nn.Sequential(*layers)
 
 
+class StackedModule(nn.Module):
+    """
+    Base class of modules holding the parameters of n independent networks (one per agent) stacked at dim 0.
+    It also loads state_dicts in the layout of the equivalent nn.ModuleList, i.e. "{i}.{name}" instead of "{name}".
+    """
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        stackStateDict(state_dict, self, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class StackedLinear(StackedModule):
+    """
+    n independent linear layers evaluated in one batched matmul.
+    Input: [..., n, in_features], Output: [..., n, out_features]
+    in_features can be a list if the members have different input sizes,
+    the inputs of the smaller members are then expected to be zero-padded to the max.
+    """
+    def __init__(self, n, in_features, out_features):
+        super().__init__()
+        self.n = n
+        if isinstance(in_features, (list, tuple)):
+            self.in_sizes = [int(size) for size in in_features]
+        else:
+            self.in_sizes = [int(in_features)] * n
+        self.in_features = max(self.in_sizes)
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.zeros(n, out_features, self.in_features))
+        self.bias = nn.Parameter(torch.zeros(n, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # the same distribution as nn.Linear for each member, the padded part stays zero
+        with torch.no_grad():
+            self.weight.zero_()
+            for i, size in enumerate(self.in_sizes):
+                bound = 1 / np.sqrt(size)
+                self.weight[i, :, :size].uniform_(-bound, bound)
+                self.bias[i].uniform_(-bound, bound)
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, self.n, self.in_features).transpose(0, 1) # [n, batch_size, in_features]
+        x = torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+        return x.transpose(0, 1).reshape(*shape[:-1], self.out_features)
+
+
+class StackedMLP(StackedModule, nn.Sequential):
+    """
+    The stacked counterpart of MLP(), sizes[0] can be a list of the input sizes of the members.
+    """
+    def __init__(self, n, sizes, activation, output_activation=nn.Identity, **kwargs):
+        layers = []
+        for j in range(len(sizes) - 1):
+            act = activation if j < len(sizes) - 2 else output_activation
+            layers += [StackedLinear(n, sizes[j], sizes[j + 1]), act()]
+        super().__init__(*layers)
+        self.n = n
+
+
+def stackStateDict(state_dict, module, prefix=''):
+    """
+    Converts (in place) the entries of an nn.ModuleList state_dict ("{prefix}{i}.{name}")
+    into the stacked layout of module ("{prefix}{name}"), zero-padding the smaller members.
+    Does nothing if the state_dict is already stacked.
+    """
+    target = module.state_dict()
+    if all(prefix + name in state_dict for name in target):
+        return state_dict
+    if not all(f"{prefix}0.{name}" in state_dict for name in target):
+        return state_dict
+    for name, value in target.items():
+        stacked = torch.zeros_like(value)
+        for i in range(module.n):
+            item = state_dict.pop(f"{prefix}{i}.{name}")
+            stacked[tuple([i] + [slice(0, size) for size in item.shape])] = item
+        state_dict[prefix + name] = stacked
+    return state_dict
+
+
+def unstackStateDict(module, prefix=''):
+    """
+    Returns the state_dict of a stacked module in the layout of the equivalent nn.ModuleList ("{prefix}{i}.{name}").
+    """
+    in_sizes = {}
+    for name, item in module.named_modules():
+        if isinstance(item, StackedLinear):
+            in_sizes[f"{name}.weight" if name else "weight"] = item.in_sizes
+    state_dict = {}
+    for name, value in module.state_dict().items():
+        for i in range(module.n):
+            item = value[i]
+            if name in in_sizes:
+                item = item[:, :in_sizes[name][i]]
+            state_dict[f"{prefix}{i}.{name}"] = item.clone()
+    return state_dict
+
+
 class ParameterizedModel(nn.Module):
     """
         assumes parameterized state representation
@@ -335,75 +432,98 @@ class EnsembledModel(nn.Module):
         return loss_
 
 class GraphConvolutionalModel(nn.Module):
-    class EdgeNetwork(nn.Module):
-        def __init__(self, i, j, sizes, activation=nn.ReLU, output_activation=nn.Identity):
+    class EdgeNetworks(StackedModule):
+        """
+        The networks of all the edges (i, j), stacked and evaluated in one batched matmul.
+        Loads the state_dict of the nn.ModuleList of per-edge networks ("{e}.net.{k}.weight").
+        """
+        def __init__(self, edges, sizes, activation=nn.ReLU, output_activation=nn.Identity):
             super().__init__()
-            self.i = i
-            self.j = j
-            layers = []
-            for t in range(len(sizes) - 1):
-                act = activation if t < len(sizes) - 2 else output_activation
-                layers += [nn.Linear(sizes[t], sizes[t + 1]), act()]
-            self.net = nn.Sequential(*layers)
+            self.n = len(edges)
+            self.i = [i for i, _ in edges]
+            self.j = [j for _, j in edges]
+            self.output_dim = sizes[-1]
+            self.net = StackedMLP(self.n, sizes, activation, output_activation)
+            self.index = None
         
+        def _index(self, device):
+            if self.index is None or self.index[0].device != device:
+                self.index = (torch.tensor(self.i, dtype=torch.long, device=device), torch.tensor(self.j, dtype=torch.long, device=device))
+            return self.index
+
         def forward(self, s:torch.Tensor):
             """
             Input: [batch_size, n_agent, node_embed_dim] # raw input
-            Output: [batch_size, edge_embed_dim]
+            Output: [batch_size, n_edge, edge_embed_dim]
             """
-            s1 = s.select(dim=1, index=self.i)
-            s2 = s.select(dim=1, index=self.j)
-            s = torch.cat([s1, s2], dim=-1)
+            if self.n == 0:
+                return s.new_zeros(s.shape[0], 0, self.output_dim)
+            i, j = self._index(s.device)
+            s = torch.cat([s.index_select(1, i), s.index_select(1, j)], dim=-1)
             return self.net(s)
+
+        def aggregate(self, h, n_agent):
+            """
+            Sums the edge messages into both ends of each edge.
+            Input: [batch_size, n_edge, edge_embed_dim]
+            Output: [batch_size, n_agent, edge_embed_dim]
+            """
+            i, j = self._index(h.device)
+            result = torch.zeros(h.shape[0], n_agent, h.shape[2], dtype=h.dtype, device=h.device)
+            return result.index_add(1, i, h).index_add(1, j, h)
     
-    class NodeNetwork(nn.Module):
-        def __init__(self, sizes, n_embedding=0, action_dim=0, activation=nn.ReLU, output_activation=nn.ReLU):
+    class StackedEmbedding(StackedModule):
+        def __init__(self, n, num_embeddings, embedding_dim):
             super().__init__()
-            layers = []
-            for t in range(len(sizes) - 1):
-                act = activation if t < len(sizes) - 2 else output_activation
-                layers += [nn.Linear(sizes[t], sizes[t + 1]), act()]
-            self.net = nn.Sequential(*layers)
-            
-            
+            self.n = n
+            self.weight = nn.Parameter(torch.randn(n, num_embeddings, embedding_dim))
+
+        def forward(self, x):
+            """
+            Input: [batch_size, n] (long), Output: [batch_size, n, embedding_dim]
+            """
+            members = torch.arange(self.n, device=x.device).unsqueeze(0).expand(*x.shape)
+            return self.weight[members, x]
+
+    class NodeNetworks(StackedModule):
+        """
+        The networks of all the nodes, stacked and evaluated in one batched matmul.
+        Loads the state_dict of the nn.ModuleList of per-node networks.
+        """
+        def __init__(self, n_agent, sizes, n_embedding=0, action_dim=0, activation=nn.ReLU, output_activation=nn.ReLU):
+            super().__init__()
+            self.n = n_agent
+            self.n_embedding = n_embedding
+            self.net = StackedMLP(n_agent, sizes, activation, output_activation)
             if n_embedding != 0:
-                self.action_embedding_fn = nn.Embedding(action_dim, n_embedding)
-                self.action_embedding = lambda x: self.action_embedding_fn(x.squeeze(-1))
-            else:
-                self.action_embedding = nn.Identity()
+                self.action_embedding_fn = GraphConvolutionalModel.StackedEmbedding(n_agent, action_dim, n_embedding)
 
-        def forward(self, h_ls, a):
+        def forward(self, h, a):
             """
             Input: 
-                h_ls: list of tensors with sizes of [batch_size, edge_embed_dim]
-                a: [batch_size, action_dim]
+                h: [batch_size, n_agent, edge_embed_dim], the sum of the edge messages of each node
+                a: [batch_size, n_agent, action_dim]
             Output: 
-                h: [batch_size, node_embed_dim]
+                h: [batch_size, n_agent, node_embed_dim]
             """
-            embedding = 0
-            for h in h_ls:
-                embedding += h
-            a = self.action_embedding(a)
-            while a.ndim < embedding.ndim:
+            if self.n_embedding != 0:
+                a = self.action_embedding_fn(a.squeeze(-1).long())
+            else:
+                a = a.to(h.dtype)
+            while a.ndim < h.ndim:
                 a = a.unsqueeze(-1)
-            embedding = torch.cat([embedding, a], dim=-1)
+            embedding = torch.cat([h, a], dim=-1)
             return self.net(embedding)
 
     class NodeWiseEmbedding(nn.Module):
         def __init__(self, n_agent, input_dim, output_dim, output_activation):
             super().__init__()
-            self.nets = nn.ModuleList()
             self.n_agent = n_agent
-            for _ in range(n_agent):
-                self.nets.append(nn.Sequential(*[nn.Linear(input_dim, output_dim), output_activation()]))
+            self.nets = StackedMLP(n_agent, [input_dim, output_dim], output_activation, output_activation)
         
         def forward(self, h):
             # input dim = 3, output the same
-            items = []
-            for i in range(self.n_agent):
-                items.append(self.nets[i](h.select(dim=1, index=i)))
-            items = torch.stack(items, dim=1)
-            return items
+            return self.nets(h)
 
     def __init__(self, logger, adj, state_dim, action_dim, n_agent, p_args):
         super().__init__()
@@ -420,6 +540,9 @@ class GraphConvolutionalModel(nn.Module):
         self.node_embed_dim = p_args.node_embed_dim
         self.node_hidden_size = p_args.node_hidden_size
         self.reward_coeff = p_args.reward_coeff
+        # the members of the ensemble are stacked as n_ensemble disjoint copies of the graph
+        self.n_ensemble = 1 if (not hasattr(p_args, "n_ensemble")) else p_args.n_ensemble
+        self.n_node = self.n_ensemble * n_agent
 
         self.node_nets = self._init_node_nets()
         self.edge_nets = self._init_edge_nets()
@@ -427,24 +550,72 @@ class GraphConvolutionalModel(nn.Module):
         self.MSE = nn.MSELoss(reduction='none')
         self.BCE = nn.BCELoss(reduction='none')
     
-    def predict(self, s, a):
+    def predict(self, s, a, member=None, uncertainty=False):
         """
             Input: 
                 s: [batch_size, n_agent, state_dim]
                 a: [batch_size, n_agent, action_dim]
+                member: [batch_size], the ensemble member of each sample, random if None
+                uncertainty: also returns the disagreement of the members on s1, [batch_size],
+                    all the members are then evaluated on all the samples
             Output: [batch_size, n_agent, state_dim] # same as input state
         """
         with torch.no_grad():
-            r1, s1, d1 = self.forward(s, a)
+            b, n = s.shape[:2]
+            K = self.n_ensemble
+            if member is None and K > 1:
+                member = torch.randint(low=0, high=K, size=(b,), device=s.device)
+            if K == 1:
+                r1, s1, d1 = self.forward(s, a)
+                disagreement = torch.zeros(b, device=s.device)
+            elif uncertainty:
+                r1, s1, d1 = [item.view(b, K, n, -1) for item in self.forward(s.repeat(1, K, 1), a.repeat(1, K, 1))]
+                disagreement = s1.std(dim=1).view(b, -1).mean(dim=1)
+                idxs = torch.arange(b, device=s.device)
+                r1, s1, d1 = [item[idxs, member] for item in [r1, s1, d1]]
+            else:
+                r1, s1, d1 = self._forwardMembers(s, a, member)
             done = torch.clamp(d1, 0., 1.)
             done = torch.cat([1 - done, done], dim=-1)
             done = Categorical(done).sample() > 0  # [b]
+            if uncertainty:
+                return r1, s1, done, disagreement
             return r1, s1, done
+
+    def _forwardMembers(self, s, a, member):
+        """
+        Evaluates each sample only by its own member, in one forward pass:
+        the samples are grouped by member into [max_group_size, n_ensemble * n_agent, dim], the rest of the groups zero-padded.
+        """
+        b, n = s.shape[:2]
+        K = self.n_ensemble
+        member_mask = F.one_hot(member, K)
+        rank = (member_mask.cumsum(dim=0) - 1).gather(1, member.unsqueeze(1)).squeeze(1) # index of each sample in its group
+        m = int(member_mask.sum(dim=0).max())
+        def group(x):
+            grouped = x.new_zeros(m, K, n, x.shape[-1])
+            grouped[rank, member] = x
+            return grouped.view(m, K * n, -1)
+        return [item.view(m, K, n, -1)[rank, member] for item in self.forward(group(s), group(a))]
+
+    def _toMembers(self, x):
+        """
+        [n_ensemble * batch_size, T, n_agent, dim] -> [batch_size, T, n_ensemble * n_agent, dim],
+        member k is trained on the k-th chunk of the batch, i.e. on its own bootstrap sample.
+        """
+        K = self.n_ensemble
+        if K == 1:
+            return x
+        b, T, n, dim = x.shape
+        b = b // K
+        return x[:K * b].view(K, b, T, n, dim).permute(1, 2, 0, 3, 4).reshape(b, T, K * n, dim)
     
     def train(self, s, a, r, s1, d, length = 1):
         """
         Input shape: [batch_size, T, n_agent, dim]
+        With an ensemble, the batch is split evenly into the bootstrap samples of the members.
         """
+        s, a, r, s1, d = [self._toMembers(item) for item in [s, a, r, s1, d]]
         pred_s, pred_r, pred_d = [], [], []
         s0 = s.select(dim=1, index=0)
         length = min(length, s.shape[1])
@@ -489,22 +660,14 @@ class GraphConvolutionalModel(nn.Module):
     
     def forward(self, s, a):
         """
-            Input: [batch_size, n_agent, state_dim]
-            Output: [batch_size, n_agent, state_dim]
+            Input: [batch_size, n_ensemble * n_agent, state_dim], member k takes the k-th block of n_agent nodes
+            Output: [batch_size, n_ensemble * n_agent, state_dim]
         """
         embedding = self.node_embedding(s) # dim = 3
         for _ in range(self.n_conv):
-            edge_info_of_nodes = [[] for __ in range(self.n_agent)]
-            for edge_net in self.edge_nets:
-                edge_info = edge_net(embedding) # dim = 2
-                edge_info_of_nodes[edge_net.i].append(edge_info)
-                edge_info_of_nodes[edge_net.j].append(edge_info)
-            node_preds = []
-            for i in range(self.n_agent):
-                node_net = self.node_nets[i]
-                node_pred = node_net(edge_info_of_nodes[i], a.select(dim=1, index=i)) # dim = 2
-                node_preds.append(node_pred)
-            embedding = torch.stack(node_preds, dim=1) # dim = 3
+            edge_info = self.edge_nets(embedding) # [batch_size, n_edge, edge_embed_dim]
+            edge_info_of_nodes = self.edge_nets.aggregate(edge_info, self.n_node) # [batch_size, n_agent, edge_embed_dim]
+            embedding = self.node_nets(edge_info_of_nodes, a) # dim = 3
         state_pred = self.state_head(embedding)
         if self.residual:
             state_pred += s
@@ -513,27 +676,26 @@ class GraphConvolutionalModel(nn.Module):
         return reward_pred, state_pred, done_pred
 
     def _init_node_nets(self):
-        node_nets = nn.ModuleList()
         action_dim = self.n_embedding if self.n_embedding > 0 else self.action_dim
         sizes = [self.edge_embed_dim + action_dim] + self.node_hidden_size + [self.node_embed_dim]
-        for i in range(self.n_agent):
-            node_nets.append(GraphConvolutionalModel.NodeNetwork(sizes=sizes, n_embedding=self.n_embedding, action_dim=self.action_dim))
-        return node_nets
+        return GraphConvolutionalModel.NodeNetworks(self.n_node, sizes=sizes, n_embedding=self.n_embedding, action_dim=self.action_dim)
 
     def _init_edge_nets(self):
-        edge_nets = nn.ModuleList()
+        edges = []
         sizes = [self.node_embed_dim * 2] + self.edge_hidden_size + [self.edge_embed_dim]
-        for i in range(self.n_agent):
-            for j in range(i + 1, self.n_agent):
-                if self.adj[i][j]:
-                    edge_nets.append(GraphConvolutionalModel.EdgeNetwork(i, j, sizes))
-        return edge_nets
+        for k in range(self.n_ensemble):
+            offset = k * self.n_agent
+            for i in range(self.n_agent):
+                for j in range(i + 1, self.n_agent):
+                    if self.adj[i][j]:
+                        edges.append((offset + i, offset + j))
+        return GraphConvolutionalModel.EdgeNetworks(edges, sizes)
 
     def _init_node_embedding(self):
-        node_embedding = GraphConvolutionalModel.NodeWiseEmbedding(self.n_agent, self.state_dim, self.node_embed_dim, output_activation=nn.ReLU)
-        state_head = GraphConvolutionalModel.NodeWiseEmbedding(self.n_agent, self.node_embed_dim, self.state_dim, output_activation=nn.Identity)
-        reward_head = GraphConvolutionalModel.NodeWiseEmbedding(self.n_agent, self.node_embed_dim, 1, nn.Identity)
-        done_head = GraphConvolutionalModel.NodeWiseEmbedding(self.n_agent, self.node_embed_dim, 1, nn.Sigmoid)
+        node_embedding = GraphConvolutionalModel.NodeWiseEmbedding(self.n_node, self.state_dim, self.node_embed_dim, output_activation=nn.ReLU)
+        state_head = GraphConvolutionalModel.NodeWiseEmbedding(self.n_node, self.node_embed_dim, self.state_dim, output_activation=nn.Identity)
+        reward_head = GraphConvolutionalModel.NodeWiseEmbedding(self.n_node, self.node_embed_dim, 1, nn.Identity)
+        done_head = GraphConvolutionalModel.NodeWiseEmbedding(self.n_node, self.node_embed_dim, 1, nn.Sigmoid)
         return node_embedding, state_head, reward_head, done_head
 
 
@@ -697,6 +859,49 @@ class GaussianActor(nn.Module):
             distri = Normal(mean, std)
             return distri.log_prob(a).sum(dim=-1)
 
+class StackedCategoricalActor(StackedModule):
+    """
+    The stacked counterpart of n CategoricalActors with MLP networks.
+    Input: [..., n, dim], Output: [..., n, action_dim]
+    """
+
+    def __init__(self, n, **net_args):
+        super().__init__()
+        self.n = n
+        self.softmax = nn.Softmax(dim=-1)
+        self.network = StackedMLP(n, **net_args)
+        self.eps = 1e-5
+
+    def forward(self, obs):
+        logit = self.network(obs)
+        probs = self.softmax(logit)
+        probs = (probs + self.eps)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+        return probs
+
+class StackedGaussianActor(StackedModule):
+    """
+    The stacked counterpart of n GaussianActors with MLP networks.
+    Input: [..., n, dim], Output: [..., n, action_dim] (acting) or [..., n] (log prob of a)
+    """
+    def __init__(self, n, action_dim, **net_args):
+        super().__init__()
+        self.n = n
+        self.network = StackedMLP(n, **net_args)
+        self.output_size = net_args['sizes'][-1]
+        self.action_head = StackedLinear(n, self.output_size, action_dim)
+        self.log_std = torch.nn.Parameter(- 0.5 * torch.ones(n, action_dim, dtype=torch.float32))
+
+    def forward(self, obs, a=None):
+        output = self.network(obs)
+        mean = self.action_head(output)
+        std = torch.exp(self.log_std).expand(*mean.shape)
+        if a is None: # acting
+            return mean, std
+        else:
+            distri = Normal(mean, std)
+            return distri.log_prob(a).sum(dim=-1)
+
 class SquashedGaussianActor(nn.Module):
     """
     Squashed Gaussian actor used in SAC.
@@ -7,6 +7,11 @@ import wandb
 from ray.util import pdb
 import ray
 import time
+import pickle
+import shutil
+import queue
+import threading
+import atexit
 from torch.utils.tensorboard import SummaryWriter
 
 import gc
@@ -325,10 +330,14 @@ class LogClient(object):
         all None valued keys are counters
         this feature is helpful when logging from model interior
         since the model should be step-agnostic
+        a call with counters only (e.g. .log(interaction=None)) only increments them
+        .count(key, n) adds n to a counter at once
     Sets seed for each process
     Centralized saving
     economic logging
         stores the values, log once per log_period
+        only the latest value of each key is kept (a copy, the tensors stay on their device),
+        without any device sync, the nan checks and the writes are done by the server thread
     syntactic sugar
         supports both .log(data={key: value}) and .log(key=value) 
     multiple backends
@@ -340,7 +349,8 @@ class LogClient(object):
         children get n_interaction from the root logger
     """
     def __init__(self, server, prefix=""):
-        self.buffer = {}
+        self.buffer = {} # counters
+        self.series = {} # the latest value of each key
         if isinstance(server, LogClient):
             prefix = f"{server.prefix}/{prefix}"
             server = server.server
@@ -359,45 +369,44 @@ class LogClient(object):
         
     def log(self, raw_data=None, **kwargs):
         if raw_data is None:
-            raw_data = {}
-        raw_data.update(kwargs)
-        
-        data = {}
-        for key in raw_data: # also logs the mean for histograms
-            data[key] = raw_data[key]
-            if isinstance(data[key], torch.Tensor) and len(data[key].shape)>0 or\
-            isinstance(data[key], np.ndarray) and len(data[key].shape)> 0:
-                data[key+'_mean'] = data[key].mean()
+            raw_data = kwargs
+        else:
+            raw_data.update(kwargs)
             
-        # updates the buffer
-        for key in data:
-            if data[key] is None:
-                if not key in self.buffer:
-                    self.buffer[key] = 0
-                self.buffer[key] += 1
-            else:
-                valid = True
-                # check nans
-                if isinstance(data[key], torch.Tensor):
-                    data[key] = data[key].detach().cpu()
-                    if torch.isnan(data[key]).any():
-                        valid = False
-                elif np.isnan(data[key]).any():
-                    valid = False
-                if not valid:
-                    print(f'{key} is nan!')
-                   # pdb.set_trace()
-                    continue
-                self.buffer[key] = data[key]
+        buffer, series = self.buffer, self.series
+        # the copy of a key replaces the previous one, which is then freed
+        for key, value in raw_data.items():
+            if value is None:
+                buffer[key] = buffer.get(key, 0) + 1
+                continue
+            # copies the value, the tensors stay on their device
+            if isinstance(value, torch.Tensor):
+                value = value.detach().clone()
+            elif isinstance(value, np.ndarray):
+                value = value.copy()
+            series[key] = value
 
         # uploading
         if time.time()>self.log_period+self.last_log:
             self.flush()
 
-    def save(self, model, info=None):
-        state_dict = model.state_dict()
-        state_dict = {k: state_dict[k].cpu() for k in state_dict}
-        self.server.save({self.prefix: state_dict}, info)
+    def count(self, key, n=1):
+        self.buffer[key] = self.buffer.get(key, 0) + n
+        if time.time()>self.log_period+self.last_log:
+            self.flush()
+
+    def save(self, model, info=None, key=None, flush=True):
+        """
+        Saves model.state_dict() as key (the prefix by default), and the state of its optimizers as key/optimizer
+        The tensors are not copied here, the server snapshots them when it writes a checkpoint
+        """
+        if key is None:
+            key = self.prefix
+        state_dict = {key: model.state_dict()}
+        optimizers = optimizerStateDicts(model)
+        if len(optimizers) > 0:
+            state_dict[f"{key}/optimizer"] = optimizers
+        self.server.save(state_dict, info, flush=flush)
         
     def getArgs(self):
         return self.server.getArgs()
@@ -427,6 +436,11 @@ class LogServer(object):
             self.logger = run
             self.writer = SummaryWriter(log_dir=f"runs/{self.name}")
             self.writer.add_text("config", f"{args._toDict(recursive=True)}")
+            # the backends are written by a single thread, see flush()
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
 
         self.mute = mute
         self.args = args
@@ -436,52 +450,299 @@ class LogServer(object):
         self.step = 0
         self.step_key = 'interaction'
         exists_or_mkdir(f"checkpoints/{self.name}")
+        if not mute:
+            self.checkpoints = CheckpointWriter(f"checkpoints/{self.name}", getattr(args, 'n_checkpoint', None))
         
     def getArgs(self):
         return self.args
             
     def flush(self, logger=None):
+        """
+        Hands the values buffered by a LogClient to the writer thread, and clears them
+        flush() without logger waits until all the values handed so far are written
+        """
+        if logger is None:
+            if not self.mute:
+                self.queue.join()
+            return None
+        series, logger.series = logger.series, {}
         if self.mute:
             return None
-        if logger is None:
-            logger = self
-        buffer = logger.buffer
+        self.queue.put((logger.prefix, dict(logger.buffer), series))
+        self.last_log = time.time()
+        
+    def close(self):
+        if self.mute or not self.thread.is_alive():
+            return None
+        self.queue.put(None)
+        self.thread.join()
+        
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return None
+                self._write(*batch)
+            except Exception as e:
+                print(f"logging failed: {e!r}")
+            finally:
+                self.queue.task_done()
+        
+    def _write(self, prefix, counters, series):
         data = {}
-        for key in buffer:
+        for key in counters:
             if key == self.step_key:
-                self.step = buffer[key]
-            log_key = logger.prefix+"/"+key
+                self.step = counters[key]
+            data[key] = counters[key]
+        for key in series:
+            # the latest value if it is valid, also logs the mean for histograms
+            value = series[key]
+            if isinstance(value, torch.Tensor):
+                value = value.cpu()
+                valid = not torch.isnan(value).any()
+            else:
+                valid = not np.isnan(value).any()
+            if not valid:
+                print(f'{key} is nan!')
+                continue
+            data[key] = value
+            if isinstance(value, (torch.Tensor, np.ndarray)) and len(value.shape) > 0:
+                data[key+'_mean'] = value.float().mean() if isinstance(value, torch.Tensor) else value.mean()
+            
+        logged = {}
+        for key in data:
+            log_key = prefix+"/"+key
             while log_key[0] == '/':
                  # removes the first slash, to be wandb compatible
                 log_key = log_key[1:]
-            data[log_key] = buffer[key]
+            logged[log_key] = data[key]
 
-            if isinstance(data[log_key], torch.Tensor) and len(data[log_key].shape)>0 or\
-            isinstance(data[log_key], np.ndarray) and len(data[log_key].shape)> 0:
-                self.writer.add_histogram(log_key, data[log_key], self.step)
+            if isinstance(data[key], torch.Tensor) and len(data[key].shape)>0 or\
+            isinstance(data[key], np.ndarray) and len(data[key].shape)> 0:
+                self.writer.add_histogram(log_key, data[key], self.step)
             else:
-                self.writer.add_scalar(log_key, data[log_key], self.step)
-            self.writer.flush()
+                self.writer.add_scalar(log_key, data[key], self.step)
+        self.writer.flush()
 
-        self.logger.log(data=data, step =self.step, commit=False)
+        self.logger.log(data=logged, step =self.step, commit=False)
         # "warning: step must only increase "commit = True
         # because wandb assumes step must increase per commit
-        self.last_log = time.time()
         
     def save(self, state_dict=None, info=None, flush=True):
         if not state_dict is None:
             self.state_dict.update(**state_dict)
         if flush and time.time() - self.last_save >= self.save_period:
-            filename = f"{self.step}_{info}.pt"
+            filename = f"{self.step}.ckpt" if info is None else f"{self.step}_{info}.ckpt"
             if not self.mute:
-                with open(f"checkpoints/{self.name}/{filename}", 'wb') as f:
-                    torch.save(self.state_dict, f)
+                # only the snapshot of the tensors blocks, the files are written by the writer thread
+                self.checkpoints.save(self.state_dict, filename)
                 print(f"checkpoint saved as {filename}")
             else:
                 print("not saving checkpoints because the logger is muted")
             self.last_save = time.time()
             
 
+class _Stored(object):
+    """ The placeholder of a tensor in the index of a checkpoint """
+    def __init__(self, file, dtype, device):
+        self.file = file
+        self.dtype = dtype
+        self.device = device
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread
+    
+    A checkpoint is a directory with one .npy file per tensor and index.pkl, the pickled state with the tensors
+    replaced by _Stored placeholders, so that the tensors can be memory-mapped and loaded selectively (see loadCheckpoint)
+    
+    save() copies the tensors into preallocated (pinned, for cuda tensors) cpu buffers with non-blocking copies,
+    the thread waits for the copies, writes the files into a temporary directory and renames it, 
+    then removes all but the last n_keep checkpoints (None keeps all of them)
+    """
+    def __init__(self, directory, n_keep=None):
+        self.directory = directory
+        self.n_keep = n_keep
+        self.buffers = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        
+    def save(self, state, filename):
+        # the buffers of the previous checkpoint are reused
+        self.wait()
+        tensors = []
+        index = self._snapshot(state, tensors)
+        event = None
+        if torch.cuda.is_available() and any(buffer.is_pinned() for _, buffer in tensors):
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((filename, index, tensors, event))
+        
+    def _snapshot(self, state, tensors):
+        if isinstance(state, torch.Tensor):
+            file = f"{len(tensors)}.npy"
+            buffer = self.buffers.get(file)
+            if buffer is None or buffer.shape != state.shape or buffer.dtype != state.dtype:
+                buffer = torch.empty(state.shape, dtype=state.dtype, pin_memory=state.is_cuda)
+                self.buffers[file] = buffer
+            buffer.copy_(state.detach(), non_blocking=True)
+            tensors.append((file, buffer))
+            return _Stored(file, state.dtype, str(state.device))
+        if isinstance(state, dict):
+            return _rebuild(state, ((key, self._snapshot(value, tensors)) for key, value in state.items()))
+        if isinstance(state, (list, tuple)):
+            return type(state)(self._snapshot(value, tensors) for value in state)
+        return state
+        
+    def wait(self):
+        self.queue.join()
+        
+    def close(self):
+        if not self.thread.is_alive():
+            return None
+        self.queue.put(None)
+        self.thread.join()
+        
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return None
+                self._write(*job)
+            except Exception as e:
+                print(f"saving the checkpoint failed: {e!r}")
+            finally:
+                self.queue.task_done()
+                
+    def _write(self, filename, index, tensors, event):
+        if event is not None:
+            event.synchronize()
+        path = os.path.join(self.directory, filename)
+        tmp = os.path.join(self.directory, f".{filename}.tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for file, buffer in tensors:
+            np.save(os.path.join(tmp, file), buffer.numpy())
+        with open(os.path.join(tmp, "index.pkl"), "wb") as f:
+            pickle.dump(index, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp, path)
+        
+        if self.n_keep is not None:
+            saved = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".ckpt")]
+            saved.sort(key=os.path.getmtime)
+            for old in saved[:-self.n_keep]:
+                shutil.rmtree(old, ignore_errors=True)
+
+def loadCheckpoint(path, key=None, modules=None, map_location='cpu'):
+    """
+    Loads a checkpoint written by CheckpointWriter, or a .pt file saved by torch.save
+    key: only returns state[key], e.g. the state_dict of the root logger is state[""]
+    modules: with key, only loads the entries of state[key] that belong to these modules,
+        e.g. ['ps'] for the world model or ['actors'] for the policies
+    The tensors are memory-mapped (copy on write) and are only read when used, or moved if map_location is not 'cpu'
+    """
+    if not os.path.isdir(path):
+        state = torch.load(path, map_location=map_location)
+    else:
+        with open(os.path.join(path, "index.pkl"), "rb") as f:
+            state = pickle.load(f)
+    if key is not None:
+        state = state[key]
+        if modules is not None:
+            prefixes = tuple(f"{module}." for module in modules)
+            state = _rebuild(state, ((name, value) for name, value in state.items() if name.startswith(prefixes)))
+    if os.path.isdir(path):
+        state = _loadStored(path, state, map_location)
+    return state
+
+def _loadStored(path, state, map_location):
+    if isinstance(state, _Stored):
+        tensor = torch.from_numpy(np.load(os.path.join(path, state.file), mmap_mode='c'))
+        if map_location != 'cpu':
+            tensor = tensor.to(map_location)
+        return tensor
+    if isinstance(state, dict):
+        return _rebuild(state, ((key, _loadStored(path, value, map_location)) for key, value in state.items()))
+    if isinstance(state, (list, tuple)):
+        return type(state)(_loadStored(path, value, map_location) for value in state)
+    return state
+
+def _rebuild(state, items):
+    # keeps the _metadata of module state_dicts
+    result = type(state)(items)
+    if hasattr(state, '_metadata'):
+        result._metadata = state._metadata
+    return result
+
+def optimizerStateDicts(model):
+    """ The state_dict of each optimizer attribute of model, e.g. {'optimizer_pi': ...} """
+    return {name: value.state_dict() for name, value in vars(model).items() if isinstance(value, torch.optim.Optimizer)}
+
+def loadOptimizerStateDicts(model, state_dict):
+    """ Loads the optimizer states saved by LogClient.save, the optimizers of model that are not in state_dict are left as is """
+    for name, value in state_dict.items():
+        optimizer = getattr(model, name, None)
+        if isinstance(optimizer, torch.optim.Optimizer):
+            optimizer.load_state_dict(value)
+
+class EpisodeRecorder(object):
+    """
+    Records the test episodes of a round as columns
+    
+    Each field (e.g. s, a, r, d) is a [n_episode, max_length, ...] .npy file under path/{round}/, 
+    created on its first step and written in place through a memory map, so that the episodes are streamed to the disk
+    while they run. lengths.npy, written by close(), marks the round as complete. Read them with loadEpisodes().
+    """
+    def __init__(self, path, n_episode, max_length):
+        exists_or_mkdir(path)
+        self.round = len([name for name in os.listdir(path) if name.isdigit()])
+        self.path = os.path.join(path, f"{self.round:05d}")
+        exists_or_mkdir(self.path)
+        self.n_episode = n_episode
+        self.max_length = max_length
+        self.lengths = np.zeros(n_episode, dtype=np.int64)
+        self.columns = {}
+        
+    def store(self, episode, **fields):
+        """ appends one step to an episode """
+        t = self.lengths[episode]
+        for name, value in fields.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach().cpu().numpy()
+            value = np.asarray(value)
+            if not name in self.columns:
+                self.columns[name] = np.lib.format.open_memmap(os.path.join(self.path, f"{name}.npy"), mode='w+',
+                                                               dtype=value.dtype, shape=(self.n_episode, self.max_length) + value.shape)
+            self.columns[name][episode, t] = value
+        self.lengths[episode] = t + 1
+        
+    def close(self):
+        for column in self.columns.values():
+            column.flush()
+        self.columns = {}
+        np.save(os.path.join(self.path, "lengths.npy"), self.lengths)
+
+def loadEpisodes(path):
+    """
+    Memory-maps the test rounds recorded by EpisodeRecorder under path
+    Returns a list of {field: [n_episode, max_length, ...], 'lengths': [n_episode]}, one per complete round, in order
+    The steps after the length of an episode are zeros
+    """
+    rounds = []
+    for name in sorted(os.listdir(path)):
+        directory = os.path.join(path, name)
+        if not name.isdigit() or not os.path.exists(os.path.join(directory, "lengths.npy")):
+            continue
+        columns = {file[:-len(".npy")]: np.load(os.path.join(directory, file), mmap_mode='r')
+                   for file in os.listdir(directory) if file.endswith(".npy")}
+        rounds.append(columns)
+    return rounds
+
 def setSeed(seed):
     random.seed(seed)
     np.random.seed(seed)
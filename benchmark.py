@@ -0,0 +1,444 @@
+"""
+Microbenchmarks for the hot paths of the training loop.
+Each benchmark first checks that the fast path matches the reference implementation, then times both,
+except for sumo, which compares the steps/sec of the TraCI and libsumo backends, and loop, which checks the
+numpy loop simulator against SUMO trajectories recorded in benchmark_data, a parity test on the ring only
+(python benchmark.py --target loop --record records them again). policy compares agent.act() with the exported TorchScript policy.
+ic3net compares the per-sample IC3Net forward with the batched one, at --batch_size and at a batch of 10k.
+rollout compares ModelRollout, with and without mask_done, with the per-step loop of model rollouts it replaced,
+on --batch_size branches of a deterministic (greedy, thresholded dones) untrained catchup model.
+
+Usage:
+python benchmark.py --target collect
+"""
+import os
+import time
+import argparse
+
+import torch
+
+
+def timeit(fn, n_repeat=20):
+    fn() # warm up
+    time_t = time.time()
+    for _ in range(n_repeat):
+        fn()
+    return (time.time() - time_t) / n_repeat
+
+
+def chainAdjacency(n_agent, radius=1):
+    """The neighbor mask of a platoon (CACC) with the given observable radius."""
+    adj = torch.eye(n_agent)
+    for i in range(n_agent - 1):
+        adj[i, i + 1] = 1
+        adj[i + 1, i] = 1
+    return torch.matrix_power(adj, radius)
+
+
+class NullLogger:
+    """A logger that drops everything, for the agents built by the benchmarks."""
+    prefix = ''
+
+    def __init__(self):
+        self.buffer = {'interaction': 0}
+
+    def child(self, prefix=''):
+        return self
+
+    def log(self, *args, **kwargs):
+        pass
+
+
+def catchupAgentArgs(config, n_agent, **overrides):
+    """The agent_args of a CACC catchup config (e.g. 'Catchup_DPPO') for a platoon of n_agent vehicles."""
+    import importlib
+    from gym.spaces import Box, Discrete
+    from algorithms.utils import Config
+    env = Config()
+    env.neighbor_mask = chainAdjacency(n_agent).numpy()
+    env.observation_space = Box(-1e6, 1e6, [5])
+    env.action_space = Discrete(4)
+    agent_args = importlib.import_module(f"algorithms.config.{config}").getArgs(1, 2, 1, env).agent_args
+    for name, value in overrides.items():
+        setattr(agent_args, name, value)
+    return agent_args
+
+
+def benchCollect(args):
+    from algorithms.mbdppo.MB_DPPO import MultiCollect
+
+    def reference(collect, method, tensor):
+        b, n, depth = tensor.shape
+        result = []
+        for i in range(n):
+            selected = torch.index_select(tensor, dim=1, index=collect.indices[i])
+            if method == 'gather':
+                result.append(selected.view(b, -1))
+            elif method == 'reduce_mean':
+                result.append(selected.mean(dim=1))
+            else:
+                result.append(selected.sum(dim=1))
+        if method != 'gather':
+            result = torch.stack(result, dim=1)
+        return result
+
+    for n_agent in [8, 32, 128, 512]:
+        for radius in [1, 3]:
+            collect = MultiCollect(chainAdjacency(n_agent, radius), device=args.device)
+            tensor = torch.randn(args.batch_size, n_agent, 5, device=args.device)
+            for method in ['gather', 'reduce_mean', 'reduce_sum']:
+                fast = collect._collect(method, tensor)
+                ref = reference(collect, method, tensor)
+                if method == 'gather':
+                    assert all(torch.equal(x, y) for x, y in zip(fast, ref)), f"gather mismatch at n_agent={n_agent}"
+                else:
+                    assert torch.allclose(fast, ref, atol=1e-5), f"{method} mismatch at n_agent={n_agent}"
+                t_ref = timeit(lambda: reference(collect, method, tensor))
+                t_fast = timeit(lambda: collect._collect(method, tensor))
+                print(f"n_agent {n_agent:4d} radius {radius} {method:12s} loop {t_ref*1e3:8.3f}ms batched {t_fast*1e3:8.3f}ms speedup {t_ref/t_fast:6.2f}x")
+
+
+def benchGAE(args):
+    from algorithms.mbdppo.advantage import AdvantageEstimator
+
+    def reference(value, last_value, r, d, gamma, lamda, use_rtg, use_gae_returns):
+        b, T, n, _ = value.shape
+        returns = torch.zeros(value.size())
+        deltas, advantages = torch.zeros_like(returns), torch.zeros_like(returns)
+        prev_value = last_value
+        prev_return = prev_value if not use_rtg else torch.zeros_like(prev_value)
+        prev_advantage = torch.zeros_like(prev_return)
+        d_mask = d.float()
+        for t in reversed(range(T)):
+            deltas[:, t] = r.select(1, t) + gamma * (1 - d_mask.select(1, t)) * prev_value - value.select(1, t)
+            advantages[:, t] = deltas.select(1, t) + gamma * lamda * (1 - d_mask.select(1, t)) * prev_advantage
+            if use_gae_returns:
+                returns[:, t] = value.select(1, t) + advantages.select(1, t)
+            else:
+                returns[:, t] = r.select(1, t) + gamma * (1 - d_mask.select(1, t)) * prev_return
+            prev_return = returns.select(1, t)
+            prev_value = value.select(1, t)
+            prev_advantage = advantages.select(1, t)
+        return returns, advantages
+
+    n_agent = 8
+    for T in [25, 600]:
+        b = max(args.batch_size // T, 1)
+        value, r = torch.randn(b, T, n_agent, 1), torch.randn(b, T, n_agent, 1)
+        last_value = torch.randn(b, n_agent, 1)
+        d = torch.rand(b, T, n_agent, 1) < 0.01
+        for use_rtg, use_gae_returns in [(False, False), (True, False), (False, True)]:
+            estimator = AdvantageEstimator(0.99, 0.5, use_rtg, use_gae_returns)
+            returns, advantages, _ = estimator(value, last_value, r, d)
+            ref_returns, ref_advantages = reference(value, last_value, r, d, 0.99, 0.5, use_rtg, use_gae_returns)
+            assert torch.allclose(returns, ref_returns, atol=1e-4) and torch.allclose(advantages, ref_advantages, atol=1e-4), \
+                f"mismatch at T={T}, use_rtg={use_rtg}, use_gae_returns={use_gae_returns}"
+            t_ref = timeit(lambda: reference(value, last_value, r, d, 0.99, 0.5, use_rtg, use_gae_returns), n_repeat=5)
+            t_fast = timeit(lambda: estimator(value, last_value, r, d), n_repeat=5)
+            print(f"T {T:4d} batch {b:5d} rtg {use_rtg:d} gae_returns {use_gae_returns:d} loop {t_ref*1e3:8.3f}ms scan {t_fast*1e3:8.3f}ms speedup {t_ref/t_fast:6.2f}x")
+
+
+def benchSumo(args):
+    """Steps/sec of the SUMO-backed envs, with TraCI and with libsumo (if installed)."""
+    import numpy as np
+    from algorithms.envs.Ring import makeRingAttenuation
+    from algorithms.envs.FigureEight import makeFigureEight2
+
+    n_step = 500
+    for name, make in [('ring', makeRingAttenuation), ('figure_eight', makeFigureEight2)]:
+        for use_libsumo in [False, True]:
+            backend = 'libsumo' if use_libsumo else 'traci'
+            try:
+                env = make(use_libsumo=use_libsumo)
+            except ImportError:
+                print(f"{name:12s} {backend:8s} skipped, libsumo is not installed")
+                continue
+            env.reset()
+            actions = np.zeros((env.n_agent, 1), dtype=np.float32)
+            time_t = time.time()
+            for _ in range(n_step):
+                env.step(actions)
+            steps_per_sec = n_step / (time.time() - time_t)
+            env.terminate()
+            print(f"{name:12s} {backend:8s} {steps_per_sec:8.1f} steps/s")
+
+
+# the recorded SUMO trajectories of benchLoopSim, regenerated with --record (needs SUMO)
+LOOP_RECORDING = 'benchmark_data/loop_{}_sumo.npz'
+# tolerances of the numpy loop simulator against the SUMO recordings: max |dv| (m/s), mean |dv| (m/s), max |dx| (m).
+# The ring matches SUMO up to the float32 rounding of the recording: this is a parity test.
+# The figure eight does not: the numpy simulator approximates the right of way at the crossing (see loop.py), which
+# shifts a few vehicles by up to ~1 m/s and ~5 m. Parity with SUMO is not claimed there, the tolerances are only set
+# above the recorded deviations so that changes to the junction approximation are noticed.
+LOOP_TOLERANCE = {
+    'ring': (1e-3, 1e-4, 1e-2),
+    'figure_eight': (1.5, 0.05, 7.5),
+}
+
+
+def rolloutLoop(make, simulator, n_step):
+    """Speeds and positions [n_step, n_veh] of a loop env run from seed 0 with random actions, the length and steps/sec."""
+    import random
+    import numpy as np
+
+    random.seed(0)
+    np.random.seed(0)
+    env = make(simulator=simulator)
+    env.reset()
+    ids = env.k.vehicle.get_ids()
+    rng = np.random.RandomState(0)
+    speeds, positions = [], []
+    time_t = time.time()
+    for _ in range(n_step):
+        actions = rng.uniform(-1, 1, size=(env.n_agent, 1)).astype(np.float32)
+        env.step(actions)
+        speeds.append(env.k.vehicle.get_speed(ids))
+        positions.append(env.k.vehicle.get_x_by_id(ids))
+    steps_per_sec = n_step / (time.time() - time_t)
+    return env, ids, np.array(speeds), np.array(positions), env.k.network.length(), steps_per_sec
+
+
+def benchLoopSim(args):
+    """Parity of the numpy loop simulator with SUMO and of the batched loop envs with the flow ones, and steps/sec.
+
+    The numpy envs are run from the same seed with the same random actions as the SUMO trajectories recorded in
+    LOOP_RECORDING, and the deviations of the speeds and positions of the vehicles are checked against LOOP_TOLERANCE,
+    so SUMO is only needed to regenerate the recordings (--record). Only the ring is claimed to match SUMO,
+    the figure eight check is a regression check of the approximate crossing (see LOOP_TOLERANCE).
+    The batched env (see BatchedLoopEnv) with n_env=1 should then run the same episode as the numpy env,
+    and is timed with n_env=--batch_size.
+    """
+    import random
+    import numpy as np
+    from algorithms.envs.Ring import makeRingAttenuation, makeRingAttenuationBatched
+    from algorithms.envs.FigureEight import makeFigureEight2, makeFigureEight2Batched
+
+    n_step = 500
+    for name, make, make_batched in [('ring', makeRingAttenuation, makeRingAttenuationBatched),
+                                     ('figure_eight', makeFigureEight2, makeFigureEight2Batched)]:
+        path = LOOP_RECORDING.format(name)
+        if args.record:
+            env, _, speed, x, length, steps_per_sec = rolloutLoop(make, 'traci', n_step)
+            env.terminate()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            np.savez_compressed(path, speed=speed.astype(np.float32), x=x.astype(np.float32), length=length)
+            print(f"{name:12s} {'traci':6s} {steps_per_sec:8.1f} steps/s, recorded to {path}")
+
+        env, ids, speed, x, length, steps_per_sec = rolloutLoop(make, 'numpy', n_step)
+        env.terminate()
+        print(f"{name:12s} {'numpy':6s} {steps_per_sec:8.1f} steps/s")
+
+        # the same episode with the batched env
+        random.seed(0)
+        np.random.seed(0)
+        envs = make_batched(1)
+        envs.reset()
+        slots = [envs.worlds.slots[veh_id] for veh_id in ids]
+        rng = np.random.RandomState(0)
+        batched_speed, batched_x = [], []
+        for _ in range(n_step):
+            actions = rng.uniform(-1, 1, size=(1, envs.n_agent, 1)).astype(np.float32)
+            envs.step(actions)
+            batched_speed.append(envs.worlds.speed[0, slots])
+            batched_x.append(envs.worlds.pos[0, slots])
+        dv = np.abs(np.array(batched_speed) - speed).max()
+        dx = np.abs(np.array(batched_x) - x).max()
+        assert dv < 1e-3 and dx < 1e-3, f"{name}: the batched env deviates from the numpy env by {dv} m/s, {dx} m"
+
+        n_env = args.batch_size
+        envs = make_batched(n_env)
+        envs.reset()
+        actions = np.zeros((n_env, envs.n_agent, 1), dtype=np.float32)
+        time_t = time.time()
+        for _ in range(n_step // 10):
+            envs.step(actions)
+        env_steps_per_sec = n_env * (n_step // 10) / (time.time() - time_t)
+        print(f"{name:12s} {'batch':6s} {env_steps_per_sec:8.1f} env steps/s ({n_env} envs)")
+
+        recording = np.load(path)
+        assert recording['speed'].shape == speed.shape, \
+            f"{name}: the numpy env does not match the setup of the recording, rerun with --record"
+        # the positions wrap around the length of the SUMO network (which includes the junctions)
+        length = recording['length']
+        dv = np.abs(speed - recording['speed'])
+        dx = np.abs((x - recording['x'] + length / 2) % length - length / 2)
+        print(f"{name:12s} parity: max |dv| {dv.max():.3f} m/s, mean |dv| {dv.mean():.3f} m/s, max |dx| {dx.max():.3f} m")
+        max_dv, mean_dv, max_dx = LOOP_TOLERANCE[name]
+        assert dv.max() <= max_dv and dv.mean() <= mean_dv and dx.max() <= max_dx, \
+            f"{name}: the numpy loop simulator deviates from SUMO beyond {LOOP_TOLERANCE[name]}"
+
+
+def benchPolicy(args):
+    from algorithms.mbdppo.MB_DPPO import DPPOAgent
+    from algorithms.mbdppo.policy import exportPolicy
+
+    for n_agent in [8, 64]:
+        for stacked in [False, True]:
+            agent = DPPOAgent(NullLogger(), args.device, catchupAgentArgs('Catchup_DPPO', n_agent, stacked=stacked))
+            policy = exportPolicy(agent)
+            s = torch.randn(args.batch_size, n_agent, 5, device=args.device)
+            probs = agent._evalPi(s)
+            a, logp = policy(s, True)
+            assert torch.equal(a, probs.argmax(dim=-1)), f"action mismatch at n_agent={n_agent}"
+            assert torch.allclose(logp, torch.log(probs.gather(-1, a.unsqueeze(-1))).squeeze(-1), atol=1e-5), \
+                f"logp mismatch at n_agent={n_agent}"
+
+            def reference():
+                dist = agent.act(s)
+                a = dist.sample()
+                return a, dist.log_prob(a)
+            t_ref = timeit(reference)
+            t_fast = timeit(lambda: policy(s))
+            print(f"n_agent {n_agent:3d} stacked {stacked:d} act {t_ref*1e3:8.3f}ms scripted {t_fast*1e3:8.3f}ms speedup {t_ref/t_fast:6.2f}x")
+
+
+def benchIC3Net(args):
+    from algorithms.mbdppo.MB_DPPO import IC3Net
+
+    def reference(agent, s):
+        """The per-sample message passing and per-agent heads of IC3Net with nn.ModuleList layers."""
+        s_encoding = agent.activation_function(agent.obs_encoder(s))
+        batch_comm_adj = agent.adj.unsqueeze(0).repeat(s.shape[0], 1, 1)
+        batch_message = torch.stack([torch.mm(batch_comm_adj.select(0, i), s_encoding.select(0, i)) for i in range(s.shape[0])], dim=0)
+
+        def group_inference(model, data):
+            return torch.stack([model[i](data.select(1, i)) for i in range(agent.n_agent)], dim=1)
+        hidden_state = s_encoding + group_inference(agent.main_models, s_encoding) + group_inference(agent.message_models, batch_message)
+        return group_inference(agent.actors, hidden_state), group_inference(agent.value_heads, hidden_state)
+
+    def fast(agent, s):
+        hidden_state = agent.inference_hidden_state(s)
+        return agent._evalPi(hidden_state), agent.group_inference(agent.value_heads, hidden_state)
+
+    for n_agent in [8, 32]:
+        agent = IC3Net(NullLogger(), args.device, catchupAgentArgs('Catchup_IC3Net', n_agent)).to(args.device)
+        stacked = IC3Net(NullLogger(), args.device, catchupAgentArgs('Catchup_IC3Net', n_agent, stacked=True)).to(args.device)
+        stacked.load_state_dict(agent.state_dict())
+        for batch_size in [args.batch_size, 10000]:
+            s = torch.randn(batch_size, n_agent, 5, device=args.device)
+            probs_ref, v_ref = reference(agent, s)
+            for model in [agent, stacked]:
+                probs, v = fast(model, s)
+                assert torch.allclose(probs, probs_ref, atol=1e-5), f"probs mismatch at n_agent={n_agent}"
+                assert torch.allclose(v, v_ref, atol=1e-4), f"value mismatch at n_agent={n_agent}"
+            t_ref = timeit(lambda: reference(agent, s), n_repeat=5)
+            t_batched = timeit(lambda: fast(agent, s), n_repeat=5)
+            t_stacked = timeit(lambda: fast(stacked, s), n_repeat=5)
+            print(f"n_agent {n_agent:3d} batch {batch_size:6d} loop {t_ref*1e3:9.3f}ms batched {t_batched*1e3:9.3f}ms "
+                  f"stacked {t_stacked*1e3:9.3f}ms speedup {t_ref/t_stacked:6.2f}x")
+
+
+def benchModelRollout(args):
+    from algorithms.mbdppo.MB_DPPO import MB_DPPOAgent, TrajectoryBuffer
+    from algorithms.mbdppo.rollout import ModelRollout
+
+    class Greedy:
+        """The action distribution of a policy, sampled greedily."""
+        def __init__(self, dist):
+            self.dist = dist
+
+        def sample(self):
+            return self.dist.probs.argmax(dim=-1)
+
+        def log_prob(self, a):
+            return self.dist.log_prob(a)
+
+    class Deterministic:
+        """
+        The agent with greedy actions and thresholded dones, so that a branch does not depend on the others of its batch
+        and the rollouts with and without masking see the same branches.
+        """
+        n_ensemble = 1
+
+        def __init__(self, agent, done_thres):
+            self.agent = agent
+            self.done_thres = done_thres
+
+        def act(self, s):
+            return Greedy(self.agent.act(s))
+
+        def model_step(self, s, a, uncertainty=False, member=None, t=None):
+            r, s1, d = self.agent.ps.forward(s, a.unsqueeze(-1))
+            return r, s1, d > self.done_thres, s
+
+    def reference(model, s, length):
+        """The per-step loop of rollout_model() before ModelRollout."""
+        trajs = TrajectoryBuffer(device=args.device)
+        for _ in range(length):
+            dist = model.act(s)
+            a = dist.sample()
+            logp = dist.log_prob(a)
+            r, s1, d, _ = model.model_step(s, a)
+            trajs.store(s, a, r, s1, d, logp)
+            s = s1
+        return trajs.retrieveBatch()
+
+    n_agent, length = 8, 25
+    agent = MB_DPPOAgent(NullLogger(), args.device, catchupAgentArgs('Catchup_DMPO', n_agent))
+    s = torch.randn(args.batch_size, n_agent, 5, device=args.device)
+    _, _, d = agent.ps.forward(s, agent.act(s).probs.argmax(dim=-1).unsqueeze(-1))
+    # about a tenth of the branches stop at each step
+    branch_d = d.view(args.batch_size, -1).max(dim=1)[0]
+    model = Deterministic(agent, branch_d.kthvalue(int(0.9 * args.batch_size))[0].item())
+    ref = reference(model, s, length)
+
+    # the first done step of each branch, length if it never stops
+    done = ref['d'].view(args.batch_size, length, -1).any(dim=2)
+    stop = torch.where(done.any(dim=1), done.float().argmax(dim=1), torch.full_like(done[:, 0], length, dtype=torch.long))
+    steps = torch.arange(length, device=args.device)
+    expected_valid = steps.unsqueeze(0) <= stop.unsqueeze(1)
+    for mask_done in [False, True]:
+        batch, n_step = ModelRollout(model, device=args.device, mask_done=mask_done)(s, length)
+        valid = batch['valid'].view(args.batch_size, length, -1).all(dim=2)
+        if not mask_done:
+            assert valid.all() and n_step == args.batch_size * length, "the rollout without masking should evaluate every step"
+            assert all(torch.allclose(batch[name].float(), ref[name].float(), atol=1e-5) for name in ref), \
+                "the rollout without masking mismatches the per-step loop"
+            continue
+        assert torch.equal(valid, expected_valid), "mask_done stops the branches at the wrong steps"
+        assert n_step == int(expected_valid.sum()), "mask_done evaluates the wrong number of branch-steps"
+        for name in ref:
+            rows = expected_valid.view(args.batch_size, length, *[1] * (ref[name].dim() - 2)).expand_as(ref[name])
+            assert torch.allclose(batch[name][rows].float(), ref[name][rows].float(), atol=1e-5), \
+                f"{name} of mask_done mismatches the per-step loop on the valid steps"
+        assert batch['d'][~expected_valid].all(), "the padding of mask_done should be done"
+        # the first padding step of a stopped branch starts from the s1 of its last step
+        stopped = (stop < length - 1).nonzero().view(-1)
+        first_pad = stop.index_select(0, stopped) + 1
+        assert torch.allclose(batch['s'][stopped, first_pad], ref['s1'][stopped, first_pad - 1], atol=1e-5), \
+            "the padding of mask_done should start from the s1 of the last valid step"
+
+    t_ref = timeit(lambda: reference(model, s, length), n_repeat=5)
+    t_full = timeit(lambda: ModelRollout(model, device=args.device)(s, length), n_repeat=5)
+    t_masked = timeit(lambda: ModelRollout(model, device=args.device, mask_done=True)(s, length), n_repeat=5)
+    print(f"n_traj {args.batch_size:5d} length {length} loop {t_ref*1e3:8.3f}ms rollout {t_full*1e3:8.3f}ms "
+          f"mask_done {t_masked*1e3:8.3f}ms ({float(expected_valid.float().mean()):.2f} of the steps) speedup {t_ref/t_masked:6.2f}x")
+
+
+BENCHMARKS = {
+    'collect': benchCollect,
+    'gae': benchGAE,
+    'sumo': benchSumo,
+    'loop': benchLoopSim,
+    'policy': benchPolicy,
+    'ic3net': benchIC3Net,
+    'rollout': benchModelRollout,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', type=str, required=False, default='all', help=f"benchmark to run ({'/'.join(BENCHMARKS)}/all)")
+    parser.add_argument('--device', type=str, required=False, default='cpu', help="torch device")
+    parser.add_argument('--batch_size', type=int, required=False, default=1024, help="batch size of the synthetic inputs")
+    parser.add_argument('--record', action='store_true', help="loop: record the SUMO trajectories again (needs SUMO)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    targets = list(BENCHMARKS) if args.target == 'all' else [args.target]
+    for target in targets:
+        print(f"===== {target} =====")
+        with torch.no_grad():
+            BENCHMARKS[target](args)
@@ -43,6 +43,7 @@ def getRunArgs(input_args):
     run_args.init_checkpoint = None
     run_args.start_step = 0
     run_args.save_period = 1800 # in seconds
+    run_args.n_checkpoint = None # keeps the last n_checkpoint checkpoints, None for all
     run_args.log_period = int(20)
     run_args.seed = None
     return run_args
@@ -179,7 +180,7 @@ print(f"n_gpus {torch.cuda.device_count()}")
 
 if run_args.profiling:
     import cProfile
-    cProfile.run("OnPolicyRunner(logger = logger, run_args=run_args, alg_args=alg_args, agent=agent, env_learn=env_train, env_test = env_test).run()",
+    cProfile.run("OnPolicyRunner(logger = logger, run_args=run_args, alg_args=alg_args, agent=agent, env_learn=env_train, env_test = env_test, env_fn_test=env_fn_test).run()",
                  filename=f'device{run_args.device}_parallel{run_args.parallel}.profile')
 else:
-    OnPolicyRunner(logger = logger, run_args=run_args, alg_args=alg_args, agent=agent, env_learn=env_train, env_test = env_test).run()
+    OnPolicyRunner(logger = logger, run_args=run_args, alg_args=alg_args, agent=agent, env_learn=env_train, env_test = env_test, env_fn_test=env_fn_test).run()